@@ -4,6 +4,7 @@ const rateLimit = require('express-rate-limit');
 const { getCustomersCollection } = require('../config/db');
 const { ObjectId } = require('mongodb');
 const { generateDocumentation } = require('../services/sharepointService');
+const { runPythonProcessor, abortSignalForRequest } = require('../services/renderScheduler');
 const path = require('path');
 const fs = require('fs');
 const { connectToDatabase } = require('../config/db');
@@ -1886,8 +1887,6 @@ router.post('/shop/:shopId/documentation', validateAuthentication, async (req, r
     // Handle SharePoint documentation generation
     if (action === 'document') {
       try {
-        // SECURITY: Use spawn instead of exec to prevent command injection
-        const { spawn } = require('child_process');
         const base64 = require('base64-js');
         
         // Create shop data with single product for appending
@@ -1944,40 +1943,13 @@ router.post('/shop/:shopId/documentation', validateAuthentication, async (req, r
         
         logger.debug('Calling merch XLSX processor for single product...');
         
-        // SECURITY: Use spawn with array arguments to prevent command injection
-        const pythonScript = path.join(__dirname, '../services/merch_xlsx_processor.py');
-        const args = [pythonScript, templatePath, encodedShopData, outputPath];
-        
-        const pythonProcess = spawn('python3', args, {
-          stdio: ['pipe', 'pipe', 'pipe'],
-          shell: false // SECURITY: Disable shell to prevent injection
-        });
-        
-        let stdout = '';
-        let stderr = '';
-        
-        pythonProcess.stdout.on('data', (data) => {
-          stdout += data.toString();
-        });
-        
-        pythonProcess.stderr.on('data', (data) => {
-          stderr += data.toString();
-        });
-        
-        // Wait for process to complete
-        await new Promise((resolve, reject) => {
-          pythonProcess.on('close', (code) => {
-            if (code === 0) {
-              resolve();
-            } else {
-              reject(new Error(`Python process exited with code ${code}`));
-            }
-          });
-          
-          pythonProcess.on('error', (error) => {
-            reject(error);
-          });
-        });
+        // Interactive priority: served ahead of onboarding bundles by the render scheduler
+        // (spawned with array arguments and no shell, see renderScheduler)
+        const { stdout, stderr } = await runPythonProcessor(
+          'merch_xlsx_processor.py',
+          [templatePath, encodedShopData, outputPath],
+          { priority: 'interactive', label: 'single product documentation', signal: abortSignalForRequest(res) }
+        );
         
         // Log any stderr output as a warning, but do NOT treat it as a fatal error.
         // openpyxl (used by merch_xlsx_processor.py) prints benign warnings such as
@@ -2027,6 +1999,15 @@ router.post('/shop/:shopId/documentation', validateAuthentication, async (req, r
       } catch (err) {
         logger.error('Error generating documentation:', err);
         
+        // The render scheduler sheds interactive work it cannot serve in time
+        if (err.code === 'RENDER_OVERLOADED' || err.code === 'RENDER_DEADLINE_EXCEEDED') {
+          return res.status(503).json({
+            success: false,
+            message: 'Le service de génération de documents est surchargé, veuillez réessayer dans quelques instants',
+            shopId
+          });
+        }
+        
         // Handle the special case where documentation already exists
         if (err.message === 'DOCUMENTATION_EXISTS') {
           return res.status(409).json({
@@ -2221,7 +2202,6 @@ router.post('/shop/:shopId/product/:productId/documentation', async (req, res) =
     if (action === 'document') {
       try {
         // Call the merch XLSX processor to append product to existing document
-        const { spawn } = require('child_process');
         const base64 = require('base64-js');
         
         // Create shop data with single product for appending
@@ -2278,40 +2258,13 @@ router.post('/shop/:shopId/product/:productId/documentation', async (req, res) =
         
         logger.debug('Calling merch XLSX processor for single product...');
         
-        // SECURITY: Use spawn with array arguments to prevent command injection
-        const pythonScript = path.join(__dirname, '../services/merch_xlsx_processor.py');
-        const args = [pythonScript, templatePath, encodedShopData, outputPath];
-        
-        const pythonProcess = spawn('python3', args, {
-          stdio: ['pipe', 'pipe', 'pipe'],
-          shell: false // SECURITY: Disable shell to prevent injection
-        });
-        
-        let stdout = '';
-        let stderr = '';
-        
-        pythonProcess.stdout.on('data', (data) => {
-          stdout += data.toString();
-        });
-        
-        pythonProcess.stderr.on('data', (data) => {
-          stderr += data.toString();
-        });
-        
-        // Wait for process to complete
-        await new Promise((resolve, reject) => {
-          pythonProcess.on('close', (code) => {
-            if (code === 0) {
-              resolve();
-            } else {
-              reject(new Error(`Python process exited with code ${code}`));
-            }
-          });
-          
-          pythonProcess.on('error', (error) => {
-            reject(error);
-          });
-        });
+        // Interactive priority: served ahead of onboarding bundles by the render scheduler
+        // (spawned with array arguments and no shell, see renderScheduler)
+        const { stdout, stderr } = await runPythonProcessor(
+          'merch_xlsx_processor.py',
+          [templatePath, encodedShopData, outputPath],
+          { priority: 'interactive', label: 'single product documentation', signal: abortSignalForRequest(res) }
+        );
         
         // Log any stderr output as a warning, but do NOT treat it as a fatal error.
         // openpyxl (used by merch_xlsx_processor.py) prints benign warnings such as
@@ -2360,6 +2313,14 @@ router.post('/shop/:shopId/product/:productId/documentation', async (req, res) =
         
       } catch (error) {
         logger.error('Error generating product documentation:', error);
+        if (error.code === 'RENDER_OVERLOADED' || error.code === 'RENDER_DEADLINE_EXCEEDED') {
+          return res.status(503).json({
+            success: false,
+            message: 'Le service de génération de documents est surchargé, veuillez réessayer dans quelques instants',
+            productId,
+            documented: false
+          });
+        }
         res.status(500).json({
           success: false,
           message: `Erreur lors de la génération de la documentation: ${error.message}`,
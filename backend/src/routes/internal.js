@@ -15,6 +15,7 @@ const multer = require('multer');
 const { S3Client, GetObjectCommand, DeleteObjectCommand } = require('@aws-sdk/client-s3');
 const { getSignedUrl: getSignedUrlV3 } = require('@aws-sdk/s3-request-presigner');
 const { getSensitiveDocument, documentExists } = require('../services/sensitiveDocumentsS3');
+const { abortSignalForRequest } = require('../services/renderScheduler');
 
 // S3 Client Configuration
 const s3Client = new S3Client({
@@ -1233,7 +1234,7 @@ router.post('/shop/:shopId/documentation', requireInternalAPIAuth, async (req, r
          const { generateDocumentation } = require('../services/sharepointService');
          
          // Generate SharePoint documentation
-         await generateDocumentation(customer, shop, forceOverwrite);
+         await generateDocumentation(customer, shop, forceOverwrite, { signal: abortSignalForRequest(res) });
          
          // Update shop status to documented
          const productsCount = shop.products?.length || 0;
@@ -3314,6 +3315,55 @@ router.get('/clients/:clientId/shops/:shopId', requireInternalAPIAuth, async (re
   }
 });
 
+// Preview of the fiche projet / Web-Design intro with the shop's values, without generating
+// the DOCX. Unsaved form values can be sent in `shop` and take precedence over the stored ones.
+router.post('/clients/:clientId/shops/:shopId/document-preview', requireInternalAPIAuth, async (req, res) => {
+  try {
+    const { clientId, shopId } = req.params;
+    const { document = 'ficheProjet', format = 'html', shop: formValues = {} } = req.body || {};
+
+    if (!['ficheProjet', 'webDesign'].includes(document) || !['html', 'text'].includes(format)) {
+      return res.status(400).json({
+        success: false,
+        message: 'Document ou format de prévisualisation invalide'
+      });
+    }
+
+    const customersCollection = await getCustomersCollection();
+    const customer = await customersCollection.findOne({
+      _id: new ObjectId(clientId),
+      'shops.shopId': shopId
+    });
+    const shop = customer && customer.shops.find(s => s.shopId === shopId);
+    if (!shop) {
+      return res.status(404).json({
+        success: false,
+        message: 'Boutique non trouvée'
+      });
+    }
+
+    const { previewShopDocument } = require('../services/sharepointService');
+    const preview = await previewShopDocument(customer, { ...shop, ...formValues }, document, format, {
+      signal: abortSignalForRequest(res)
+    });
+    res.status(200).json({ success: true, document, format, preview });
+  } catch (error) {
+    if (error.code === 'RENDER_INVALID_PAYLOAD') {
+      return res.status(400).json({
+        success: false,
+        message: 'Valeurs de la boutique invalides pour la prévisualisation',
+        errors: error.errors
+      });
+    }
+    logger.error('Error generating document preview:', error.message);
+    res.status(500).json({
+      success: false,
+      message: 'Erreur lors de la prévisualisation du document',
+      error: error.message
+    });
+  }
+});
+
 // NEW: Route to save Shopify credentials and retry theme configuration
 router.post('/shops/:shopId/save-credentials-and-configure-theme', requireInternalAPIAuth, async (req, res) => {
   const { shopId } = req.params;
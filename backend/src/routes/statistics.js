@@ -1,6 +1,7 @@
 const express = require('express');
 const router = express.Router();
 const { getCustomersCollection } = require('../config/db');
+const { getRenderStats } = require('../services/renderScheduler');
 
 // Get comprehensive statistics
 router.get('/', async (req, res) => {
@@ -239,4 +240,13 @@ router.get('/', async (req, res) => {
   }
 });
 
+// Document render scheduler: queue depth, concurrency and wait/run time percentiles per priority
+router.get('/render-queue', (req, res) => {
+  res.json({
+    success: true,
+    renderQueue: getRenderStats(),
+    generatedAt: new Date().toISOString()
+  });
+});
+
 module.exports = router; 
\ No newline at end of file
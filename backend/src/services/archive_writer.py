@@ -0,0 +1,344 @@
+import hashlib
+import io
+import json
+import os
+import struct
+import time
+import zlib
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+from render_progress import bytes_saved, checkpoint, emit
+
+# Shared save layer for the DOCX/XLSX processors.
+#
+# python-docx, openpyxl and the XML fallback all used to write their archives through
+# zipfile.ZipFile(ZIP_DEFLATED), i.e. member by member on a single core at the default
+# level. Here the members are collected in memory first, independent members are deflated
+# in parallel threads (zlib releases the GIL while compressing) and members copied from a
+# source archive without changes keep their already compressed bytes.
+#
+# Output is byte-deterministic: members are written in a fixed order with a fixed timestamp,
+# so rendering the same template with the same payload gives the same file, and the SHA-256
+# of the written bytes is returned with the save statistics. Callers compare it with the
+# digest of the last upload to skip sending identical documents again.
+
+SAVE_PROFILES = {
+    # Lowest deflate level, already compressed media is stored as-is
+    'fast': {'level': 1, 'store_media': True},
+    # Same compression as zipfile.ZIP_DEFLATED
+    'default': {'level': 6, 'store_media': False},
+    # Smallest files, slowest saves
+    'small': {'level': 9, 'store_media': False},
+}
+
+DEFAULT_SAVE_PROFILE = 'default'
+
+# Members bigger than this are compressed in the thread pool, smaller ones inline
+PARALLEL_MIN_SIZE = 16 * 1024
+
+# Timestamp of every member (the zip format cannot go earlier)
+FIXED_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+# Prefix of the line processors print so callers can pick the digest out of stdout
+RENDER_DIGEST_PREFIX = 'RENDER_DIGEST'
+
+MEDIA_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.tif', '.tiff', '.wdp', '.mp3', '.mp4', '.zip')
+
+
+def resolve_save_profile(name=None):
+    """Return (profile name, settings) for `name`, falling back to $DOCUMENT_SAVE_PROFILE then 'default'."""
+    profile_name = name or os.environ.get('DOCUMENT_SAVE_PROFILE') or DEFAULT_SAVE_PROFILE
+    if profile_name not in SAVE_PROFILES:
+        raise ValueError(f"Unknown save profile '{profile_name}', expected one of {sorted(SAVE_PROFILES)}")
+    return profile_name, SAVE_PROFILES[profile_name]
+
+
+class MemberCollector:
+    """Minimal stand-in for a writable ZipFile: keeps every member in memory, in write order."""
+
+    def __init__(self):
+        self.members = []
+
+    def writestr(self, zinfo_or_arcname, data):
+        name = zinfo_or_arcname.filename if isinstance(zinfo_or_arcname, zipfile.ZipInfo) else zinfo_or_arcname
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self.members.append((name, bytes(data)))
+
+    def write(self, filename, arcname=None):
+        with open(filename, 'rb') as f:
+            self.writestr(arcname or os.path.basename(filename), f.read())
+
+    def namelist(self):
+        return [name for name, _ in self.members]
+
+    def close(self):
+        pass
+
+
+def _deflate(data, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _dos_date_time(date_time):
+    year, month, day, hour, minute, second = date_time[:6]
+    dos_date = (max(year, 1980) - 1980) << 9 | month << 5 | day
+    dos_time = hour << 11 | minute << 5 | (second // 2)
+    return dos_date, dos_time
+
+
+def _read_raw_member(fp, info):
+    """Return the compressed bytes of `info` exactly as stored in the archive opened as `fp`."""
+    fp.seek(info.header_offset)
+    header = fp.read(30)
+    name_length, extra_length = struct.unpack('<HH', header[26:30])
+    fp.seek(info.header_offset + 30 + name_length + extra_length)
+    return fp.read(info.compress_size)
+
+
+def _member_order(member):
+    # Content types and package relationships first, as Office writes them, then by name
+    name = member[0]
+    return (name != '[Content_Types].xml', name != '_rels/.rels', name)
+
+
+def _prepare_entries(members, settings, workers):
+    """Compress the new members of `members` and return the entries to write, in order.
+
+    `members` holds (name, data) tuples for new content and (name, ZipInfo, raw bytes)
+    tuples for members reused from another archive.
+    """
+    date_time = FIXED_DATE_TIME
+    entries = [None] * len(members)
+    jobs = {}
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for index, member in enumerate(members):
+            if len(member) == 3:
+                name, info, raw = member
+                entries[index] = {
+                    'name': name, 'method': info.compress_type, 'date_time': date_time,
+                    'crc': info.CRC, 'size': info.file_size, 'payload': raw,
+                }
+                continue
+
+            checkpoint()
+            name, data = member
+            entry = {'name': name, 'date_time': date_time, 'crc': zlib.crc32(data), 'size': len(data)}
+            if settings['store_media'] and name.lower().endswith(MEDIA_EXTENSIONS):
+                entry.update(method=zipfile.ZIP_STORED, payload=data)
+            elif len(data) >= PARALLEL_MIN_SIZE and workers > 1:
+                entry['method'] = zipfile.ZIP_DEFLATED
+                jobs[index] = pool.submit(_deflate, data, settings['level'])
+            else:
+                entry.update(method=zipfile.ZIP_DEFLATED, payload=_deflate(data, settings['level']))
+            entries[index] = entry
+
+        for index, future in jobs.items():
+            entries[index]['payload'] = future.result()
+
+    return entries
+
+
+class _DigestWriter:
+    """File wrapper hashing everything written through it."""
+
+    def __init__(self, fp):
+        self._fp = fp
+        self.sha256 = hashlib.sha256()
+
+    def write(self, data):
+        self.sha256.update(data)
+        return self._fp.write(data)
+
+
+def _write_entries(fp, entries):
+    """Write local headers, data and the central directory for `entries`; return bytes written."""
+    central_directory = []
+    offset = 0
+    # Local headers (30 bytes) and central directory records (46 bytes), plus the end record
+    total = sum(76 + 2 * len(entry['name'].encode('utf-8')) + len(entry['payload']) for entry in entries) + 22
+    for entry in entries:
+        name = entry['name'].encode('utf-8')
+        flags = 0x800 if not entry['name'].isascii() else 0
+        dos_date, dos_time = _dos_date_time(entry['date_time'])
+        payload = entry['payload']
+        if len(payload) > 0xFFFFFFFF or entry['size'] > 0xFFFFFFFF or offset > 0xFFFFFFFF:
+            raise ValueError(f"Member {entry['name']} is too large for a non-zip64 archive")
+
+        header = struct.pack(
+            '<IHHHHHIIIHH', 0x04034b50, 20, flags, entry['method'], dos_time, dos_date,
+            entry['crc'], len(payload), entry['size'], len(name), 0,
+        )
+        fp.write(header)
+        fp.write(name)
+        fp.write(payload)
+
+        central_directory.append(struct.pack(
+            '<IHHHHHHIIIHHHHHII', 0x02014b50, 20, 20, flags, entry['method'], dos_time, dos_date,
+            entry['crc'], len(payload), entry['size'], len(name), 0, 0, 0, 0, 0o600 << 16, offset,
+        ) + name)
+        offset += len(header) + len(name) + len(payload)
+        bytes_saved(offset, total)
+
+    directory = b''.join(central_directory)
+    fp.write(directory)
+    fp.write(struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, len(entries), len(entries), len(directory), offset, 0))
+    emit('saved', bytes=total, total=total)
+    return offset + len(directory) + 22
+
+
+def write_archive(output_path, members, profile=None, workers=None):
+    """Write `members` to a new zip archive at `output_path` and return save statistics."""
+    profile_name, settings = resolve_save_profile(profile)
+    workers = workers or min(len(members), os.cpu_count() or 1) or 1
+
+    started = time.perf_counter()
+    entries = _prepare_entries(sorted(members, key=_member_order), settings, workers)
+    compress_seconds = time.perf_counter() - started
+
+    # Write next to the destination first so a failed save never leaves a truncated file behind
+    temp_path = f"{output_path}.{os.getpid()}.part"
+    try:
+        with open(temp_path, 'wb') as temp_fp:
+            writer = _DigestWriter(temp_fp)
+            bytes_written = _write_entries(writer, entries)
+        os.replace(temp_path, output_path)
+    except Exception:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+    return {
+        'profile': profile_name,
+        'members': len(entries),
+        'reused_members': sum(1 for member in members if len(member) == 3),
+        'compress_seconds': round(compress_seconds, 4),
+        'bytes_written': bytes_written,
+        'sha256': writer.sha256.hexdigest(),
+    }
+
+
+def rewrite_archive(source_path, output_path, replacements, profile=None):
+    """Copy `source_path` to `output_path`, replacing the members named in `replacements`.
+
+    Unchanged members are copied with their original compressed bytes. `source_path` and
+    `output_path` may be the same file.
+    """
+    members = []
+    with open(source_path, 'rb') as fp, zipfile.ZipFile(fp, 'r') as zin:
+        for info in zin.infolist():
+            if info.filename in replacements:
+                members.append((info.filename, replacements[info.filename]))
+            else:
+                members.append((info.filename, info, _read_raw_member(fp, info)))
+    return write_archive(output_path, members, profile)
+
+
+def reuse_source_members(members, source_path):
+    """Return `members` with every (name, data) member whose content is unchanged from the
+    same member of the archive at `source_path` (usually the template) turned into a reused
+    member, so its original compressed bytes are written instead of deflating it again."""
+    if not source_path or not os.path.exists(source_path):
+        return members
+    reused = []
+    with open(source_path, 'rb') as fp, zipfile.ZipFile(fp, 'r') as zin:
+        sources = {info.filename: info for info in zin.infolist()
+                   if info.compress_type in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED)}
+        for member in members:
+            info = sources.get(member[0]) if len(member) == 2 else None
+            # Size and CRC first, the full comparison only for the members that match
+            if info is None or info.file_size != len(member[1]) or info.CRC != zlib.crc32(member[1]):
+                reused.append(member)
+                continue
+            raw = _read_raw_member(fp, info)
+            data = raw if info.compress_type == zipfile.ZIP_STORED else zlib.decompress(raw, -15)
+            reused.append((member[0], info, raw) if data == member[1] else member)
+    return reused
+
+
+# Private python-docx PackageWriter steps save_docx() relies on (checked, see requirements.txt)
+PACKAGE_WRITER_STEPS = ('_write_content_types_stream', '_write_pkg_rels', '_write_parts')
+
+
+def save_docx(document, output_path, profile=None, source_path=None):
+    """Save a python-docx Document through the shared save layer.
+
+    Parts unchanged from the archive at `source_path` (the template) keep its compressed bytes.
+    """
+    # Same steps as docx.opc.package.OpcPackage.save(), with the zip writer swapped out
+    from docx.opc.pkgwriter import PackageWriter
+
+    if not all(hasattr(PackageWriter, name) for name in PACKAGE_WRITER_STEPS):
+        # python-docx without these private steps: let it save to memory and rewrite its members
+        buffer = io.BytesIO()
+        document.save(buffer)
+        with zipfile.ZipFile(buffer, 'r') as zin:
+            members = [(info.filename, zin.read(info)) for info in zin.infolist()]
+        return write_archive(output_path, reuse_source_members(members, source_path), profile)
+
+    package = document.part.package
+    for part in package.parts:
+        part.before_marshal()
+
+    collector = MemberCollector()
+    phys_writer = _PackUriWriter(collector)
+    PackageWriter._write_content_types_stream(phys_writer, package.parts)
+    PackageWriter._write_pkg_rels(phys_writer, package.rels)
+    PackageWriter._write_parts(phys_writer, package.parts)
+    return write_archive(output_path, reuse_source_members(collector.members, source_path), profile)
+
+
+def save_xlsx(workbook, output_path, profile=None, patch=None, source_path=None):
+    """Save an openpyxl Workbook through the shared save layer.
+
+    `patch`, if given, receives the serialized (name, data) members and returns the members
+    to write, e.g. to splice pre-rendered rows into a worksheet. Members unchanged from the
+    archive at `source_path` (the template) keep its compressed bytes.
+    """
+    # Same steps as openpyxl.writer.excel.save_workbook(), with the zip writer swapped out
+    import datetime
+    from openpyxl.writer.excel import ExcelWriter
+
+    collector = MemberCollector()
+    # openpyxl stamps the save time here; keep the template's dates instead (or
+    # $SOURCE_DATE_EPOCH) so the same render gives the same bytes
+    source_date_epoch = os.environ.get('SOURCE_DATE_EPOCH')
+    if source_date_epoch:
+        timestamp = datetime.datetime.fromtimestamp(int(source_date_epoch), tz=datetime.timezone.utc).replace(tzinfo=None)
+        workbook.properties.created = workbook.properties.modified = timestamp
+    ExcelWriter(workbook, collector).save()
+    members = patch(collector.members) if patch else collector.members
+    return write_archive(output_path, reuse_source_members(members, source_path), profile)
+
+
+def format_save_stats(stats):
+    return (f"{stats['bytes_written']} bytes written, {stats['members']} members "
+            f"({stats['reused_members']} reused), compression {stats['compress_seconds']:.3f}s, "
+            f"profile '{stats['profile']}', sha256 {stats['sha256'][:12]}")
+
+
+def file_digest(path):
+    """SHA-256 of the file at `path`, for outputs not written through write_archive."""
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def format_render_digest(output_path, sha256):
+    """Line a processor prints for each output file, read back by the Node side."""
+    return f"{RENDER_DIGEST_PREFIX} " + json.dumps({'path': os.path.abspath(output_path), 'sha256': sha256})
+
+
+class _PackUriWriter:
+    """Adapts MemberCollector to the PhysPkgWriter interface used by python-docx."""
+
+    def __init__(self, collector):
+        self._collector = collector
+
+    def write(self, pack_uri, blob):
+        self._collector.writestr(pack_uri.membername, blob)
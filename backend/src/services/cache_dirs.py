@@ -0,0 +1,22 @@
+import os
+import stat
+
+# Disk caches of the processors (template snapshots, preview models).
+#
+# Cache entries are read back without any check of their origin (template snapshots are even
+# unpickled), so they live in a directory private to the service's user, under the service's
+# own directory by default and never in a shared location such as /tmp.
+
+CACHE_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache')
+
+
+def private_cache_dir(path):
+    """Create `path` with mode 0700 if needed; True only if it is a real directory owned by
+    this user and not writable by anyone else."""
+    try:
+        os.makedirs(path, mode=0o700, exist_ok=True)
+        info = os.lstat(path)
+    except OSError:
+        return False
+    return (stat.S_ISDIR(info.st_mode) and info.st_uid == os.getuid()
+            and not info.st_mode & (stat.S_IWGRP | stat.S_IWOTH))
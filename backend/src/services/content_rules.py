@@ -0,0 +1,305 @@
+import re
+
+from lxml import etree
+
+# Conditional content for DOCX templates (contract clauses, optional modules...).
+#
+# A rule names a clause text found in the template, an action and a payload condition:
+#   {"text": "Abonnement SHOPIFY 12 mois = 948€", "action": "strike",
+#    "when": {"field": "typeAbonnementShopify", "in": ["", "aucun", "mensuel"]}}
+#
+#   action  strike | hide | remove
+#   scope   match (only the runs holding the text, strike/hide only), paragraph, row (the
+#           table row holding the text) or section (the body block holding the text up to
+#           the next heading of the same or a higher level). Default: match, paragraph for remove.
+#   when    {"field": f, "in": [...]}        value (trimmed, lower case) is one of the list
+#           {"field": f, "equals": v}
+#           {"field": f, "truthy": true}     / "falsy": true
+#           {"all": [...]}, {"any": [...]}, {"not": {...}}
+#           no "when": always applies
+#
+# The rules of a template are compiled once into a single regex holding every clause text
+# (one named group per distinct text, whitespace matched loosely). A render evaluates the
+# conditions once, then scans each paragraph's text once with that regex, so the cost of a
+# render does not grow with the number of clauses.
+
+W_NS = 'http://schemas.openxmlformats.org/wordprocessingml/2006/main'
+NAMESPACES = {'w': W_NS}
+
+ACTIONS = ('strike', 'hide', 'remove')
+SCOPES = ('match', 'paragraph', 'row', 'section')
+
+# Runs of a paragraph, including those wrapped in hyperlinks and inline content controls
+PARAGRAPH_RUNS = etree.XPath(
+    './w:r | ./w:hyperlink/w:r | ./w:sdt/w:sdtContent/w:r | ./w:sdt/w:sdtContent/w:hyperlink/w:r',
+    namespaces=NAMESPACES,
+)
+
+# Containers that must keep at least one paragraph
+PARAGRAPH_REQUIRED = {f'{{{W_NS}}}{tag}' for tag in ('tc', 'txbxContent', 'hdr', 'ftr', 'footnote', 'endnote')}
+
+HEADING_STYLE_NAME = re.compile(r'^(?:heading|titre)\s*(\d)$', re.IGNORECASE)
+
+
+def _w(tag):
+    return f'{{{W_NS}}}{tag}'
+
+
+def _normalize(value):
+    if value is None:
+        return ''
+    return str(value).strip().lower()
+
+
+def _compile_condition(spec, where):
+    """Compile a `when` description into a function payload -> bool."""
+    if spec is None:
+        return lambda payload: True
+    if 'all' in spec:
+        parts = [_compile_condition(item, where) for item in spec['all']]
+        return lambda payload: all(part(payload) for part in parts)
+    if 'any' in spec:
+        parts = [_compile_condition(item, where) for item in spec['any']]
+        return lambda payload: any(part(payload) for part in parts)
+    if 'not' in spec:
+        inner = _compile_condition(spec['not'], where)
+        return lambda payload: not inner(payload)
+
+    field = spec.get('field')
+    if not field:
+        raise ValueError(f"{where}: condition needs a 'field' (or all/any/not)")
+    if 'in' in spec:
+        allowed = {_normalize(item) for item in spec['in']}
+        return lambda payload: _normalize(payload.get(field)) in allowed
+    if 'equals' in spec:
+        expected = spec['equals']
+        return lambda payload: payload.get(field) == expected
+    if spec.get('truthy'):
+        return lambda payload: bool(payload.get(field))
+    if spec.get('falsy'):
+        return lambda payload: not bool(payload.get(field))
+    raise ValueError(f"{where}: condition on '{field}' needs in, equals, truthy or falsy")
+
+
+def _text_pattern(text):
+    # Templates often use non-breaking or doubled spaces inside clauses
+    return r'\s+'.join(re.escape(token) for token in text.split())
+
+
+def compile_rules(specs, name='<inline>'):
+    """Compile a list of rule descriptions. Returns {'rules': [...], 'pattern': regex or None}."""
+    rules = []
+    group_by_text = {}
+    for index, spec in enumerate(specs):
+        where = f"{name}:rules[{index}]"
+        text = ' '.join(str(spec.get('text', '')).split())
+        if not text:
+            raise ValueError(f"{where}: rule needs a 'text'")
+        action = spec.get('action', 'strike')
+        if action not in ACTIONS:
+            raise ValueError(f"{where}: unknown action '{action}', expected one of {ACTIONS}")
+        scope = spec.get('scope', 'paragraph' if action == 'remove' else 'match')
+        if scope not in SCOPES or (action == 'remove' and scope == 'match'):
+            raise ValueError(f"{where}: scope '{scope}' not supported for '{action}'")
+        group = group_by_text.setdefault(text, f'r{len(group_by_text)}')
+        rules.append({
+            'text': text, 'action': action, 'scope': scope, 'group': group,
+            'condition': _compile_condition(spec.get('when'), where),
+        })
+
+    # Longest texts first so a clause containing another one wins at the same position
+    alternatives = [f'(?P<{group}>{_text_pattern(text)})'
+                    for text, group in sorted(group_by_text.items(), key=lambda item: -len(item[0]))]
+    return {
+        'rules': rules,
+        'pattern': re.compile('|'.join(alternatives)) if alternatives else None,
+    }
+
+
+def _run_text(r):
+    return ''.join(t.text or '' for t in r.iter(_w('t')))
+
+
+def _ancestor(element, tag):
+    parent = element.getparent()
+    while parent is not None and parent.tag != tag:
+        parent = parent.getparent()
+    return parent
+
+
+def _body_block(element):
+    """The child of w:body holding `element`, or None outside the document body."""
+    child, parent = element, element.getparent()
+    while parent is not None and parent.tag != _w('body'):
+        child, parent = parent, parent.getparent()
+    return child if parent is not None else None
+
+
+class HeadingLevels:
+    """Outline level of body paragraphs, from their own properties or their style."""
+
+    def __init__(self, styles_element):
+        self._styles = {}
+        if styles_element is None:
+            return
+        for style in styles_element.iter(_w('style')):
+            level = self._outline_level(style.find(_w('pPr')))
+            name = style.find(_w('name'))
+            match = HEADING_STYLE_NAME.match(name.get(_w('val'), '')) if name is not None else None
+            if level is None and match:
+                level = int(match.group(1))
+            if level is not None:
+                self._styles[style.get(_w('styleId'))] = level
+
+    @staticmethod
+    def _outline_level(pPr):
+        outline = pPr.find(_w('outlineLvl')) if pPr is not None else None
+        if outline is None:
+            return None
+        level = int(outline.get(_w('val'), '9')) + 1
+        return level if level <= 9 else None
+
+    def level(self, element):
+        if element.tag != _w('p'):
+            return None
+        pPr = element.find(_w('pPr'))
+        level = self._outline_level(pPr)
+        if level is None and pPr is not None:
+            style = pPr.find(_w('pStyle'))
+            if style is not None:
+                level = self._styles.get(style.get(_w('val')))
+        return level
+
+
+def _section_blocks(block, headings):
+    """`block` and the body blocks after it, up to the next heading of the same or a higher level."""
+    start_level = headings.level(block)
+    blocks = [block]
+    sibling = block.getnext()
+    while sibling is not None and sibling.tag != _w('sectPr'):
+        level = headings.level(sibling)
+        if level is not None and (start_level is None or level <= start_level):
+            break
+        blocks.append(sibling)
+        sibling = sibling.getnext()
+    return blocks
+
+
+def _scope_elements(rule, p, match_runs, headings):
+    """Elements an action applies to: runs for 'match', otherwise container elements."""
+    if rule['scope'] == 'match':
+        return match_runs
+    if rule['scope'] == 'row':
+        row = _ancestor(p, _w('tr'))
+        return [row] if row is not None else [p]
+    if rule['scope'] == 'section':
+        block = _body_block(p)
+        return _section_blocks(block, headings) if block is not None else [p]
+    return [p]
+
+
+def _set_run_property(r, name):
+    from docx.text.run import Run
+
+    font = Run(r, None).font
+    setattr(font, name, True)
+
+
+def _hide_paragraph_mark(p):
+    """Hide the paragraph mark too, so a hidden paragraph leaves no empty line."""
+    from docx.oxml import OxmlElement
+
+    pPr = p.get_or_add_pPr()
+    rPr = pPr.find(_w('rPr'))
+    if rPr is None:
+        rPr = OxmlElement('w:rPr')
+        anchor = pPr.find(_w('sectPr'))
+        if anchor is None:
+            anchor = pPr.find(_w('pPrChange'))
+        if anchor is not None:
+            anchor.addprevious(rPr)
+        else:
+            pPr.append(rPr)
+    rPr._set_bool_val('vanish', True)
+
+
+def _format(elements, action):
+    prop = 'strike' if action == 'strike' else 'hidden'
+    for element in elements:
+        # iter() includes the element itself, so this covers single runs and paragraphs
+        for r in element.iter(_w('r')):
+            _set_run_property(r, prop)
+        if action == 'hide':
+            for p in element.iter(_w('p')):
+                _hide_paragraph_mark(p)
+
+
+def _remove(element):
+    parent = element.getparent()
+    if parent is None:
+        return
+    parent.remove(element)
+
+    if element.tag == _w('tr') and parent.tag == _w('tbl') and parent.find(_w('tr')) is None:
+        # A table without rows is invalid: remove the table too
+        _remove(parent)
+    elif parent.tag in PARAGRAPH_REQUIRED and parent.find(_w('p')) is None and parent.find(_w('tbl')) is None:
+        from docx.oxml import OxmlElement
+
+        parent.append(OxmlElement('w:p'))
+
+
+def active_rules(compiled, payload):
+    """{regex group: [rules]} of the rules whose condition holds for `payload`."""
+    active = {}
+    for rule in compiled['rules']:
+        if rule['condition'](payload):
+            active.setdefault(rule['group'], []).append(rule)
+    return active
+
+
+def apply_rules(compiled, payload, paragraphs, styles_element=None):
+    """Apply the compiled rules whose condition holds for `payload` to `paragraphs` (w:p elements).
+
+    Every paragraph is matched once against the single clause regex. Removals are done after
+    the traversal. Returns a list of (action, scope, text, paragraph text) for logging.
+    """
+    if compiled['pattern'] is None:
+        return []
+    active = active_rules(compiled, payload)
+    if not active:
+        return []
+
+    headings = HeadingLevels(styles_element)
+    applied = []
+    removals = []
+    for p in paragraphs:
+        runs = PARAGRAPH_RUNS(p)
+        texts = [_run_text(r) for r in runs]
+        text = ''.join(texts)
+        if not text:
+            continue
+        for match in compiled['pattern'].finditer(text):
+            rules = active.get(match.lastgroup)
+            if not rules:
+                continue
+            # Runs overlapping the matched span
+            match_runs, offset = [], 0
+            for r, run_text in zip(runs, texts):
+                if offset < match.end() and offset + len(run_text) > match.start():
+                    match_runs.append(r)
+                offset += len(run_text)
+            for rule in rules:
+                elements = _scope_elements(rule, p, match_runs, headings)
+                if rule['action'] == 'remove':
+                    removals.extend(elements)
+                else:
+                    _format(elements, rule['action'])
+                applied.append((rule['action'], rule['scope'], rule['text'], text))
+
+    seen = set()
+    for element in removals:
+        if id(element) not in seen:
+            seen.add(id(element))
+            _remove(element)
+    return applied
@@ -0,0 +1,418 @@
+import base64
+import bisect
+import datetime
+import hashlib
+import html
+import json
+import os
+import re
+import sys
+import zipfile
+
+from lxml import etree
+
+from cache_dirs import CACHE_ROOT, private_cache_dir
+from content_rules import PARAGRAPH_RUNS, HeadingLevels, active_rules
+from placeholder_registry import mapping_for, resolve_placeholders
+
+# Set up logging to a file
+def setup_logging():
+    log_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'logs')
+    os.makedirs(log_dir, exist_ok=True)
+    log_file = os.path.join(log_dir, f'docx_preview_{datetime.datetime.now().strftime("%Y%m%d_%H%M%S")}.log')
+
+    def log_message(message):
+        with open(log_file, 'a', encoding='utf-8') as f:
+            timestamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            f.write(f'[{timestamp}] {message}\n')
+            print(f'[{timestamp}] {message}')
+
+    return log_message
+
+log = setup_logging()
+
+# Preview of a rendered DOCX contract (fiche projet, Web-Design intro) without producing it.
+#
+# A full render loads the template with python-docx, makes several passes, saves and may
+# rewrite the XML. A preview only needs the text and the basic formatting, so each template
+# is parsed once (zipfile + lxml, python-docx is never imported) into a small JSON model:
+# body blocks (paragraphs and tables), header and footer paragraphs, runs with their
+# bold/italic/underline/strike/hidden flags and the heading level of each paragraph. The
+# model is cached in memory and on disk (in a private directory, see cache_dirs), keyed by
+# the SHA-256 of the template, like the XLSX template snapshots. A preview then substitutes the placeholders of the template's mapping
+# and applies its content rules (strike, hide, remove) on a copy of the model and renders it
+# as HTML or text, in memory.
+#
+#   python docx_preview.py <docx_template_path> <shop_data_base64> <output.html|output.txt>
+
+CACHE_DIR = os.environ.get('DOCX_PREVIEW_CACHE_DIR') or os.path.join(CACHE_ROOT, 'docx-preview')
+
+# Bump when the model layout changes, older cache entries are then ignored
+MODEL_VERSION = 1
+
+W_NS = 'http://schemas.openxmlformats.org/wordprocessingml/2006/main'
+STORY_PARTS = {'header': re.compile(r'^word/header\d*\.xml$'), 'footer': re.compile(r'^word/footer\d*\.xml$')}
+
+# Invisible characters the DOCX processor tolerates around a placeholder
+INVISIBLE_CHARACTERS = '\u200b\u200c\u200d\u2060\ufeff\u202f\u00a0\u2009\u200a\u2028\u2029'
+
+# Run children holding text: text, tabs and line breaks
+RUN_TEXT_TAGS = {f'{{{W_NS}}}{tag}' for tag in ('t', 'tab', 'br', 'cr')}
+RUN_FLAGS = {'b': 'bold', 'i': 'italic', 'strike': 'strike', 'dstrike': 'strike', 'vanish': 'hidden'}
+HTML_TAGS = [('bold', 'strong'), ('italic', 'em'), ('underline', 'u'), ('strike', 's')]
+
+_snapshots = {}  # content hash -> model JSON
+_patterns = {}   # mapping name -> placeholder regex
+
+
+def _w(tag):
+    return f'{{{W_NS}}}{tag}'
+
+
+def _on(element):
+    return element is not None and element.get(_w('val'), 'true') not in ('0', 'false', 'off', 'none')
+
+
+def _run(r):
+    text = ''.join(
+        (node.text or '') if node.tag == _w('t') else '\t' if node.tag == _w('tab') else '\n'
+        for node in r if node.tag in RUN_TEXT_TAGS
+    )
+    rPr = r.find(_w('rPr'))
+    run = {'text': text}
+    if rPr is not None:
+        for tag, flag in RUN_FLAGS.items():
+            if _on(rPr.find(_w(tag))):
+                run[flag] = True
+        if _on(rPr.find(_w('u'))):
+            run['underline'] = True
+    return run
+
+
+def _paragraph(p, headings):
+    runs = [run for run in (_run(r) for r in PARAGRAPH_RUNS(p)) if run['text']]
+    return {'level': headings.level(p), 'runs': runs}
+
+
+def _blocks(element, headings):
+    """Model blocks of a body child: a paragraph, a table, or the content of a content control."""
+    if element.tag == _w('p'):
+        yield {'type': 'p', **_paragraph(element, headings)}
+    elif element.tag == _w('tbl'):
+        rows = []
+        for tr in element.findall(_w('tr')):
+            # Nested tables are flattened into the paragraphs of their cell
+            cells = [[_paragraph(p, headings) for p in tc.iter(_w('p'))] for tc in tr.findall(_w('tc'))]
+            rows.append({'cells': cells})
+        yield {'type': 'table', 'rows': rows}
+    elif element.tag == _w('sdt'):
+        content = element.find(_w('sdtContent'))
+        for child in content if content is not None else []:
+            yield from _blocks(child, headings)
+
+
+def parse_template(docx_path):
+    """Preview model of the template at `docx_path`."""
+    with zipfile.ZipFile(docx_path) as archive:
+        names = sorted(archive.namelist())
+        styles = etree.fromstring(archive.read('word/styles.xml')) if 'word/styles.xml' in names else None
+        headings = HeadingLevels(styles)
+        body = etree.fromstring(archive.read('word/document.xml')).find(_w('body'))
+        model = {'blocks': [block for child in body for block in _blocks(child, headings)]}
+        for story, pattern in STORY_PARTS.items():
+            paragraphs = []
+            for name in names:
+                if pattern.match(name):
+                    root = etree.fromstring(archive.read(name))
+                    paragraphs.extend(_paragraph(p, headings) for p in root.iter(_w('p')))
+            model[story] = paragraphs
+    return model
+
+
+def _digest(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def load_model(docx_path):
+    """Return (fresh copy of the template's model, 'memory' | 'disk' | 'parsed')."""
+    digest = _digest(docx_path)
+    snapshot = _snapshots.get(digest)
+    source = 'memory'
+    disk_path = os.path.join(CACHE_DIR, f'{digest}.preview-{MODEL_VERSION}.json')
+    if snapshot is None:
+        # Only a directory private to this user is trusted, otherwise the model is parsed
+        disk_usable = private_cache_dir(CACHE_DIR)
+        source = 'disk'
+        if disk_usable:
+            try:
+                with open(disk_path, 'r', encoding='utf-8') as f:
+                    snapshot = f.read()
+            except OSError:
+                pass
+        if snapshot is None:
+            snapshot = json.dumps(parse_template(docx_path), ensure_ascii=False)
+            source = 'parsed'
+        if source == 'parsed' and disk_usable:
+            try:
+                temp_path = f'{disk_path}.{os.getpid()}.part'
+                with open(temp_path, 'w', encoding='utf-8') as f:
+                    f.write(snapshot)
+                os.replace(temp_path, disk_path)
+            except OSError:
+                # The disk cache is an optimization only
+                pass
+        _snapshots[digest] = snapshot
+    # Every preview edits its own copy
+    return json.loads(snapshot), source
+
+
+def _iter_paragraphs(model):
+    """(paragraph, body block index or None, table row or None) for every paragraph of the model."""
+    for index, block in enumerate(model['blocks']):
+        if block['type'] == 'p':
+            yield block, index, None
+        else:
+            for row in block['rows']:
+                for cell in row['cells']:
+                    for paragraph in cell:
+                        yield paragraph, index, row
+    for story in STORY_PARTS:
+        for paragraph in model[story]:
+            yield paragraph, None, None
+
+
+def _placeholder_pattern(mapping):
+    pattern = _patterns.get(mapping['name'])
+    if pattern is None:
+        # Longest placeholders first, so XXX10 is not read as XXX1 followed by 0
+        keys = sorted((key for key, _ in mapping['placeholders']), key=len, reverse=True)
+        invisible = f'[{INVISIBLE_CHARACTERS}]*'
+        pattern = re.compile(f"{invisible}({'|'.join(re.escape(key) for key in keys)}){invisible}") if keys else None
+        _patterns[mapping['name']] = pattern
+    return pattern
+
+
+def _substitute(paragraph, pattern, values):
+    """Replace the placeholders of a paragraph, even split over several runs. The value takes
+    the formatting of the run where the placeholder starts. Returns the number of replacements."""
+    runs = paragraph['runs']
+    text = ''.join(run['text'] for run in runs)
+    matches = list(pattern.finditer(text)) if text else []
+    if not matches:
+        return 0
+
+    starts, offset = [], 0
+    for run in runs:
+        starts.append(offset)
+        offset += len(run['text'])
+    pieces = [[] for _ in runs]
+
+    def copy(start, end):
+        while start < end:
+            index = bisect.bisect_right(starts, start) - 1
+            stop = min(end, starts[index] + len(runs[index]['text']))
+            pieces[index].append(text[start:stop])
+            start = stop
+
+    position = 0
+    for match in matches:
+        copy(position, match.start())
+        pieces[bisect.bisect_right(starts, match.start()) - 1].append(values[match.group(1)])
+        position = match.end()
+    copy(position, len(text))
+
+    for run, piece in zip(runs, pieces):
+        run['text'] = ''.join(piece)
+    paragraph['runs'] = [run for run in runs if run['text']]
+    return len(matches)
+
+
+def _section(model, index):
+    """Indexes of body block `index` and the blocks after it, up to the next heading of the same
+    or a higher level (see content_rules)."""
+    blocks = model['blocks']
+    start_level = blocks[index].get('level')
+    section = [index]
+    for next_index in range(index + 1, len(blocks)):
+        level = blocks[next_index].get('level')
+        if level is not None and (start_level is None or level <= start_level):
+            break
+        section.append(next_index)
+    return section
+
+
+def _block_paragraphs(block):
+    if block['type'] == 'p':
+        return [block]
+    return [paragraph for row in block['rows'] for cell in row['cells'] for paragraph in cell]
+
+
+def _apply_rules(model, compiled, payload):
+    """Strike, hide or remove content in the model, as content_rules.apply_rules does in the document."""
+    if compiled['pattern'] is None:
+        return []
+    active = active_rules(compiled, payload)
+    if not active:
+        return []
+    applied = []
+    for paragraph, block_index, row in list(_iter_paragraphs(model)):
+        text = ''.join(run['text'] for run in paragraph['runs'])
+        if not text:
+            continue
+        for match in compiled['pattern'].finditer(text):
+            rules = active.get(match.lastgroup)
+            if not rules:
+                continue
+            for rule in rules:
+                scope = rule['scope']
+                if scope == 'match':
+                    runs, offset = [], 0
+                    for run in paragraph['runs']:
+                        if offset < match.end() and offset + len(run['text']) > match.start():
+                            runs.append(run)
+                        offset += len(run['text'])
+                    targets = []
+                elif scope == 'row' and row is not None:
+                    targets = [row]
+                elif scope == 'section' and block_index is not None:
+                    targets = [model['blocks'][index] for index in _section(model, block_index)]
+                else:
+                    targets = [paragraph]
+
+                if rule['action'] == 'remove':
+                    for target in targets:
+                        target['removed'] = True
+                    continue
+                if scope != 'match':
+                    runs = []
+                    for target in targets:
+                        paragraphs = ([p for cell in target['cells'] for p in cell] if 'cells' in target
+                                      else _block_paragraphs(target) if 'type' in target else [target])
+                        for p in paragraphs:
+                            runs.extend(p['runs'])
+                            if rule['action'] == 'hide':
+                                p['hidden'] = True
+                for run in runs:
+                    run['strike' if rule['action'] == 'strike' else 'hidden'] = True
+                applied.append((rule['action'], scope, rule['text'], text))
+    return applied
+
+
+def _visible(paragraph):
+    return not paragraph.get('removed') and not paragraph.get('hidden')
+
+
+def _paragraph_html(paragraph):
+    parts = []
+    for run in paragraph['runs']:
+        if run.get('hidden'):
+            continue
+        piece = html.escape(run['text']).replace('\n', '<br>')
+        for flag, tag in HTML_TAGS:
+            if run.get(flag):
+                piece = f'<{tag}>{piece}</{tag}>'
+        parts.append(piece)
+    level = paragraph.get('level')
+    tag = f'h{level}' if level and level <= 6 else 'p'
+    return f"<{tag}>{''.join(parts)}</{tag}>"
+
+
+def _paragraph_text(paragraph):
+    parts = []
+    for run in paragraph['runs']:
+        if run.get('hidden'):
+            continue
+        # Struck clauses stay readable in the text preview
+        parts.append(f"~~{run['text']}~~" if run.get('strike') else run['text'])
+    return ''.join(parts)
+
+
+def render_html(model):
+    lines = ['<div class="docx-preview">']
+    lines.extend(f'<header>{_paragraph_html(p)}</header>' for p in model['header'] if _visible(p) and p['runs'])
+    for block in model['blocks']:
+        if block.get('removed'):
+            continue
+        if block['type'] == 'p':
+            if _visible(block):
+                lines.append(_paragraph_html(block))
+            continue
+        rows = [row for row in block['rows'] if not row.get('removed')]
+        if not rows:
+            continue
+        lines.append('<table>')
+        for row in rows:
+            cells = ''.join(
+                f"<td>{''.join(_paragraph_html(p) for p in cell if _visible(p))}</td>" for cell in row['cells'])
+            lines.append(f'<tr>{cells}</tr>')
+        lines.append('</table>')
+    lines.extend(f'<footer>{_paragraph_html(p)}</footer>' for p in model['footer'] if _visible(p) and p['runs'])
+    lines.append('</div>')
+    return '\n'.join(lines) + '\n'
+
+
+def render_text(model):
+    lines = [_paragraph_text(p) for p in model['header'] if _visible(p)]
+    for block in model['blocks']:
+        if block.get('removed'):
+            continue
+        if block['type'] == 'p':
+            if _visible(block):
+                lines.append(_paragraph_text(block))
+            continue
+        for row in block['rows']:
+            if not row.get('removed'):
+                lines.append(' | '.join(
+                    ' '.join(_paragraph_text(p) for p in cell if _visible(p)) for cell in row['cells']))
+    lines.extend(_paragraph_text(p) for p in model['footer'] if _visible(p))
+    return '\n'.join(lines) + '\n'
+
+
+def preview_docx(docx_path, shop_data, output_format='html'):
+    """Return (preview as HTML or text, statistics) for `docx_path` rendered with `shop_data`."""
+    if not isinstance(shop_data, dict):
+        raise ValueError(f"shop_data is not a dictionary. Type: {type(shop_data)}")
+    if output_format not in ('html', 'text'):
+        raise ValueError(f"Unknown preview format '{output_format}', expected 'html' or 'text'")
+
+    model, source = load_model(docx_path)
+    mapping = mapping_for(docx_path, 'docx')
+    values = resolve_placeholders(mapping, shop_data)
+
+    replacements = 0
+    pattern = _placeholder_pattern(mapping)
+    if pattern is not None:
+        for paragraph, _, _ in _iter_paragraphs(model):
+            replacements += _substitute(paragraph, pattern, values)
+    applied = _apply_rules(model, mapping['rules'], shop_data)
+
+    rendered = render_html(model) if output_format == 'html' else render_text(model)
+    return rendered, {'model': source, 'replacements': replacements, 'rules': applied}
+
+
+if __name__ == "__main__":
+    try:
+        if len(sys.argv) != 4:
+            error_msg = "Usage: python docx_preview.py <docx_template_path> <shop_data_json_string> <output.html|output.txt>"
+            log(error_msg)
+            print(error_msg, file=sys.stderr)
+            sys.exit(1)
+
+        template_path, encoded_shop_data_string, output_path = sys.argv[1:4]
+        shop_data = json.loads(base64.b64decode(encoded_shop_data_string).decode('utf-8'))
+        output_format = 'text' if output_path.endswith('.txt') else 'html'
+
+        rendered, stats = preview_docx(template_path, shop_data, output_format)
+        with open(output_path, 'w', encoding='utf-8') as f:
+            f.write(rendered)
+        log(f"Preview of {template_path} written to {output_path} ({output_format}): model from {stats['model']}, "
+            f"{stats['replacements']} placeholder(s) replaced, {len(stats['rules'])} rule(s) applied")
+    except Exception as e:
+        error_msg = f"Fatal error: {str(e)}"
+        log(error_msg)
+        print(error_msg, file=sys.stderr)
+        sys.exit(1)
@@ -2,15 +2,22 @@ from docx import Document
 from docx.shared import Inches
 from docx.enum.text import WD_ALIGN_PARAGRAPH
 from docx.enum.style import WD_STYLE_TYPE
+from docx.opc.constants import RELATIONSHIP_TYPE as RT
+from docx.text.paragraph import Paragraph
+from docx.text.run import Run
 import json
 import sys
 import os
 import base64
 import datetime
-import tempfile
 import zipfile
 import re
-import shutil
+
+from archive_writer import save_docx, rewrite_archive, format_save_stats, file_digest, format_render_digest
+from content_rules import apply_rules
+from placeholder_registry import mapping_for, resolve_placeholders
+from render_engines import choose_engine, format_engine, measure_template
+from render_progress import RenderCancelled, abort, finish, phase, start_job
 
 # Set up logging to a file
 def setup_logging():
@@ -34,6 +41,7 @@ def replace_placeholders_and_format(docx_path, shop_data, output_path):
     log(f"Output will be saved to: {output_path}")
     
     try:
+        phase('load')
         document = Document(docx_path)
         log(f"Successfully loaded document: {docx_path}")
     except Exception as e:
@@ -41,14 +49,18 @@ def replace_placeholders_and_format(docx_path, shop_data, output_path):
         raise
 
     log(f"[DEBUG - Inside replace_placeholders_and_format] Type of shop_data: {type(shop_data)}")
-    log(f"[DEBUG - Inside replace_placeholders_and_format] Content of shop_data: {shop_data}")
     
     # Ensure shop_data is a dictionary
     if not isinstance(shop_data, dict):
-        error_msg = f"[ERROR] shop_data is not a dictionary. Type: {type(shop_data)}, Value: {shop_data}"
+        error_msg = f"[ERROR] shop_data is not a dictionary. Type: {type(shop_data)}"
         log(error_msg)
         raise ValueError(error_msg)
 
+    # Documents only have the object engine, logged like the other processors (see render_engines)
+    measurements = measure_template(docx_path)
+    engine, reason = choose_engine('docx', shop_data.get('renderEngine'), measurements)
+    log(format_engine(engine, reason, measurements))
+
     # Define the mapping from XXXn to shop_data keys
     # Values are now pre-formatted from the backend
     
@@ -85,56 +97,39 @@ def replace_placeholders_and_format(docx_path, shop_data, output_path):
         
         return text
     
-    placeholder_mapping = {
-        "XXX1": shop_data.get("nomProjet", ""),  # XXX1: nomProjet
-        "XXX2": shop_data.get("typeProjet", ""),  # XXX2: typeProjet
-        "XXX3": shop_data.get("commercial", ""),  # XXX3: commercial (salesperson)
-        "XXX4": shop_data.get("nomClient", ""),  # XXX4: nomClient (customer raisonSociale)
-        "XXX5": shop_data.get("compteClientRef", ""),  # XXX5: compteClientRef (customer CompteClientNumber)
-        "XXX7": shop_data.get("dateMiseEnLigne", ""),  # XXX7: dateMiseEnLigne (if available)
-        "XXX8": shop_data.get("dateCommercialisation", ""),  # XXX8: dateCommercialisation (YYYY/MM/DD)
-        "XXX9": shop_data.get("dateSortieOfficielle", ""),  # XXX9: dateSortieOfficielle (YYYY/MM/DD)
-        "XXX10": shop_data.get("precommande", ""),  # XXX10: precommande (OUI/NON)
-        "XXX11": shop_data.get("dedicaceEnvisagee", ""),  # XXX11: dedicaceEnvisagee (OUI/NON)
-        "XXX12": shop_data.get("estBoutiqueEnLigne", ""),  # XXX12: estBoutiqueEnLigne (OUI/NON)
-        "XXX13": shop_data.get("chefProjet", ""),  # XXX13: prenomChefProjet + ' ' + nomChefProjet
-        "XXX14": shop_data.get("demarrageProjet", ""),  # XXX14: demarrageProjet (YYYY/MM/DD)
-        "XXX15": shop_data.get("contactsClient", ""),  # XXX15: contactsClient (client email)
-        "XXX69": shop_data.get("pourcentageSNA", ""),  # XXX69: pourcentageSNA value
-        "COMPTENUM": shop_data.get("compteClientRef", ""),  # COMPTENUM: customer CompteClientNumber
-    }
-
-    # -------------------------------------------------------------
-    # Dynamic strikethrough rules for Contract-D2C cost lines
-    # -------------------------------------------------------------
-    type_ab = str(shop_data.get("typeAbonnementShopify", "")).strip().lower()
-    strike_mensuel = type_ab in ("", "aucun", "annuel")  # cross out mensuel when not chosen or when annual chosen
-    strike_annuel  = type_ab in ("", "aucun", "mensuel") # cross out annuel when not chosen or when monthly chosen
-
-    strike_mondial_relay = not bool(shop_data.get("moduleMondialRelay", False))
-    strike_delivengo     = not bool(shop_data.get("moduleDelivengo", False))
-
-    contract_d2c_strikethrough_rules = [
-        {"text": "Abonnement SHOPIFY mensuel sans engagement = 88€", "strike": strike_mensuel},
-        {"text": "Abonnement SHOPIFY 12 mois = 948€", "strike": strike_annuel},
-        {"text": "Les coûts pour ajouter le module Mondial Relay = 34€", "strike": strike_mondial_relay},
-        {"text": "Les coûts pour ajouter le module Delivengo = 34€", "strike": strike_delivengo},
+    # Placeholder values come from the template's mapping file (placeholder_maps/)
+    docx_mapping = mapping_for(docx_path, 'docx')
+    placeholder_mapping = resolve_placeholders(docx_mapping, shop_data)
+
+    # Paragraphs living outside the body flow: headers, footers and text boxes
+    story_paragraphs = list(iter_story_paragraphs(document))
+    log(f"Found {len(story_paragraphs)} paragraphs in headers, footers and text boxes")
+
+    # Table paragraphs, walked once over w:tbl/w:tr/w:tc: each physical cell (merged or not)
+    # is visited a single time and nested tables are included
+    body_tables = [
+        (tbl, list(iter_table_paragraphs(tbl, document.part)))
+        for tbl in iter_tables(document.element.body)
     ]
+    log(f"Found {len(body_tables)} tables with {sum(len(paras) for _, paras in body_tables)} paragraphs")
 
+    phase('render')
     # First pass: Replace all placeholders in all runs globally
     log("Starting global placeholder replacement...")
     all_runs = []
     
     # Collect all runs from paragraphs
     for paragraph in document.paragraphs:
-        all_runs.extend(paragraph.runs)
+        all_runs.extend(paragraph_runs(paragraph))
+
+    # Collect all runs from headers, footers and text boxes
+    for paragraph in story_paragraphs:
+        all_runs.extend(paragraph_runs(paragraph))
     
     # Collect all runs from tables
-    for table in document.tables:
-        for row in table.rows:
-            for cell in row.cells:
-                for paragraph in cell.paragraphs:
-                    all_runs.extend(paragraph.runs)
+    for _, table_paragraphs in body_tables:
+        for paragraph in table_paragraphs:
+            all_runs.extend(paragraph_runs(paragraph))
     
     # Replace placeholders in all runs
     total_runs = len(all_runs)
@@ -161,6 +156,11 @@ def replace_placeholders_and_format(docx_path, shop_data, output_path):
         
         log(f"Total replacements made for {key}: {replacements_made}")
     
+    # Paragraphs the next passes rebuild into a single run (their run formatting is lost),
+    # as (location, placeholder): a template where every placeholder is alone in its own run
+    # needs none (see template_normalizer)
+    rebuilt_paragraphs = []
+
     # Additional method: try replacing across paragraph text directly
     log("Attempting direct paragraph text replacement...")
     for paragraph in document.paragraphs:
@@ -176,65 +176,133 @@ def replace_placeholders_and_format(docx_path, shop_data, output_path):
                         for run in paragraph.runs:
                             run.clear()
                         paragraph.runs[0].text = new_para_text
+                        rebuilt_paragraphs.append(('body', key))
                         log(f"✅ Replaced in paragraph: '{original_para_text}' → '{new_para_text}'")
     
+    # Same paragraph-level replacement for headers, footers and text boxes
+    log("Attempting header/footer/text box paragraph replacement...")
+    for paragraph in story_paragraphs:
+        if paragraph.text:
+            original_para_text = paragraph.text
+            for key, value in placeholder_mapping.items():
+                if key in original_para_text or key in clean_text_for_replacement(original_para_text):
+                    log(f"Found {key} in header/footer/text box: '{original_para_text}'")
+                    new_para_text = replace_placeholder_with_unicode_handling(original_para_text, key, str(value))
+                    if new_para_text != original_para_text:
+                        for run in paragraph.runs:
+                            run.clear()
+                        if paragraph.runs:
+                            paragraph.runs[0].text = new_para_text
+                        else:
+                            paragraph.add_run(new_para_text)
+                        rebuilt_paragraphs.append(('header/footer/text box', key))
+                        log(f"✅ Replaced in header/footer/text box: '{original_para_text}' → '{new_para_text}'")
+                        original_para_text = new_para_text
+    
     # Additional method: try replacing in table cells directly
     log("Attempting direct table cell text replacement...")
-    for table in document.tables:
-        for row in table.rows:
-            for cell in row.cells:
-                for paragraph in cell.paragraphs:
-                    if paragraph.text:
-                        original_para_text = paragraph.text
-                        for key, value in placeholder_mapping.items():
-                            if key in original_para_text or key in clean_text_for_replacement(original_para_text):
-                                log(f"Found {key} in table cell: '{original_para_text}'")
-                                # Try to replace by reconstructing the paragraph
-                                new_para_text = replace_placeholder_with_unicode_handling(original_para_text, key, str(value))
-                                if new_para_text != original_para_text:
-                                    # Clear existing runs and create new one
-                                    for run in paragraph.runs:
-                                        run.clear()
-                                    if paragraph.runs:
-                                        paragraph.runs[0].text = new_para_text
-                                    else:
-                                        paragraph.add_run(new_para_text)
-                                    log(f"✅ Replaced in table cell: '{original_para_text}' → '{new_para_text}'")
-        
-        # Strikethrough application
-        for rule in contract_d2c_strikethrough_rules:
-            contract_text = rule["text"]
-            strike = rule["strike"]
-
-            if strike and contract_text in paragraph.text:
-                for run in paragraph.runs:
-                    if contract_text in run.text:
-                        run.font.strike = True
-    
-    # Second pass: Apply strikethrough to contract D2C items in tables (if applicable)
-    log("Starting strikethrough application...")
-    for table in document.tables:
-        for row in table.rows:
-            for cell in row.cells:
-                for paragraph in cell.paragraphs:
-                    
-                    # Strikethrough application in table cells
-                    for rule in contract_d2c_strikethrough_rules:
-                        contract_text = rule["text"]
-                        strike = rule["strike"]
-
-                        if strike and contract_text in paragraph.text:
+    for _, table_paragraphs in body_tables:
+        for paragraph in table_paragraphs:
+            if paragraph.text:
+                original_para_text = paragraph.text
+                for key, value in placeholder_mapping.items():
+                    if key in original_para_text or key in clean_text_for_replacement(original_para_text):
+                        log(f"Found {key} in table cell: '{original_para_text}'")
+                        # Try to replace by reconstructing the paragraph
+                        new_para_text = replace_placeholder_with_unicode_handling(original_para_text, key, str(value))
+                        if new_para_text != original_para_text:
+                            # Clear existing runs and create new one
                             for run in paragraph.runs:
-                                if contract_text in run.text:
-                                    run.font.strike = True
+                                run.clear()
+                            if paragraph.runs:
+                                paragraph.runs[0].text = new_para_text
+                            else:
+                                paragraph.add_run(new_para_text)
+                            rebuilt_paragraphs.append(('table cell', key))
+                            log(f"✅ Replaced in table cell: '{original_para_text}' → '{new_para_text}'")
+    
+    phase('rules')
+    # Second pass: conditional content (contract clauses struck, hidden or removed depending on
+    # the payload), one traversal of every paragraph (see content_rules and the template's mapping)
+    log("Applying conditional content rules...")
+    rule_paragraphs = [paragraph._p for paragraph in document.paragraphs]
+    rule_paragraphs.extend(paragraph._p for _, table_paragraphs in body_tables for paragraph in table_paragraphs)
+    rule_paragraphs.extend(paragraph._p for paragraph in story_paragraphs)
+    applied_rules = apply_rules(docx_mapping['rules'], shop_data, rule_paragraphs, document.styles.element)
+    for action, scope, text, paragraph_text in applied_rules:
+        log(f"Rule applied: {action} ({scope}) '{text}' in '{paragraph_text}'")
+    log(f"Conditional content rules applied: {len(applied_rules)}")
 
-    document.save(output_path)
+    save_profile = shop_data.get("saveProfile")
+    phase('save')
+    save_stats = save_docx(document, output_path, save_profile, source_path=docx_path)
     print(f"Document saved to {output_path}")
+    log(f"Document saved: {format_save_stats(save_stats)}")
 
-    # Perform XML-level replacement for any placeholders still not caught
-    xml_level_replace(output_path, placeholder_mapping)
+    # Only fall back to the XML-level rewrite for the parts that still contain placeholders
+    leftover_parts = find_parts_with_placeholders(output_path, placeholder_mapping)
+    if leftover_parts:
+        log(f"Placeholders left after structured pass: {leftover_parts}")
+        fallback_parts = xml_level_replace(output_path, placeholder_mapping, parts=leftover_parts, profile=save_profile)
+    else:
+        log("No placeholders left after structured pass, skipping XML-level replacement")
+        fallback_parts = []
 
+    log(f"Paragraphs rebuilt: {len(rebuilt_paragraphs)}, XML fallback parts: {fallback_parts}")
+
+    # Digest of the final file (the XML fallback rewrites it)
+    sha256 = file_digest(output_path) if fallback_parts else save_stats['sha256']
+    log(format_render_digest(output_path, sha256))
     log("Document processing completed successfully")
+    return {"xml_fallback_parts": fallback_parts, "rebuilt_paragraphs": rebuilt_paragraphs, "sha256": sha256}
+
+
+def paragraph_runs(paragraph):
+    """Return the runs of a paragraph, including those wrapped in hyperlinks and inline content
+    controls (`paragraph.runs` only returns direct children)."""
+    run_elements = paragraph._p.xpath(
+        './w:r | ./w:hyperlink/w:r | ./w:sdt/w:sdtContent/w:r | ./w:sdt/w:sdtContent/w:hyperlink/w:r'
+    )
+    return [Run(r, paragraph) for r in run_elements]
+
+
+def iter_story_paragraphs(document):
+    """Yield the paragraphs of headers, footers and text boxes, which `document.paragraphs`
+    and `document.tables` do not reach."""
+    # Text boxes anchored in the body (each paragraph once, even if nested)
+    for p in document.element.body.xpath('.//w:txbxContent//w:p'):
+        yield Paragraph(p, document.part)
+
+    # Header and footer parts, each one once no matter how many sections reference it
+    for rel in document.part.rels.values():
+        if rel.is_external or rel.reltype not in (RT.HEADER, RT.FOOTER):
+            continue
+        part = rel.target_part
+        for p in part.element.xpath('.//w:p'):
+            yield Paragraph(p, part)
+
+def iter_tables(container):
+    """Return the w:tbl elements directly under `container`, including those wrapped in content controls."""
+    return container.xpath('./w:tbl | ./w:sdt/w:sdtContent/w:tbl')
+
+
+def iter_table_cells(tbl):
+    """Yield every physical w:tc of `tbl` exactly once, in document order, then the cells of its nested tables.
+
+    Unlike `row.cells`, this does not rebuild the layout grid for each row and does not return a
+    merged cell once per grid column it spans.
+    """
+    for tc in tbl.xpath('./w:tr/w:tc | ./w:tr/w:sdt/w:sdtContent/w:tc | ./w:sdt/w:sdtContent/w:tr/w:tc'):
+        yield tc
+        for nested in iter_tables(tc):
+            yield from iter_table_cells(nested)
+
+
+def iter_table_paragraphs(tbl, part):
+    """Yield the paragraphs of every cell of `tbl` (nested tables included), each one once."""
+    for tc in iter_table_cells(tbl):
+        for p in tc.xpath('./w:p | ./w:sdt/w:sdtContent/w:p'):
+            yield Paragraph(p, part)
 
 def build_cross_tag_pattern(placeholder: str) -> str:
     """Return a regex that matches the placeholder even if arbitrary XML tags or zero-width characters are interleaved
@@ -246,33 +314,66 @@ def build_cross_tag_pattern(placeholder: str) -> str:
     return gap.join(escaped_chars)
 
 
-def xml_level_replace(docx_path: str, mapping: dict):
-    """Open an existing DOCX file and replace placeholders at the raw XML level using robust regexes."""
+# Characters the XML fallback tolerates between the characters of a placeholder
+PLACEHOLDER_GAP_CHARS = re.compile(r"[\s\u200b\u200c\u200d\u2060\ufeff\u202f\u00a0\u2009\u200a\u2028\u2029]+")
+XML_TAG = re.compile(r"<[^>]+>")
+
+
+def find_parts_with_placeholders(docx_path: str, mapping: dict) -> dict:
+    """Cheaply check every XML part for placeholder fragments the structured pass missed.
+
+    Tags and invisible characters are stripped from each part before searching, so a placeholder
+    split across runs is still detected. Returns {part name: [placeholders found]}.
+    """
+    keys = sorted(mapping.keys(), key=len, reverse=True)
+    if not keys:
+        return {}
+    pattern = re.compile("|".join(re.escape(key) for key in keys))
+    leftovers = {}
+    with zipfile.ZipFile(docx_path, 'r') as zin:
+        for item in zin.infolist():
+            if not item.filename.endswith('.xml'):
+                continue
+            xml_str = zin.read(item.filename).decode('utf-8', errors='ignore')
+            text = PLACEHOLDER_GAP_CHARS.sub('', XML_TAG.sub('', xml_str))
+            found = sorted(set(pattern.findall(text)))
+            if found:
+                leftovers[item.filename] = found
+    return leftovers
+
+
+def xml_level_replace(docx_path: str, mapping: dict, parts=None, profile=None):
+    """Open an existing DOCX file and replace placeholders at the raw XML level using robust regexes.
+
+    When `parts` is given only those XML parts are searched. Only the modified parts are
+    recompressed, every other member keeps its compressed bytes. Returns the names of the
+    parts where at least one replacement was made.
+    """
+    replacements = {}
     try:
         with zipfile.ZipFile(docx_path, 'r') as zin:
-            # Copy all original entries but potentially modified XML files into a new zip
-            with tempfile.NamedTemporaryFile(delete=False, suffix='.docx') as temp_fp:
-                temp_path = temp_fp.name
-            with zipfile.ZipFile(temp_path, 'w', zipfile.ZIP_DEFLATED) as zout:
-                for item in zin.infolist():
-                    data = zin.read(item.filename)
-                    if item.filename.endswith('.xml'):
-                        xml_str = data.decode('utf-8', errors='ignore')
-                        original_xml = xml_str
-                        # Replace longer placeholders first to avoid partial matches (e.g. XXX1 inside XXX12)
-                        for key in sorted(mapping.keys(), key=len, reverse=True):
-                            value = mapping[key]
-                            pattern = build_cross_tag_pattern(key)
-                            xml_str, subs = re.subn(pattern, str(value), xml_str)
-                            if subs:
-                                log(f"[XML] Replaced {key} -> '{value}' ({subs} occurrence(s)) in {item.filename}")
-                        data = xml_str.encode('utf-8')
-                    zout.writestr(item, data)
-        # Replace original file with the updated one
-        shutil.move(temp_path, docx_path)
+            for item in zin.infolist():
+                if not item.filename.endswith('.xml') or (parts is not None and item.filename not in parts):
+                    continue
+                xml_str = zin.read(item.filename).decode('utf-8', errors='ignore')
+                original_xml = xml_str
+                # Replace longer placeholders first to avoid partial matches (e.g. XXX1 inside XXX12)
+                for key in sorted(mapping.keys(), key=len, reverse=True):
+                    value = mapping[key]
+                    pattern = build_cross_tag_pattern(key)
+                    xml_str, subs = re.subn(pattern, str(value), xml_str)
+                    if subs:
+                        log(f"[XML] Replaced {key} -> '{value}' ({subs} occurrence(s)) in {item.filename}")
+                if xml_str != original_xml:
+                    replacements[item.filename] = xml_str.encode('utf-8')
+        if replacements:
+            save_stats = rewrite_archive(docx_path, docx_path, replacements, profile)
+            log(f"[XML] Archive rewritten: {format_save_stats(save_stats)}")
         log("XML-level placeholder replacement completed.")
     except Exception as e:
         log(f"[XML] Error during XML-level replacement: {e}")
+        return []
+    return list(replacements)
 
 if __name__ == "__main__":
     try:
@@ -299,7 +400,6 @@ if __name__ == "__main__":
             log("Successfully decoded base64 data")
             
             log(f"[DEBUG] Type of shop_data_string after decode: {type(shop_data_string)}")
-            log(f"[DEBUG] First 100 chars of shop_data_string: {shop_data_string[:100]}...")
 
             # Parse the JSON string
             log("Parsing JSON data...")
@@ -311,9 +411,15 @@ if __name__ == "__main__":
 
             # Process the document
             log("Starting document processing...")
+            start_job('docx_processor', [output_path])
             replace_placeholders_and_format(template_path, shop_data, output_path)
             log("Document processing completed successfully")
+            finish(output_path)
             
+        except RenderCancelled as e:
+            # Cancel request or deadline: outputs removed, see render_progress
+            log(f"Processing cancelled: {str(e)}")
+            sys.exit(abort(e))
         except Exception as e:
             error_msg = f"Error processing document: {str(e)}"
             log(error_msg)
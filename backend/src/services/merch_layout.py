@@ -0,0 +1,128 @@
+from product_fields import SIZES, calculate_total_stock, calculate_size_stock
+
+# Layout of the FICHES.PRODUITS_SHOPIFY workbooks, shared by merch_xlsx_processor (writer)
+# and merch_workbook_reader (streaming reader).
+
+# Header cells are searched in the first columns only
+HEADER_SCAN_COLUMNS = 14
+
+# A row with at least this many size labels is the size header row
+MIN_SIZE_HEADERS = 3
+
+# Fallback start row when no header is found
+DEFAULT_DATA_START_ROW = 6
+
+# Product row columns, as written by process_merch_xlsx (A=1 ... U=21)
+PRODUCT_COLUMNS = [
+    'typeProduit',        # A: Type de produit
+    'titre',              # B: Titre
+    'description',        # C: Description
+    'codeEAN',            # D: Code EAN
+    'stockTotal',         # E: Quantités totales
+    'stock_XS',           # F
+    'stock_S',            # G
+    'stock_M',            # H
+    'stock_L',            # I
+    'stock_XL',           # J
+    'poids',              # K: Poids
+    'prix',               # L: Prix TTC
+    'occ',                # M: OCC (OUI/NON)
+    'dateSortie',         # N: Date de sortie/commercialisation (DD/MM/YYYY)
+    None,                 # O
+    'pod',                # P: POD (OUI/NON)
+    None,                 # Q
+    None,                 # R
+    'couleurs',           # S: Couleurs
+    'tailles',            # T: Tailles
+    'visuels',            # U: Visuels
+]
+
+
+def product_row_values(fields, column_n_date):
+    """Values of one product row (columns A..U) and the product's total stock.
+
+    `fields` comes from product_fields.extract_product_fields(). Used by the serial writer
+    and by the sharded row renderer, so both write exactly the same cells.
+    """
+    stock = fields['stock']
+    total_stock = calculate_total_stock(stock)
+    size_stocks = {size: calculate_size_stock(stock, size) for size in SIZES}
+    pod_status = 'OUI' if fields['type_produit'].upper() == 'POD' else 'NON'
+    row_data = [
+        fields['type_produit'],
+        fields['titre'],
+        fields['description'],
+        fields['code_ean'],
+        total_stock,
+        *(size_stocks[size] for size in SIZES),
+        fields['poids'],
+        fields['prix'],
+        'OUI' if fields['occ'] else 'NON',
+        column_n_date,
+        '',
+        pod_status,
+        '',
+        '',
+        fields['couleurs_str'],
+        fields['tailles_str'],
+        '',  # Visuels: always left empty, never the S3 URLs
+    ]
+    return row_data, total_stock
+
+
+def is_product_sheet(title, layout, selection=None):
+    """Whether the sheet `title` (laid out as `layout`) gets product rows for the payload option
+    `productSheets`: empty or 'all' (every sheet, as always), 'auto' (the sheets with a size
+    header row) or a list of sheet titles."""
+    if selection in (None, '', 'all'):
+        return True
+    if selection == 'auto':
+        return layout['size_header_row'] is not None
+    return title in selection
+
+
+def detect_data_start_row(rows):
+    """Find where product rows start, reading `rows` (an iterable of (row number, values)) once.
+
+    Same rules, in the same order of priority, as the merch workbook has always used:
+    1. the row after the first row holding at least 3 size labels (XS, S, M, L, XL),
+    2. 3 rows after the first row whose column A contains "TYPE DE PRODUIT",
+    3. 3 rows after the first row whose column A contains "TYPE",
+    4. row 6.
+    Stops reading as soon as rule 1 matches. Returns a dict with data_start_row,
+    size_header_row, size_positions and reason.
+    """
+    type_de_produit_row = None
+    type_row = None
+
+    for row_num, values in rows:
+        found_sizes = 0
+        size_positions = {}
+        for col_num, value in enumerate(values[:HEADER_SCAN_COLUMNS], 1):
+            if value and isinstance(value, str) and value.strip().upper() in SIZES:
+                found_sizes += 1
+                size_positions[value.strip().upper()] = col_num
+        if found_sizes >= MIN_SIZE_HEADERS:
+            return {
+                'data_start_row': row_num + 1,
+                'size_header_row': row_num,
+                'size_positions': size_positions,
+                'reason': f"size header row at row {row_num}",
+            }
+
+        first = values[0] if values else None
+        if first and isinstance(first, str):
+            upper = first.upper()
+            if type_de_produit_row is None and "TYPE DE PRODUIT" in upper:
+                type_de_produit_row = row_num
+            if type_row is None and "TYPE" in upper:
+                type_row = row_num
+
+    if type_de_produit_row is not None:
+        return {'data_start_row': type_de_produit_row + 3, 'size_header_row': None, 'size_positions': {},
+                'reason': f"'TYPE DE PRODUIT' at row {type_de_produit_row}, with buffer"}
+    if type_row is not None:
+        return {'data_start_row': type_row + 3, 'size_header_row': None, 'size_positions': {},
+                'reason': f"header row with 'TYPE' at row {type_row}, with buffer"}
+    return {'data_start_row': DEFAULT_DATA_START_ROW, 'size_header_row': None, 'size_positions': {},
+            'reason': "no header rows found, default row with safety buffer"}
@@ -0,0 +1,325 @@
+import math
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+import openpyxl
+from openpyxl.cell.cell import Cell, MergedCell
+from openpyxl.styles import Border, Side
+from openpyxl.utils import get_column_letter, range_boundaries
+
+try:
+    from openpyxl.styles.cell_style import StyleArray
+except ImportError:
+    StyleArray = None
+
+from merch_layout import (HEADER_SCAN_COLUMNS, PRODUCT_COLUMNS, detect_data_start_row, is_product_sheet,
+                          product_row_values)
+from product_fields import extract_product_fields
+from render_progress import pool_results, products_written
+from worksheet_workers import cell_xml, rewrite_cells
+
+# Sharded rendering of the product rows of FICHES.PRODUITS_SHOPIFY workbooks.
+#
+# For very large catalogs, filling the product rows cell by cell through openpyxl keeps
+# one core busy. Here the products are split into chunks and a process pool renders the
+# <row> XML of each chunk directly. Everything the workers need from the workbook is
+# resolved up front in the parent: the data start row of every sheet and the style id of
+# every product cell (template style + thin border, as the serial writer sets it). The
+# workbook is then saved without the product cells and the rendered rows are stitched into
+# each worksheet's <sheetData>, in row order. Each chunk also returns the stock of its
+# products, the shop total is the sum of these partial sums.
+#
+# openpyxl writes strings as inline strings (no shared string table), so do the workers.
+#
+# With per-sheet workers (payload `sheetWorkers`, see worksheet_workers) the work is split by
+# worksheet instead: one worker per worksheet part rewrites its header cells and renders all
+# of its product rows (render_sheet), the row values being computed once in the parent.
+
+# Below this many products a chunk costs more to ship to a worker than to render inline
+MIN_SHARD_PRODUCTS = 500
+
+PRODUCT_COLUMN_COUNT = len(PRODUCT_COLUMNS)
+COLUMN_LETTERS = [get_column_letter(col) for col in range(1, PRODUCT_COLUMN_COUNT + 1)]
+
+THIN_BORDER = Border(left=Side(style='thin'), right=Side(style='thin'),
+                     top=Side(style='thin'), bottom=Side(style='thin'))
+
+ROW_PATTERN = re.compile(r'<row r="(\d+)"([^>]*?)(?:/>|>(.*?)</row>)', re.S)
+DIMENSION_PATTERN = re.compile(r'<dimension ref="([^"]*)"\s*/>')
+
+
+def resolve_shard_workers(option, product_count):
+    """Number of render processes for `option` (payload `renderShards` or $MERCH_RENDER_SHARDS):
+    a number, 'auto' (one per core) or empty (sharding off). 0 when sharding does not apply."""
+    option = option if option not in (None, '') else os.environ.get('MERCH_RENDER_SHARDS', '')
+    if option in ('', False, 0, '0'):
+        return 0
+    if option in ('auto', True):
+        workers = os.cpu_count() or 1
+    else:
+        workers = int(option)
+    # Never more workers than chunks worth shipping
+    return max(0, min(workers, product_count // MIN_SHARD_PRODUCTS))
+
+
+def product_rows(products, column_n_date):
+    """Values of the product rows (see merch_layout.product_row_values) and their stock sum."""
+    rows = []
+    partial_stock = 0
+    for product in products:
+        row_data, total_stock = product_row_values(extract_product_fields(product), column_n_date)
+        rows.append(row_data)
+        partial_stock += total_stock
+    return rows, partial_stock
+
+
+def render_sheet_rows(sheet, start_index, rows):
+    """Cells XML of `rows` (product number `start_index` onwards) for one sheet.
+
+    `sheet` holds the sheet's first product row, a palette of style id tuples and the palette
+    index of each product row.
+    """
+    first_row, palette, row_styles = sheet['first_row'], sheet['palette'], sheet['row_styles']
+    rendered = []
+    for offset, row_data in enumerate(rows):
+        index = start_index + offset
+        row_num = first_row + index
+        styles = palette[row_styles[index]]
+        rendered.append(''.join(
+            cell_xml(f'{COLUMN_LETTERS[col]}{row_num}', styles[col], value)
+            for col, value in enumerate(row_data)
+        ))
+    return rendered
+
+
+def render_chunk(sheets, start_index, products, column_n_date):
+    """Render the product rows of `products` (product number `start_index` onwards) for every sheet.
+
+    Returns ([cells XML per row, per sheet], stock sum).
+    """
+    rows, partial_stock = product_rows(products, column_n_date)
+    return [render_sheet_rows(sheet, start_index, rows) for sheet in sheets], partial_stock
+
+
+def render_sheet(sheet_xml, rewrite, sheet, rows):
+    """Sheet worker: header cells of one worksheet part (see worksheet_workers.rewrite_cells),
+    then its product rows when it is a product sheet (`sheet` is None otherwise)."""
+    sheet_xml, notes = rewrite_cells(sheet_xml, rewrite)
+    if sheet is not None:
+        sheet_xml = stitch_rows(sheet_xml, sheet['first_row'], render_sheet_rows(sheet, 0, rows))
+        notes.append(f"{len(rows)} product row(s) from row {sheet['first_row']}")
+    return sheet_xml, notes
+
+
+def _check_sheet(worksheet, first_row, last_row):
+    """Reason why the product rows of `worksheet` need the serial writer, or None."""
+    for merged in worksheet.merged_cells.ranges:
+        if merged.min_row <= last_row and merged.max_row >= first_row and merged.min_col <= PRODUCT_COLUMN_COUNT:
+            return f"sheet '{worksheet.title}': merged cells {merged.coord} overlap the product rows"
+
+    cells = worksheet._cells
+    for row in range(first_row, last_row + 1):
+        for col in range(1, PRODUCT_COLUMN_COUNT + 1):
+            cell = cells.get((row, col))
+            if cell is not None and (cell.comment is not None or cell.hyperlink is not None):
+                return f"sheet '{worksheet.title}': cell {cell.coordinate} has a comment or hyperlink"
+    return None
+
+
+DEFAULT_STYLE = tuple(StyleArray()) if StyleArray is not None else None
+
+
+def _missing_internals(workbook):
+    """openpyxl private internals the sheet specs rely on (cell and style tables, StyleArray)
+    that this openpyxl build lacks; requirements.txt pins the versions they were written for."""
+    missing = []
+    if StyleArray is None or 'borderId' not in vars(StyleArray):
+        missing.append('StyleArray')
+    if not hasattr(Cell, '_style'):
+        missing.append('Cell._style')
+    for name in ('_cell_styles', '_borders'):
+        if not hasattr(getattr(workbook, name, None), 'add'):
+            missing.append(f'Workbook.{name}')
+    if any(not isinstance(getattr(worksheet, '_cells', None), dict) for worksheet in workbook.worksheets):
+        missing.append('Worksheet._cells')
+    return missing
+
+
+def _prepare_sheet(worksheet, layout, product_count, border_id):
+    """Resolve the style ids of the product rows of `worksheet` and remove their cells."""
+    first_row = layout['data_start_row']
+    last_row = first_row + product_count - 1
+    cells = worksheet._cells
+    cell_styles = worksheet.parent._cell_styles
+
+    # Style id of every product cell: its template style with the thin border, exactly what
+    # `cell.border = thin_border` gives in the serial writer. Rows usually share a few styles.
+    bordered_ids = {}
+    palette, palette_index, row_styles = [], {}, []
+    for row in range(first_row, last_row + 1):
+        style_ids = []
+        for col in range(1, PRODUCT_COLUMN_COUNT + 1):
+            cell = cells.pop((row, col), None)
+            # Cells created without a style (e.g. by iter_rows) have no StyleArray yet
+            base = tuple(cell._style) if cell is not None and cell._style is not None else DEFAULT_STYLE
+            if base not in bordered_ids:
+                bordered = StyleArray(base)
+                bordered.borderId = border_id
+                bordered_ids[base] = cell_styles.add(bordered)
+            style_ids.append(bordered_ids[base])
+        style_ids = tuple(style_ids)
+        if style_ids not in palette_index:
+            palette_index[style_ids] = len(palette)
+            palette.append(style_ids)
+        row_styles.append(palette_index[style_ids])
+
+    # Template rows below the products are cleared, as in the serial writer
+    for row in range(last_row + 1, worksheet.max_row + 1):
+        for col in range(1, PRODUCT_COLUMN_COUNT + 1):
+            cell = cells.get((row, col))
+            if cell is not None and not isinstance(cell, MergedCell):
+                cell.value = None
+
+    return {
+        'worksheet': worksheet,
+        'first_row': first_row,
+        'last_row': last_row,
+        'palette': palette,
+        'row_styles': row_styles,
+        'reason': layout['reason'],
+    }
+
+
+def stitch_rows(sheet_xml, first_row, rows):
+    """Insert the rendered product `rows` (cells XML, from `first_row` on) into a worksheet XML.
+
+    Rows openpyxl still wrote in that range (row heights, cells right of column U) keep
+    their attributes and cells, placed after the product cells.
+    """
+    last_row = first_row + len(rows) - 1
+    start = sheet_xml.index('<sheetData')
+    if sheet_xml.startswith('<sheetData/>', start):
+        sheet_xml = sheet_xml[:start] + '<sheetData></sheetData>' + sheet_xml[start + len('<sheetData/>'):]
+    body_start = sheet_xml.index('>', start) + 1
+    body_end = sheet_xml.index('</sheetData>', body_start)
+    body = sheet_xml[body_start:body_end]
+
+    before_end = after_start = len(body)
+    existing = {}
+    for match in ROW_PATTERN.finditer(body):
+        row_num = int(match.group(1))
+        if row_num < first_row:
+            continue
+        if row_num > last_row:
+            after_start = match.start()
+            break
+        before_end = min(before_end, match.start())
+        existing[row_num] = (match.group(2), match.group(3) or '')
+    before_end = min(before_end, after_start)
+
+    pieces = [body[:before_end]]
+    for offset, cells in enumerate(rows):
+        row_num = first_row + offset
+        attributes, extra_cells = existing.get(row_num, ('', ''))
+        pieces.append(f'<row r="{row_num}"{attributes}>{cells}{extra_cells}</row>')
+    pieces.append(body[after_start:])
+
+    sheet_xml = sheet_xml[:body_start] + ''.join(pieces) + sheet_xml[body_end:]
+
+    # The dimension was computed without the product cells
+    dimension = DIMENSION_PATTERN.search(sheet_xml)
+    if dimension and rows:
+        _, min_row, max_col, max_row = range_boundaries(dimension.group(1))
+        ref = (f"A{min(min_row or first_row, first_row)}:"
+               f"{get_column_letter(max(max_col or 1, PRODUCT_COLUMN_COUNT))}{max(max_row or last_row, last_row)}")
+        sheet_xml = sheet_xml[:dimension.start(1)] + ref + sheet_xml[dimension.end(1):]
+    return sheet_xml
+
+
+def prepare_product_sheets(workbook, product_count, product_sheets=None):
+    """Lay out the product sheets of `workbook` (see merch_layout.is_product_sheet) for
+    `product_count` rows: style ids resolved, product cells removed.
+
+    Returns a list of sheet specs, or {'fallback': reason} when the workbook has to go through
+    the serial writer (nothing is modified then).
+    """
+    missing = _missing_internals(workbook)
+    if missing:
+        return {'fallback': f"openpyxl {openpyxl.__version__} has no {', '.join(missing)}: serial writer"}
+    selected = []
+    for worksheet in workbook.worksheets:
+        layout = detect_data_start_row(
+            enumerate(worksheet.iter_rows(max_col=HEADER_SCAN_COLUMNS, values_only=True), 1)
+        )
+        if not is_product_sheet(worksheet.title, layout, product_sheets):
+            continue
+        first_row = layout['data_start_row']
+        reason = _check_sheet(worksheet, first_row, first_row + product_count - 1)
+        if reason:
+            return {'fallback': reason}
+        selected.append((worksheet, layout))
+
+    border_id = workbook._borders.add(THIN_BORDER)
+    return [_prepare_sheet(worksheet, layout, product_count, border_id) for worksheet, layout in selected]
+
+
+def describe_sheets(specs):
+    return [{'title': spec['worksheet'].title, 'first_row': spec['first_row'], 'last_row': spec['last_row'],
+             'styles': len(spec['palette']), 'reason': spec['reason']} for spec in specs]
+
+
+def worker_sheet(spec):
+    """What a worker needs from a sheet spec (picklable)."""
+    return {key: spec[key] for key in ('first_row', 'palette', 'row_styles')}
+
+
+def render_product_sheets(workbook, products, column_n_date, workers, product_sheets=None):
+    """Render the product rows of the product sheets of `workbook` in `workers` processes.
+
+    Returns a dict with the shop's total stock, the per-sheet layouts, shard statistics and
+    `patch`, the member patch to pass to archive_writer.save_xlsx(); or {'fallback': reason}
+    when the workbook has to go through the serial writer (nothing is modified then).
+    """
+    specs = prepare_product_sheets(workbook, len(products), product_sheets)
+    if isinstance(specs, dict):
+        return specs
+
+    chunk_size = max(MIN_SHARD_PRODUCTS, math.ceil(len(products) / max(workers, 1)))
+    worker_sheets = [worker_sheet(spec) for spec in specs]
+
+    rendered = [[] for _ in specs]
+    total_stock = 0
+    partial_sums = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [
+            pool.submit(render_chunk, worker_sheets, start, products[start:start + chunk_size], column_n_date)
+            for start in range(0, len(products), chunk_size)
+        ]
+        # Results are taken in submission order, so the rows stay in product order
+        results = pool_results(
+            pool, futures, lambda done: products_written(min(done * chunk_size, len(products)), len(products)))
+        for chunk_rows, partial_stock in results:
+            for sheet_index, sheet_rows in enumerate(chunk_rows):
+                rendered[sheet_index].extend(sheet_rows)
+            partial_sums.append(partial_stock)
+            total_stock += partial_stock
+
+    def patch(members):
+        by_path = {spec['worksheet'].path.lstrip('/'): (spec, rows) for spec, rows in zip(specs, rendered)}
+        patched = []
+        for name, data in members:
+            if name in by_path:
+                spec, rows = by_path[name]
+                data = stitch_rows(data.decode('utf-8'), spec['first_row'], rows).encode('utf-8')
+            patched.append((name, data))
+        return patched
+
+    return {
+        'total_stock': total_stock,
+        'sheets': describe_sheets(specs),
+        'shards': len(partial_sums),
+        'partial_sums': partial_sums,
+        'workers': workers,
+        'patch': patch,
+    }
@@ -0,0 +1,206 @@
+from openpyxl import load_workbook
+import json
+import sys
+import os
+import base64
+import datetime
+
+from product_fields import SIZES, calculate_total_stock, calculate_size_stock, extract_product_fields
+from merch_layout import HEADER_SCAN_COLUMNS, PRODUCT_COLUMNS, detect_data_start_row
+
+# Set up logging to a file
+def setup_logging():
+    log_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'logs')
+    os.makedirs(log_dir, exist_ok=True)
+    log_file = os.path.join(log_dir, f'merch_workbook_reader_{datetime.datetime.now().strftime("%Y%m%d_%H%M%S")}.log')
+
+    def log_message(message):
+        with open(log_file, 'a', encoding='utf-8') as f:
+            timestamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            f.write(f'[{timestamp}] {message}\n')
+            print(f'[{timestamp}] {message}')
+
+    return log_message
+
+log = setup_logging()
+
+# Reads the product rows back out of a generated (and possibly hand edited)
+# FICHES.PRODUITS_SHOPIFY workbook, for reconciliation with the shop's products.
+# The workbook is opened read-only and rows are streamed as values, so memory does not
+# grow with the number of rows.
+
+# Fields compared between the sheet and the payload
+COMPARED_FIELDS = ['typeProduit', 'description', 'codeEAN', 'stockTotal', 'stockParTaille',
+                   'poids', 'prix', 'occ', 'couleurs', 'tailles']
+
+
+def normalize_value(value):
+    """Sheet cells edited by hand come back as numbers or padded text: compare them as text."""
+    if value is None:
+        return ''
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value).strip()
+
+
+def split_list(value):
+    text = normalize_value(value)
+    return [item.strip() for item in text.split(',') if item.strip()] if text else []
+
+
+def to_int(value):
+    text = normalize_value(value)
+    try:
+        return int(float(text)) if text else 0
+    except ValueError:
+        return 0
+
+
+def row_to_product(values, sheet_title, row_num):
+    """Product record for one data row, or None for an empty row."""
+    cells = dict(zip(PRODUCT_COLUMNS, list(values) + [None] * (len(PRODUCT_COLUMNS) - len(values))))
+    if not normalize_value(cells['typeProduit']) and not normalize_value(cells['titre']):
+        return None
+    return {
+        'sheet': sheet_title,
+        'row': row_num,
+        'typeProduit': normalize_value(cells['typeProduit']),
+        'titre': normalize_value(cells['titre']),
+        'description': normalize_value(cells['description']),
+        'codeEAN': normalize_value(cells['codeEAN']),
+        'stockTotal': to_int(cells['stockTotal']),
+        'stockParTaille': {size: to_int(cells[f'stock_{size}']) for size in SIZES},
+        'poids': normalize_value(cells['poids']),
+        'prix': normalize_value(cells['prix']),
+        'occ': normalize_value(cells['occ']).upper() == 'OUI',
+        'pod': normalize_value(cells['pod']).upper() == 'OUI',
+        'couleurs': split_list(cells['couleurs']),
+        'tailles': split_list(cells['tailles']),
+    }
+
+
+def iter_workbook_products(xlsx_path, sheet_names=None):
+    """Yield one product record per data row of the product sheets (or of the sheets named in `sheet_names`)."""
+    workbook = load_workbook(xlsx_path, read_only=True, data_only=True)
+    try:
+        for worksheet in workbook.worksheets:
+            if sheet_names and worksheet.title not in sheet_names:
+                continue
+            layout = detect_data_start_row(
+                enumerate(worksheet.iter_rows(max_col=HEADER_SCAN_COLUMNS, values_only=True), 1)
+            )
+            if not sheet_names and layout['size_header_row'] is None:
+                # The processor fills every sheet: by default only read the ones laid out as product sheets
+                log(f"Sheet '{worksheet.title}' skipped: no size header row")
+                continue
+            log(f"Sheet '{worksheet.title}': {layout['reason']}, data from row {layout['data_start_row']}")
+
+            rows = worksheet.iter_rows(min_row=layout['data_start_row'], max_col=len(PRODUCT_COLUMNS), values_only=True)
+            for row_num, values in enumerate(rows, layout['data_start_row']):
+                product = row_to_product(values, worksheet.title, row_num)
+                if product is not None:
+                    yield product
+    finally:
+        workbook.close()
+
+
+def expected_record(product):
+    """What process_merch_xlsx writes for a payload product, in the reader's record format."""
+    fields = extract_product_fields(product)
+    stock = fields['stock']
+    return {
+        'typeProduit': normalize_value(fields['type_produit']),
+        'titre': normalize_value(fields['titre']),
+        'description': normalize_value(fields['description']),
+        'codeEAN': normalize_value(fields['code_ean']),
+        'stockTotal': calculate_total_stock(stock),
+        'stockParTaille': {size: calculate_size_stock(stock, size) for size in SIZES},
+        'poids': normalize_value(fields['poids']),
+        'prix': normalize_value(fields['prix']),
+        'occ': bool(fields['occ']),
+        'couleurs': split_list(fields['couleurs_str']),
+        'tailles': split_list(fields['tailles_str']),
+    }
+
+
+def diff_products(sheet_products, payload_products):
+    """Yield the differences between the sheet rows and the payload products, matched by title.
+
+    Only the payload is indexed in memory; the sheet rows are consumed as they stream.
+    """
+    expected_by_title = {}
+    for product in payload_products:
+        record = expected_record(product)
+        expected_by_title.setdefault(record['titre'], []).append(record)
+
+    for product in sheet_products:
+        yield product, None
+        candidates = expected_by_title.get(product['titre'])
+        if not candidates:
+            yield None, {'status': 'extra_in_sheet', 'titre': product['titre'], 'sheet': product['sheet'], 'row': product['row']}
+            continue
+        expected = candidates.pop(0)
+        changes = {field: {'payload': expected[field], 'sheet': product[field]}
+                   for field in COMPARED_FIELDS if expected[field] != product[field]}
+        if changes:
+            yield None, {'status': 'changed', 'titre': product['titre'], 'sheet': product['sheet'],
+                         'row': product['row'], 'changes': changes}
+
+    for title, remaining in expected_by_title.items():
+        for _ in remaining:
+            yield None, {'status': 'missing_in_sheet', 'titre': title}
+
+
+def export_workbook_products(xlsx_path, output_path, payload=None, sheet_names=None):
+    """Write the workbook products to `output_path` as JSONL; with a payload, also write
+    the differences to `<output_path>.diff.jsonl`. Returns counters."""
+    counts = {'products': 0, 'changed': 0, 'extra_in_sheet': 0, 'missing_in_sheet': 0}
+    products = iter_workbook_products(xlsx_path, sheet_names)
+    diff_path = f"{output_path}.diff.jsonl" if payload is not None else None
+
+    with open(output_path, 'w', encoding='utf-8') as out:
+        diff_out = open(diff_path, 'w', encoding='utf-8') if diff_path else None
+        try:
+            entries = diff_products(products, payload.get('products', [])) if diff_out else ((p, None) for p in products)
+            for product, difference in entries:
+                if product is not None:
+                    out.write(json.dumps(product, ensure_ascii=False) + '\n')
+                    counts['products'] += 1
+                if difference is not None:
+                    diff_out.write(json.dumps(difference, ensure_ascii=False) + '\n')
+                    counts[difference['status']] += 1
+        finally:
+            if diff_out:
+                diff_out.close()
+
+    log(f"Read {counts['products']} product(s) from {xlsx_path} into {output_path}")
+    if diff_path:
+        log(f"Differences written to {diff_path}: {counts['changed']} changed, "
+            f"{counts['extra_in_sheet']} only in the sheet, {counts['missing_in_sheet']} only in the payload")
+    return counts
+
+
+def load_payload(argument):
+    """Payload from a JSON file path or a base64 encoded JSON string (as the processors receive it)."""
+    if os.path.exists(argument):
+        with open(argument, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    return json.loads(base64.b64decode(argument).decode('utf-8'))
+
+
+if __name__ == "__main__":
+    try:
+        if len(sys.argv) not in (3, 4):
+            error_msg = "Usage: python merch_workbook_reader.py <xlsx_path> <output_jsonl_path> [<payload_json_path_or_base64>]"
+            log(error_msg)
+            print(error_msg, file=sys.stderr)
+            sys.exit(1)
+
+        payload = load_payload(sys.argv[3]) if len(sys.argv) == 4 else None
+        counts = export_workbook_products(sys.argv[1], sys.argv[2], payload)
+        print(json.dumps(counts))
+    except Exception as e:
+        error_msg = f"Fatal error: {str(e)}"
+        log(error_msg)
+        print(error_msg, file=sys.stderr)
+        sys.exit(1)
@@ -7,6 +7,17 @@ import os
 import base64
 import datetime
 
+from archive_writer import save_xlsx, format_save_stats, format_render_digest
+from template_pool import checkout_workbook
+from merch_layout import HEADER_SCAN_COLUMNS, detect_data_start_row, is_product_sheet, product_row_values
+from merch_sheet_shards import (describe_sheets, prepare_product_sheets, product_rows, render_product_sheets,
+                                render_sheet, resolve_shard_workers, worker_sheet)
+from placeholder_registry import mapping_for, resolve_cells, resolve_placeholders
+from product_fields import SIZES, calculate_total_stock, extract_product_fields
+from render_engines import choose_engine, format_engine, measure_template, pool_workers
+from render_progress import RenderCancelled, abort, finish, phase, products_written, start_job
+from worksheet_workers import resolve_sheet_workers, sheet_patch
+
 # Set up logging to a file
 def setup_logging():
     log_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'logs')
@@ -23,27 +34,12 @@ def setup_logging():
 
 log = setup_logging()
 
-def calculate_total_stock(stock_dict):
-    """Calculate total stock from stock dictionary"""
-    if not stock_dict:
-        return 0
-    return sum(int(value) for value in stock_dict.values() if str(value).isdigit())
-
-def calculate_size_stock(stock_dict, target_size):
-    """Calculate stock for a specific size regardless of color"""
-    if not stock_dict:
-        return 0
-    
-    total = 0
-    for combination, stock in stock_dict.items():
-        if '-' in combination:
-            size, color = combination.split('-', 1)
-            if size == target_size and str(stock).isdigit():
-                total += int(stock)
-        elif combination == target_size and str(stock).isdigit():
-            total += int(stock)
-    
-    return total
+def shopify_csv_path_for(shop_data, output_path):
+    """Path of the optional Shopify import CSV written next to the workbook, or None."""
+    shopify_csv_path = shop_data.get('shopifyCsvPath')
+    if not shopify_csv_path and shop_data.get('shopifyCsv'):
+        shopify_csv_path = os.path.splitext(output_path)[0] + '.csv'
+    return shopify_csv_path or None
 
 def process_merch_xlsx(xlsx_path, shop_data, output_path):
     log(f"Starting Merchandising XLSX processing for: {xlsx_path}")
@@ -52,10 +48,23 @@ def process_merch_xlsx(xlsx_path, shop_data, output_path):
     # Check if we're in append mode
     append_mode = shop_data.get('appendMode', False)
     log(f"Append mode: {append_mode}")
+
+    # Engine for this job, from the template shape and the product count (see render_engines)
+    measurements = measure_template(xlsx_path)
+    measurements.update(products=len(shop_data.get('products', [])), append_mode=bool(append_mode))
+    engine, reason = choose_engine('merch', shop_data.get('renderEngine'), measurements)
+    if append_mode and engine != 'object':
+        engine, reason = 'object', f"'{engine}' requested but append mode edits the workbook in place"
+    log(format_engine(engine, reason, measurements))
     
     try:
-        workbook = load_workbook(xlsx_path)
-        log(f"Successfully loaded workbook: {xlsx_path}")
+        phase('load')
+        if append_mode:
+            # Existing generated file, not a template: nothing to reuse
+            workbook, source = load_workbook(xlsx_path), 'parsed'
+        else:
+            workbook, source = checkout_workbook(xlsx_path)
+        log(f"Successfully loaded workbook: {xlsx_path} (from {source})")
     except Exception as e:
         log(f"Failed to load workbook: {str(e)}")
         raise
@@ -92,7 +101,6 @@ def process_merch_xlsx(xlsx_path, shop_data, output_path):
     # Debug: Show all available date fields in shop_data
     log(f"🔍 DEBUG: All shop_data keys: {list(shop_data.keys())}")
     log(f"🔍 DEBUG: Date fields found - dateSortie: '{shop_data.get('dateSortie', 'NOT_FOUND')}', dateSortieOfficielle: '{shop_data.get('dateSortieOfficielle', 'NOT_FOUND')}', dateCommercialisation: '{shop_data.get('dateCommercialisation', 'NOT_FOUND')}'")
-    log(f"🔍 DEBUG: Full shop_data content: {shop_data}")
     log(f"🔍 DEBUG: Final extracted - date_sortie: '{date_sortie}', date_commercialisation: '{date_commercialisation}'")
     
     # Extract date de mise en ligne in DD/MM/YYYY format for column 16
@@ -157,17 +165,95 @@ def process_merch_xlsx(xlsx_path, shop_data, output_path):
     log(f"Combined dates field: '{combined_dates}'")
     log(f"Combined dates DD/MM/YYYY: '{combined_dates_ddmmyyyy}'")
     
-    # Calculate total stock for all products in the shop
-    total_shop_stock = 0
-    for product in products:
-        product_stock = product.get('stock', {})
-        total_shop_stock += calculate_total_stock(product_stock)
+    # Sheets that get product rows: every sheet unless the payload names them (or 'auto')
+    product_sheets = shop_data.get('productSheets')
+    if product_sheets not in (None, '', 'all', 'auto'):
+        unknown = [title for title in product_sheets if title not in workbook.sheetnames]
+        if unknown:
+            log(f"productSheets: no sheet named {unknown} in the workbook")
+    log(f"Product sheets: {product_sheets or 'all'}")
+
+    phase('render', engine=engine, products=len(products))
+
+    # Multi-sheet workbooks: each worksheet part rewritten by its own worker (see worksheet_workers)
+    per_sheet = None
+    sheet_workers = 0
+    if engine == 'xml_patch':
+        sheet_workers = resolve_sheet_workers(
+            pool_workers(shop_data.get('sheetWorkers'), 'XLSX_SHEET_WORKERS', measurements), len(workbook.worksheets))
+        if not sheet_workers:
+            log("Per-sheet processing not used, no sheet worker: object engine")
+    if sheet_workers:
+        specs = prepare_product_sheets(workbook, len(products), product_sheets)
+        if isinstance(specs, dict):
+            log(f"Per-sheet processing not used, {specs['fallback']}")
+        else:
+            rows, total_stock = product_rows(products, combined_dates_ddmmyyyy)
+            per_sheet = {'specs': specs, 'rows': rows, 'total_stock': total_stock}
+            log(f"Per-sheet processing on {sheet_workers} process(es), {len(rows)} product row(s) computed once")
+            for sheet in describe_sheets(specs):
+                log(f"Sheet '{sheet['title']}': rows {sheet['first_row']}-{sheet['last_row']} ({sheet['reason']}, {sheet['styles']} row style(s))")
+
+    # Very large catalogs: product rows rendered by a process pool (see merch_sheet_shards)
+    sharded = None
+    shard_workers = 0
+    if engine == 'streaming':
+        shard_workers = resolve_shard_workers(
+            shop_data.get('renderShards') or os.environ.get('MERCH_RENDER_SHARDS') or 'auto', len(products))
+        if not shard_workers:
+            log(f"Sharded rendering not used, {len(products)} product(s) make no shard: object engine")
+    if shard_workers:
+        sharded = render_product_sheets(workbook, products, combined_dates_ddmmyyyy, shard_workers, product_sheets)
+        if 'fallback' in sharded:
+            log(f"Sharded rendering not used, {sharded['fallback']}")
+            sharded = None
+        else:
+            log(f"Rendered {len(products)} product rows in {sharded['shards']} shard(s) on {sharded['workers']} process(es)")
+            for sheet in sharded['sheets']:
+                log(f"Sheet '{sheet['title']}': rows {sheet['first_row']}-{sheet['last_row']} ({sheet['reason']}, {sheet['styles']} row style(s))")
     
-    log(f"Total shop stock calculated: {total_shop_stock}")
+    # Calculate total stock for all products in the shop
+    if sharded:
+        total_shop_stock = sharded['total_stock']
+        log(f"Total shop stock from shard partial sums {sharded['partial_sums']}: {total_shop_stock}")
+    elif per_sheet:
+        total_shop_stock = per_sheet['total_stock']
+        log(f"Total shop stock calculated: {total_shop_stock}")
+    else:
+        total_shop_stock = 0
+        for product in products:
+            product_stock = product.get('stock', {})
+            total_shop_stock += calculate_total_stock(product_stock)
+        
+        log(f"Total shop stock calculated: {total_shop_stock}")
+
+    # Header cells and placeholders come from the template's mapping file (placeholder_maps/)
+    header_mapping = mapping_for(xlsx_path, 'merch')
+    computed = {'totalShopStock': str(total_shop_stock)}
+    header_cells = resolve_cells(header_mapping, shop_data, computed)
+    header_placeholders = resolve_placeholders(header_mapping, shop_data, computed)
     log(f"Processing {len(products)} products for shop: {nom_projet}")
 
-    # Process all worksheets
-    for worksheet in workbook.worksheets:
+    save_patch = sharded['patch'] if sharded else None
+    sheet_notes = []
+    if per_sheet:
+        # Same header rules as the loop below, applied to the XML of each worksheet part
+        rewrite = {
+            'cells': header_cells,
+            'conditional_cells': {'F2': (['SUM', '####'], str(total_shop_stock))},
+            'placeholders': header_placeholders,
+        }
+        sheets_by_title = {spec['worksheet'].title: worker_sheet(spec) for spec in per_sheet['specs']}
+
+        def sheet_task(worksheet):
+            sheet = sheets_by_title.get(worksheet.title)
+            return render_sheet, (rewrite, sheet, per_sheet['rows'] if sheet else [])
+
+        save_patch = sheet_patch(workbook, sheet_task, sheet_workers, sheet_notes)
+
+    # Process all worksheets (the sheet workers do it when saving in per-sheet mode)
+    worksheets = [] if per_sheet else workbook.worksheets
+    for worksheet in worksheets:
         log(f"Processing worksheet: {worksheet.title}")
         
         # Replace placeholders in header, but skip merged cells
@@ -182,15 +268,9 @@ def process_merch_xlsx(xlsx_path, shop_data, output_path):
                     new_value = original_value
                     
                     # Special handling for specific cells FIRST (before general replacements)
-                    if cell.coordinate == 'A2':
-                        new_value = "CLIENT :"
-                        log(f"🎯 SPECIAL CELL A2: Set to 'CLIENT :' (was: '{original_value}')")
-                    elif cell.coordinate == 'B2':
-                        new_value = nom_projet
-                        log(f"🎯 SPECIAL CELL B2: Set to shop name '{nom_projet}' (was: '{original_value}')")
-                    elif cell.coordinate == 'C2':
-                        new_value = f"E-SHOP : {shopify_domain}"
-                        log(f"🎯 SPECIAL CELL C2: Set to 'E-SHOP : {shopify_domain}' (was: '{original_value}')")
+                    if cell.coordinate in header_cells:
+                        new_value = header_cells[cell.coordinate]
+                        log(f"🎯 SPECIAL CELL {cell.coordinate}: Set to '{new_value}' (was: '{original_value}')")
                     elif cell.coordinate == 'F2':
                         # F2 contains a SUM formula, let's replace it with the actual total stock value
                         if 'SUM' in str(cell.value) or '####' in str(cell.value):
@@ -200,17 +280,7 @@ def process_merch_xlsx(xlsx_path, shop_data, output_path):
                             log(f"🎯 SPECIAL CELL F2: No formula/#### found (value: '{cell.value}')")
                     else:
                         # Replace placeholders - try multiple variations (ONLY for non-special cells)
-                        placeholders_to_replace = [
-                            ('nonProjet', nom_projet),
-                            ('nomProjet', nom_projet),
-                            ('CLIENT', nom_projet),  # This won't affect A2 now
-                            ('PROJET', nom_projet),
-                            ('shopifyDomain', shopify_domain),
-                            ('SHOPIFY_DOMAIN', shopify_domain),
-                            ('####', str(total_shop_stock))  # This won't affect F2 now
-                        ]
-                        
-                        for placeholder, replacement in placeholders_to_replace:
+                        for placeholder, replacement in header_placeholders.items():
                             if placeholder in new_value:
                                 new_value = new_value.replace(placeholder, replacement)
                                 log(f"Replaced '{placeholder}' with '{replacement}' in cell {cell.coordinate}")
@@ -222,73 +292,19 @@ def process_merch_xlsx(xlsx_path, shop_data, output_path):
                             log(f"Could not modify cell {cell.coordinate}: {str(e)}")
                             continue
 
-        # Find the row that contains size headers (XS, S, M, L, XL)
-        # This is likely the last header row before data should be written
-        data_start_row = None
-        size_header_row = None
+        if sharded:
+            # Product rows already rendered, they are spliced in when saving
+            continue
         
-        # First, look for the row with size headers (XS, S, M, L, XL)
-        for row_num in range(1, worksheet.max_row + 15):  # Check more rows
-            found_sizes = 0
-            size_positions = {}
-            
-            # Check all columns in this row for size headers
-            for col_num in range(1, 15):  # Check first 15 columns
-                cell_value = worksheet.cell(row=row_num, column=col_num).value
-                if cell_value and isinstance(cell_value, str):
-                    cell_value_upper = cell_value.strip().upper()
-                    if cell_value_upper in ['XS', 'S', 'M', 'L', 'XL']:
-                        found_sizes += 1
-                        size_positions[cell_value_upper] = col_num
-            
-            # If we found at least 3 size headers, this is likely the size header row
-            if found_sizes >= 3:
-                size_header_row = row_num
-                data_start_row = row_num + 1  # Start writing data AFTER the size headers
-                log(f"Found size header row at row {size_header_row} with {found_sizes} size columns: {size_positions}")
-                break
-        
-        # Fallback: Look for "TYPE DE PRODUIT" in the first cell
-        if data_start_row is None:
-            for row_num in range(1, worksheet.max_row + 15):
-                first_cell_value = worksheet.cell(row=row_num, column=1).value
-                if first_cell_value and isinstance(first_cell_value, str):
-                    if "TYPE DE PRODUIT" in first_cell_value.upper():
-                        # Look for size headers in the next few rows after TYPE DE PRODUIT
-                        for next_row in range(row_num + 1, min(row_num + 5, worksheet.max_row + 1)):
-                            found_sizes = 0
-                            for col_num in range(1, 15):
-                                cell_value = worksheet.cell(row=next_row, column=col_num).value
-                                if cell_value and isinstance(cell_value, str):
-                                    if cell_value.strip().upper() in ['XS', 'S', 'M', 'L', 'XL']:
-                                        found_sizes += 1
-                            if found_sizes >= 3:
-                                size_header_row = next_row
-                                data_start_row = next_row + 1
-                                log(f"Found 'TYPE DE PRODUIT' at row {row_num}, size headers at row {size_header_row}")
-                                break
-                        if data_start_row:
-                            break
-                        else:
-                            # No size headers found, use row after TYPE DE PRODUIT + buffer
-                            data_start_row = row_num + 3
-                            log(f"Found 'TYPE DE PRODUIT' at row {row_num}, using row {data_start_row} with buffer")
-                            break
-        
-        # Second fallback: look for any cell containing "TYPE" in the first column
-        if data_start_row is None:
-            for row_num in range(1, worksheet.max_row + 15):
-                first_cell_value = worksheet.cell(row=row_num, column=1).value
-                if first_cell_value and isinstance(first_cell_value, str):
-                    if "TYPE" in first_cell_value.upper():
-                        data_start_row = row_num + 3  # Add buffer to avoid overwriting
-                        log(f"Found header row with 'TYPE' at row {row_num}, using row {data_start_row} with buffer")
-                        break
-        
-        # Final fallback
-        if data_start_row is None:
-            data_start_row = 6  # Start at row 6 to be safe
-            log("Could not find header rows - using default row 6 with safety buffer")
+        # Find where product rows start (size header row, then "TYPE" fallbacks, see merch_layout)
+        layout = detect_data_start_row(
+            enumerate(worksheet.iter_rows(max_col=HEADER_SCAN_COLUMNS, values_only=True), 1)
+        )
+        data_start_row = layout['data_start_row']
+        log(f"Layout: {layout['reason']}, size columns: {layout['size_positions']}")
+        if not is_product_sheet(worksheet.title, layout, product_sheets):
+            log(f"Worksheet '{worksheet.title}' is not a product sheet, no product rows")
+            continue
             
         log(f"Will start inserting product data at row: {data_start_row}")
         
@@ -323,95 +339,25 @@ def process_merch_xlsx(xlsx_path, shop_data, output_path):
         for i, product in enumerate(products):
             log(f"Processing product {i+1}/{len(products)}: {product.get('titre', 'Unknown')}")
             
-            # Calculate stock values
-            stock_dict = product.get('stock', {})
-            total_stock = calculate_total_stock(stock_dict)
-            log(f"Product {i+1} total stock: {total_stock} from stock_dict: {stock_dict}")
-            
-            # Calculate stock by size
-            size_stocks = {}
-            for size in ['XS', 'S', 'M', 'L', 'XL']:
-                size_stocks[size] = calculate_size_stock(stock_dict, size)
-            log(f"Product {i+1} size stocks: {size_stocks}")
-            
-            # Row data according to specifications:
-            # 1. Type de produit
-            # 2. Titre  
-            # 3. Description fiche produits
-            # 4. Code-barres EAN (13 chiffres)
-            # 5. Quantités totales
-            # 6. Merch/tailles (XS, S, M, L, XL sub-columns)
-            # 7. Poids
-            # 8. Prix de vente TTC
-            # 9. OCC (OUI/NON)
+            # Handle different field name variations (see product_fields), row values
+            # in column order A..U (see merch_layout.PRODUCT_COLUMNS)
+            fields = extract_product_fields(product)
+            row_data, total_stock = product_row_values(fields, combined_dates_ddmmyyyy)
+            log(f"Product {i+1} total stock: {total_stock} from stock_dict: {fields['stock']}")
+            log(f"Product {i+1} size stocks: {dict(zip(SIZES, row_data[5:10]))}")
             
-            # Handle different field name variations
-            type_produit = product.get('typeProduit', '') or product.get('type', '')
-            titre = product.get('titre', '') or product.get('title', '')
-            description = product.get('description', '')
-            # Extract EAN from eans object first, then fallback to legacy fields
-            eans_obj = product.get('eans', {})
-            if eans_obj:
-                # Get the first available EAN from the eans object
-                code_ean = next((ean for ean in eans_obj.values() if ean), None)
-            else:
-                code_ean = None
-            
-            # Fallback to legacy fields if no EAN found in eans object
-            if not code_ean:
-                code_ean = product.get('codeEAN', '') or product.get('ean', '') or product.get('codeBarres', '')
-            poids = product.get('poids', '') or product.get('weight', '')
-            prix = product.get('prix', '') or product.get('price', '')
-            occ = product.get('occ', False) or product.get('OCC', False)
-            
-            # Extract colors and sizes from product
-            couleurs = product.get('couleurs', [])
-            tailles = product.get('tailles', [])
-            
-            # Format colors and sizes as comma-separated strings
-            couleurs_str = ', '.join(couleurs) if isinstance(couleurs, list) else str(couleurs) if couleurs else ''
-            tailles_str = ', '.join(tailles) if isinstance(tailles, list) else str(tailles) if tailles else ''
-            
-            # Extract and format product images - ALWAYS LEAVE EMPTY as requested
-            image_urls = product.get('imageUrls', [])
-            visuels_str = ''  # Always leave visuels empty as requested - never put actual S3 URLs
-            
-            log(f"Product {i+1} colors: {couleurs} -> '{couleurs_str}'")
-            log(f"Product {i+1} sizes: {tailles} -> '{tailles_str}'")
-            log(f"Product {i+1} images: {len(image_urls)} images -> '{visuels_str[:100]}{'...' if len(visuels_str) > 100 else ''}'")
-            
-            # Determine POD status based on product type
-            pod_status = 'OUI' if type_produit.upper() == 'POD' else 'NON'
+            couleurs_str = fields['couleurs_str']
+            tailles_str = fields['tailles_str']
+            # Visuels (column U) always stay empty - never put actual S3 URLs
+            image_urls = fields['image_urls']
             
+            log(f"Product {i+1} colors: {fields['couleurs']} -> '{couleurs_str}'")
+            log(f"Product {i+1} sizes: {fields['tailles']} -> '{tailles_str}'")
+            log(f"Product {i+1} images: {len(image_urls)} images -> ''")
             log(f"Product {i+1} - Column N data: '{combined_dates_ddmmyyyy}' (from date_sortie: '{date_sortie}', date_commercialisation: '{date_commercialisation}')")
-            log(f"Product {i+1} - POD status: '{pod_status}' (type_produit: '{type_produit}')")
+            log(f"Product {i+1} - POD status: '{row_data[15]}' (type_produit: '{fields['type_produit']}')")
             log(f"Product {i+1} - Total shop stock: {total_shop_stock}")
             
-            # Build row data with correct column mapping (A=1, B=2, ..., P=16, S=19, T=20)
-            row_data = [
-                type_produit,                            # Column A (1): Type de produit
-                titre,                                   # Column B (2): Titre
-                description,                             # Column C (3): Description
-                code_ean,                                # Column D (4): Code EAN
-                total_stock,                             # Column E (5): Quantités totales (per product)
-                size_stocks.get('XS', 0),               # Column F (6): XS stock
-                size_stocks.get('S', 0),                # Column G (7): S stock
-                size_stocks.get('M', 0),                # Column H (8): M stock
-                size_stocks.get('L', 0),                # Column I (9): L stock
-                size_stocks.get('XL', 0),               # Column J (10): XL stock
-                poids,                                   # Column K (11): Poids
-                prix,                                    # Column L (12): Prix TTC
-                'OUI' if occ else 'NON',                # Column M (13): OCC status
-                combined_dates_ddmmyyyy,                 # Column N (14): Date de sortie/commercialisation (DD/MM/YYYY)
-                '',                                      # Column O (15): Empty cell
-                pod_status,                              # Column P (16): POD Status (OUI/NON)
-                '',                                      # Column Q (17): Empty cell
-                '',                                      # Column R (18): Empty cell
-                couleurs_str,                            # Column S (19): Couleurs (colors selected by users)
-                tailles_str,                             # Column T (20): Tailles (sizes selected by users)
-                visuels_str                              # Column U (21): Visuels (product images in order)
-            ]
-            
             # Insert the row with borders
             for col_num, value in enumerate(row_data, 1):
                 try:
@@ -442,6 +388,7 @@ def process_merch_xlsx(xlsx_path, shop_data, output_path):
                     continue
             
             log(f"Successfully added product {i+1} data at row {current_row}: {product.get('titre', 'Unknown')}")
+            products_written(i + 1, len(products), worksheet.title)
             log(f"Combined dates field content: '{combined_dates}'")
             log(f"Colors field content: '{couleurs_str}'")
             log(f"Sizes field content: '{tailles_str}'")
@@ -451,8 +398,20 @@ def process_merch_xlsx(xlsx_path, shop_data, output_path):
         log(f"Finished processing all products. Final row: {current_row - 1}")
 
     # Save the processed workbook
-    workbook.save(output_path)
-    log(f"Merchandising XLSX file saved to {output_path}")
+    phase('save')
+    save_stats = save_xlsx(workbook, output_path, shop_data.get('saveProfile'), patch=save_patch, source_path=xlsx_path)
+    for title, notes in sheet_notes:
+        log(f"Processed worksheet: {title}")
+        for note in notes:
+            log(note)
+    log(f"Merchandising XLSX file saved to {output_path}: {format_save_stats(save_stats)}")
+    log(format_render_digest(output_path, save_stats['sha256']))
+
+    # Optional Shopify import CSV built from the same product data
+    shopify_csv_path = shopify_csv_path_for(shop_data, output_path)
+    if shopify_csv_path:
+        from shopify_csv_export import export_shopify_csv
+        export_shopify_csv(shop_data, shopify_csv_path)
 
 if __name__ == "__main__":
     try:
@@ -484,9 +443,16 @@ if __name__ == "__main__":
 
             # Process the XLSX file
             log("Starting merchandising XLSX processing...")
+            # A cancelled job also removes a partial Shopify CSV
+            start_job('merch_xlsx_processor', [output_path, shopify_csv_path_for(shop_data, output_path)])
             process_merch_xlsx(template_path, shop_data, output_path)
             log("Merchandising XLSX processing completed successfully")
+            finish(output_path)
             
+        except RenderCancelled as e:
+            # Cancel request or deadline: outputs removed, see render_progress
+            log(f"Processing cancelled: {str(e)}")
+            sys.exit(abort(e))
         except Exception as e:
             error_msg = f"Error processing merchandising XLSX: {str(e)}"
             log(error_msg)
@@ -0,0 +1,312 @@
+import datetime
+import re
+from zoneinfo import ZoneInfo
+
+from archive_writer import SAVE_PROFILES
+from render_engines import ENGINES
+
+# Payload validation for the document processors, before anything heavy happens.
+#
+# A malformed payload (a list instead of the shop object, stock counts like '5.5', dates in a
+# format the merch processor passes through untouched) used to be found deep inside a
+# processor, after the template was loaded and partly rendered, or not at all. Each processor
+# now has a schema, compiled once into checker functions; render_job.py runs it on the decoded
+# payload before the processor module (and openpyxl / python-docx) is even imported.
+#
+# A checker validates and coerces one value and records precise errors with the path of the
+# value ("products[3].stock['M-Noir']"). Field types:
+#   scalar    text, number, boolean or null (what a placeholder can print)
+#   flag      boolean, or a scalar read as one ('OUI', 1...)
+#   date      '' / null, YYYY/MM/DD, YYYY-MM-DD, DD/MM/YYYY or an ISO timestamp (coerced to
+#             its date in Paris, as YYYY/MM/DD like the dates sharepointService formats);
+#             must be a real calendar date
+#   date_dmy  '' / null or DD/MM/YYYY
+#   count     a whole number >= 0, as the digit string the processors expect ('' for none);
+#             integers and integral floats are coerced to digits, surrounding spaces stripped
+#   workers   'auto', a number >= 0 or empty
+#   choice    one of a list of values, or empty
+#   {'list': type}, {'map': type}, {'object': schema}
+# Fields not listed in a schema are left alone.
+
+# Errors reported per payload, the rest is summarized
+MAX_ERRORS = 20
+
+# Dates are printed as the shop's team reads them, in Paris
+DOCUMENT_TIMEZONE = ZoneInfo('Europe/Paris')
+
+DATE_FORMATS = [
+    (re.compile(r'^(\d{4})/(\d{1,2})/(\d{1,2})$'), ('year', 'month', 'day'), False),
+    (re.compile(r'^(\d{4})-(\d{1,2})-(\d{1,2})$'), ('year', 'month', 'day'), False),
+    (re.compile(r'^(\d{1,2})/(\d{1,2})/(\d{4})$'), ('day', 'month', 'year'), False),
+    # JSON-serialized dates (Date.toJSON() is UTC: '2026-03-31T22:00:00.000Z' is 1 April in
+    # Paris); only the date is printed in the documents
+    (re.compile(r'^(\d{4})-(\d{2})-(\d{2})T(\d{2}):(\d{2})(?::(\d{2})(?:\.\d+)?)?(Z|[+-]\d{2}:?\d{2})?$'),
+     ('year', 'month', 'day', 'hour', 'minute', 'second', 'offset'), True),
+]
+DMY_FORMAT = DATE_FORMATS[2]
+
+SCALAR_TYPES = (str, int, float, bool)
+
+SHOP_TEXT_FIELDS = [
+    'nomProjet', 'typeProjet', 'commercial', 'contactsClient', 'nomClient', 'raisonSociale', 'client',
+    'customerName', 'compteClientRef', 'numeroCompteClient', 'shopifyDomain', 'chefProjet', 'pourcentageSNA',
+    'commissionSnagz', 'typeAbonnementShopify', 'facturation', 'fraisMensuelMaintenance',
+    'fraisOuvertureBoutique', 'fraisOuvertureSansHabillage',
+]
+SHOP_FLAG_FIELDS = [
+    'precommande', 'dedicace', 'dedicaceEnvisagee', 'boutiqueEnLigne', 'estBoutiqueEnLigne',
+    'moduleMondialRelay', 'moduleDelivengo', 'coutsMondialRelay', 'coutsDelivengo',
+    'abonnementMensuelShopify', 'abonnementAnnuelShopify',
+]
+SHOP_DATE_FIELDS = [
+    'dateMiseEnLigne', 'dateCommercialisation', 'dateSortieOfficielle', 'demarrageProjet',
+    # Older names the merch processor still reads
+    'dateSortie', 'dateDeSortie', 'dateAlbum', 'dateSortieAlbum', 'dateDeCommercialisation', 'dateMerch',
+    'dateCommercialisationMerch',
+]
+
+RENDER_OPTIONS = {
+    'renderEngine': {'choice': ['auto', *ENGINES]},
+    'saveProfile': {'choice': sorted(SAVE_PROFILES)},
+}
+
+PRODUCT_SCHEMA = {
+    **{name: 'scalar' for name in ('typeProduit', 'type', 'titre', 'title', 'description', 'codeEAN', 'ean',
+                                   'codeBarres', 'poids', 'weight', 'prix', 'price')},
+    'occ': 'flag',
+    'OCC': 'flag',
+    'stock': {'map': 'count'},
+    'eans': {'map': 'scalar'},
+    'skus': {'map': 'scalar'},
+    'couleurs': 'labels',
+    'tailles': 'labels',
+    'imageUrls': {'list': 'scalar'},
+}
+
+SHOP_SCHEMA = {
+    **{name: 'scalar' for name in SHOP_TEXT_FIELDS},
+    **{name: 'flag' for name in SHOP_FLAG_FIELDS},
+    **{name: 'date' for name in SHOP_DATE_FIELDS},
+    'dateMiseEnLigneDDMMYYYY': 'date_dmy',
+    **RENDER_OPTIONS,
+}
+
+# Schema of each processor kind, see SCRIPT_KINDS
+SCHEMAS = {
+    'docx': SHOP_SCHEMA,
+    'xlsx': {**SHOP_SCHEMA, 'sheetWorkers': 'workers'},
+    'd2c': SHOP_SCHEMA,
+    'merch': {
+        **SHOP_SCHEMA,
+        'appendMode': 'flag',
+        'shopifyCsv': 'flag',
+        'shopifyCsvPath': 'scalar',
+        'sheetWorkers': 'workers',
+        'renderShards': 'workers',
+        'productSheets': 'product_sheets',
+        'products': {'list': {'object': PRODUCT_SCHEMA}},
+    },
+}
+
+SCRIPT_KINDS = {
+    'docx_processor.py': 'docx',
+    'docx_preview.py': 'docx',
+    'xlsx_processor.py': 'xlsx',
+    'template_processor.py': 'd2c',
+    'merch_xlsx_processor.py': 'merch',
+}
+
+
+class PayloadError(ValueError):
+    """Invalid payload; `errors` holds one message per invalid value."""
+
+    def __init__(self, kind, errors):
+        self.kind = kind
+        self.errors = errors
+        shown = '; '.join(errors[:MAX_ERRORS])
+        more = f" (and {len(errors) - MAX_ERRORS} more)" if len(errors) > MAX_ERRORS else ''
+        super().__init__(f"Invalid {kind} payload: {shown}{more}")
+
+
+def _describe(value):
+    text = repr(value)
+    return text if len(text) <= 60 else text[:57] + '...'
+
+
+def _check_scalar(value, path, errors):
+    if value is not None and not isinstance(value, SCALAR_TYPES):
+        errors.append(f"{path}: expected text, a number or a boolean, got {type(value).__name__}")
+    return value
+
+
+def _check_labels(value, path, errors):
+    # Colors and sizes: a list of labels, or one comma-separated text
+    if isinstance(value, list):
+        for index, item in enumerate(value):
+            _check_scalar(item, f"{path}[{index}]", errors)
+        return value
+    return _check_scalar(value, path, errors)
+
+
+def _check_count(value, path, errors):
+    if value is None or value == '':
+        return value
+    if isinstance(value, bool):
+        errors.append(f"{path}: expected a whole number of items, got {_describe(value)}")
+        return value
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    if isinstance(value, int):
+        if value < 0:
+            errors.append(f"{path}: expected a whole number of items >= 0, got {value}")
+            return value
+        return str(value)
+    if isinstance(value, str) and value.strip().isdigit():
+        return value.strip()
+    errors.append(f"{path}: expected a whole number of items, got {_describe(value)}")
+    return value
+
+
+def _offset(text):
+    """Timezone of an ISO offset ('Z', '+02:00', '-0500'); None when there is none (local time)."""
+    if not text:
+        return None
+    if text == 'Z':
+        return datetime.timezone.utc
+    sign = -1 if text[0] == '-' else 1
+    hours, minutes = int(text[1:3]), int(text[-2:])
+    return datetime.timezone(sign * datetime.timedelta(hours=hours, minutes=minutes))
+
+
+def _parse_date(value, formats):
+    for pattern, order, timestamp in formats:
+        match = pattern.match(value)
+        if not match:
+            continue
+        parts = dict(zip(order, match.groups()))
+        try:
+            if not timestamp:
+                datetime.date(int(parts['year']), int(parts['month']), int(parts['day']))
+                return value
+            moment = datetime.datetime(int(parts['year']), int(parts['month']), int(parts['day']),
+                                       int(parts['hour']), int(parts['minute']), int(parts['second'] or 0),
+                                       tzinfo=_offset(parts['offset']))
+        except ValueError:
+            return None
+        if moment.tzinfo is not None:
+            moment = moment.astimezone(DOCUMENT_TIMEZONE)
+        return moment.strftime('%Y/%m/%d')
+    return None
+
+
+def _date_checker(formats, expected):
+    def check(value, path, errors):
+        if value is None or value == '':
+            return value
+        parsed = _parse_date(value.strip(), formats) if isinstance(value, str) else None
+        if parsed is None:
+            errors.append(f"{path}: expected a date as {expected}, got {_describe(value)}")
+            return value
+        return parsed
+    return check
+
+
+def _check_workers(value, path, errors):
+    if value in (None, '', 'auto') or isinstance(value, bool):
+        return value
+    if isinstance(value, int) and value >= 0:
+        return value
+    if isinstance(value, str) and value.strip().isdigit():
+        return value.strip()
+    errors.append(f"{path}: expected 'auto' or a number of processes, got {_describe(value)}")
+    return value
+
+
+def _check_product_sheets(value, path, errors):
+    if value in (None, '', 'all', 'auto'):
+        return value
+    if isinstance(value, list) and all(isinstance(title, str) for title in value):
+        return value
+    errors.append(f"{path}: expected 'all', 'auto' or a list of sheet titles, got {_describe(value)}")
+    return value
+
+
+CHECKERS = {
+    'scalar': _check_scalar,
+    # Flags go through the 'oui_non' formatter, which accepts any scalar
+    'flag': _check_scalar,
+    'labels': _check_labels,
+    'count': _check_count,
+    'date': _date_checker(DATE_FORMATS, 'YYYY/MM/DD, YYYY-MM-DD or DD/MM/YYYY'),
+    'date_dmy': _date_checker([DMY_FORMAT], 'DD/MM/YYYY'),
+    'workers': _check_workers,
+    'product_sheets': _check_product_sheets,
+}
+
+
+def _compile(spec):
+    """Compile a field type into a checker (value, path, errors) -> coerced value."""
+    if isinstance(spec, str):
+        return CHECKERS[spec]
+    if 'choice' in spec:
+        allowed = spec['choice']
+
+        def check_choice(value, path, errors):
+            if value not in (None, '') and value not in allowed:
+                errors.append(f"{path}: expected one of {allowed}, got {_describe(value)}")
+            return value
+        return check_choice
+    if 'list' in spec:
+        item = _compile(spec['list'])
+
+        def check_list(value, path, errors):
+            if value is None:
+                return value
+            if not isinstance(value, list):
+                errors.append(f"{path}: expected a list, got {type(value).__name__}")
+                return value
+            return [item(element, f"{path}[{index}]", errors) for index, element in enumerate(value)]
+        return check_list
+    if 'map' in spec:
+        item = _compile(spec['map'])
+
+        def check_map(value, path, errors):
+            if value is None:
+                return value
+            if not isinstance(value, dict):
+                errors.append(f"{path}: expected an object, got {type(value).__name__}")
+                return value
+            return {key: item(element, f"{path}[{key!r}]", errors) for key, element in value.items()}
+        return check_map
+    if 'object' in spec:
+        return _compile_object(spec['object'])
+    raise ValueError(f"Unknown payload field type {spec!r}")
+
+
+def _compile_object(schema):
+    fields = [(name, _compile(spec)) for name, spec in schema.items()]
+
+    def check_object(value, path, errors):
+        if not isinstance(value, dict):
+            errors.append(f"{path or 'payload'}: expected an object, got {type(value).__name__}")
+            return value
+        coerced = dict(value)
+        for name, check in fields:
+            if name in value:
+                coerced[name] = check(value[name], f"{path}.{name}" if path else name, errors)
+        return coerced
+
+    return check_object
+
+
+# Compiled once per process
+VALIDATORS = {kind: _compile_object(schema) for kind, schema in SCHEMAS.items()}
+
+
+def validate_payload(kind, payload):
+    """Return the coerced copy of `payload` for a `kind` processor, or raise PayloadError."""
+    errors = []
+    coerced = VALIDATORS[kind](payload, '', errors)
+    if errors:
+        raise PayloadError(kind, errors)
+    return coerced
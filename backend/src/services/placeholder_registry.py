@@ -0,0 +1,161 @@
+import json
+import os
+
+from content_rules import compile_rules
+
+# Declarative placeholder mappings shared by the DOCX/XLSX processors.
+#
+# Each file in placeholder_maps/ describes one template: which payload field fills each
+# placeholder (or cell), how the value is formatted and which fields to try when the first
+# one is empty. The files are compiled once, when this module is imported, into getter
+# functions; a render then resolves the whole substitution table from the shop payload in a
+# single pass.
+#
+# Entry syntax:
+#   {"field": "nomProjet"}                                  one payload field
+#   {"field": ["nomClient", "raisonSociale"]}               fallback chain, first non-empty wins
+#   {"field": [{"field": "clientName", "format": "first_segment"}, ...]}
+#                                                           per-field formatter inside the chain
+#   {"field": "precommande", "format": "oui_non", "default": "NON"}
+#   {"value": "CLIENT :"}                                   constant
+#
+# The chains list the canonical payload field first, then the names the older per-processor
+# payloads use, so both keep working.
+#
+# DOCX mappings can also carry "rules": conditional content (strike, hide or remove a clause)
+# compiled by content_rules.
+
+MAPS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'placeholder_maps')
+
+
+def _oui_non(value, _arg):
+    if isinstance(value, bool):
+        return 'OUI' if value else 'NON'
+    text = str(value).strip()
+    return text.upper() if text.upper() in ('OUI', 'NON') else text
+
+
+FORMATTERS = {
+    'oui_non': _oui_non,
+    'percent': lambda value, _arg: f"{value}%",
+    'prefix': lambda value, arg: f"{arg}{value}",
+    # 'CLIENT_PROJET' -> 'CLIENT' (folder style client names)
+    'first_segment': lambda value, _arg: str(value).split('_')[0],
+    # True when the value equals the argument, e.g. typeAbonnementShopify == 'mensuel'
+    'equals': lambda value, arg: str(value) == arg,
+}
+
+
+def _is_empty(value):
+    return value is None or value == ''
+
+
+def _compile_formatter(spec, where):
+    if not spec:
+        return None
+    name, _, arg = spec.partition(':')
+    if name not in FORMATTERS:
+        raise ValueError(f"{where}: unknown formatter '{name}', expected one of {sorted(FORMATTERS)}")
+    formatter = FORMATTERS[name]
+    return lambda value: formatter(value, arg)
+
+
+def _compile_entry(entry, where):
+    """Compile one mapping entry into a function payload -> str."""
+    if 'value' in entry:
+        constant = str(entry['value'])
+        return lambda payload: constant
+
+    fields = entry.get('field')
+    if isinstance(fields, (str, dict)):
+        fields = [fields]
+    if not fields:
+        raise ValueError(f"{where}: entry needs a 'field' or a 'value'")
+
+    chain = []
+    for field in fields:
+        if isinstance(field, dict):
+            chain.append((field['field'], _compile_formatter(field.get('format'), where)))
+        else:
+            chain.append((field, None))
+    formatter = _compile_formatter(entry.get('format'), where)
+    default = entry.get('default', '')
+
+    def resolve(payload):
+        for name, field_formatter in chain:
+            value = payload.get(name)
+            if _is_empty(value):
+                continue
+            if field_formatter:
+                value = field_formatter(value)
+            break
+        else:
+            return default
+        if formatter:
+            value = formatter(value)
+        return '' if value is None else str(value)
+
+    return resolve
+
+
+def _entry_fields(entry):
+    """Payload fields an entry reads, in fallback order (none for a constant)."""
+    fields = entry.get('field') or []
+    if isinstance(fields, (str, dict)):
+        fields = [fields]
+    return [field['field'] if isinstance(field, dict) else field for field in fields]
+
+
+def compile_mapping(spec, name='<inline>'):
+    """Compile a mapping description (the content of one placeholder_maps/*.json file)."""
+    return {
+        'name': name,
+        'kind': spec.get('kind'),
+        'default_for_kind': spec.get('default_for_kind', False),
+        'templates': list(spec.get('templates', [])),
+        'placeholders': [(key, _compile_entry(entry, f"{name}:{key}")) for key, entry in spec.get('placeholders', {}).items()],
+        'placeholder_fields': {key: _entry_fields(entry) for key, entry in spec.get('placeholders', {}).items()},
+        'cells': [(coordinate, _compile_entry(entry, f"{name}:{coordinate}")) for coordinate, entry in spec.get('cells', {}).items()],
+        'rules': compile_rules(spec.get('rules', []), name),
+    }
+
+
+def load_registry(maps_dir=MAPS_DIR):
+    """Compile every mapping file of `maps_dir`; return {'by_template': {...}, 'by_kind': {...}}."""
+    registry = {'by_template': {}, 'by_kind': {}}
+    for filename in sorted(os.listdir(maps_dir)):
+        if not filename.endswith('.json'):
+            continue
+        with open(os.path.join(maps_dir, filename), 'r', encoding='utf-8') as f:
+            mapping = compile_mapping(json.load(f), os.path.splitext(filename)[0])
+        for template in mapping['templates']:
+            registry['by_template'][template] = mapping
+        if mapping['default_for_kind']:
+            registry['by_kind'][mapping['kind']] = mapping
+    return registry
+
+
+# Compiled once per process
+REGISTRY = load_registry()
+
+
+def mapping_for(template_path, kind):
+    """Compiled mapping for the template at `template_path`, or the default mapping of `kind`."""
+    mapping = REGISTRY['by_template'].get(os.path.basename(template_path))
+    if mapping is None or mapping['kind'] != kind:
+        mapping = REGISTRY['by_kind'][kind]
+    return mapping
+
+
+def resolve_placeholders(mapping, payload, computed=None):
+    """Substitution table {placeholder: text} for `payload`, in mapping order."""
+    if computed:
+        payload = {**payload, **computed}
+    return {key: resolve(payload) for key, resolve in mapping['placeholders']}
+
+
+def resolve_cells(mapping, payload, computed=None):
+    """Cell values {coordinate: text} for `payload`, in mapping order."""
+    if computed:
+        payload = {**payload, **computed}
+    return {coordinate: resolve(payload) for coordinate, resolve in mapping['cells']}
@@ -0,0 +1,109 @@
+import re
+
+# Product field helpers shared by the merch workbook and the Shopify CSV export.
+# Pure Python on purpose: no openpyxl import, so streaming exports stay cheap.
+
+SIZES = ['XS', 'S', 'M', 'L', 'XL']
+
+
+def calculate_total_stock(stock_dict):
+    """Calculate total stock from stock dictionary"""
+    if not stock_dict:
+        return 0
+    return sum(int(value) for value in stock_dict.values() if str(value).isdigit())
+
+
+def calculate_size_stock(stock_dict, target_size):
+    """Calculate stock for a specific size regardless of color"""
+    if not stock_dict:
+        return 0
+
+    total = 0
+    for combination, stock in stock_dict.items():
+        if '-' in combination:
+            size, color = combination.split('-', 1)
+            if size == target_size and str(stock).isdigit():
+                total += int(stock)
+        elif combination == target_size and str(stock).isdigit():
+            total += int(stock)
+
+    return total
+
+
+def extract_product_fields(product):
+    """Normalize the field name variations of a product payload into one dict."""
+    # Handle different field name variations
+    type_produit = product.get('typeProduit', '') or product.get('type', '')
+    titre = product.get('titre', '') or product.get('title', '')
+
+    # Extract EAN from eans object first, then fallback to legacy fields
+    eans_obj = product.get('eans', {})
+    if eans_obj:
+        # Get the first available EAN from the eans object
+        code_ean = next((ean for ean in eans_obj.values() if ean), None)
+    else:
+        code_ean = None
+    if not code_ean:
+        code_ean = product.get('codeEAN', '') or product.get('ean', '') or product.get('codeBarres', '')
+
+    couleurs = product.get('couleurs', [])
+    tailles = product.get('tailles', [])
+
+    return {
+        'type_produit': type_produit,
+        'titre': titre,
+        'description': product.get('description', ''),
+        'code_ean': code_ean,
+        'eans': eans_obj or {},
+        'skus': product.get('skus', {}) or {},
+        'stock': product.get('stock', {}) or {},
+        'poids': product.get('poids', '') or product.get('weight', ''),
+        'prix': product.get('prix', '') or product.get('price', ''),
+        'occ': product.get('occ', False) or product.get('OCC', False),
+        'couleurs': couleurs,
+        'tailles': tailles,
+        # Format colors and sizes as comma-separated strings
+        'couleurs_str': ', '.join(couleurs) if isinstance(couleurs, list) else str(couleurs) if couleurs else '',
+        'tailles_str': ', '.join(tailles) if isinstance(tailles, list) else str(tailles) if tailles else '',
+        'image_urls': product.get('imageUrls', []),
+    }
+
+
+def iter_variants(fields):
+    """Yield (combination key, size, color) for every variant, using the keys of the product form
+    ("<size>-<color>", "<size>", "<color>" or "default")."""
+    tailles = [t for t in fields['tailles'] if t] if isinstance(fields['tailles'], list) else []
+    couleurs = [c for c in fields['couleurs'] if c] if isinstance(fields['couleurs'], list) else []
+
+    if tailles and couleurs:
+        for size in tailles:
+            for color in couleurs:
+                yield f"{size}-{color}", size, color
+    elif tailles:
+        for size in tailles:
+            yield size, size, None
+    elif couleurs:
+        for color in couleurs:
+            yield color, None, color
+    else:
+        yield 'default', None, None
+
+
+def parse_price(value):
+    """'25', '25,90', '25.90 €' -> '25.90'-style string; '' when not a number."""
+    cleaned = re.sub(r'[^\d,.]', '', str(value or '')).replace(',', '.')
+    try:
+        return f"{float(cleaned):.2f}"
+    except ValueError:
+        return ''
+
+
+def parse_weight_grams(value):
+    """'200', '200g', '200 g' (grams, the unit `poids` is stored in), '0,2 kg' -> 200;
+    None when not a number."""
+    text = str(value or '').strip().lower().replace(',', '.')
+    match = re.match(r'^(\d+(?:\.\d+)?)\s*(kg|g)?$', text)
+    if not match:
+        return None
+    number, unit = float(match.group(1)), match.group(2) or 'g'
+    return int(round(number if unit == 'g' else number * 1000))
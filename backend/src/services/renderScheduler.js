@@ -0,0 +1,380 @@
+/**
+ * Render Scheduler
+ * Runs the Python document processors (docx/xlsx/merch/template) behind priority queues
+ *
+ * - "interactive": single-product documentation triggered from the customer UI
+ * - "bulk": shop onboarding bundles generated by sharepointService
+ *
+ * Each class has its own concurrency cap and queue limit, so a burst of onboarding can
+ * never take every worker away from interactive requests. Jobs carry a deadline: a job
+ * still queued when it expires is dropped, a running one is stopped.
+ *
+ * Processors report progress on file descriptor 3 (one JSON event per line, see
+ * render_progress.py) and receive the deadline in $RENDER_DEADLINE_MS. A job can be
+ * cancelled with an AbortSignal (e.g. when the HTTP client disconnects): SIGTERM asks the
+ * processor to stop at its next safe point and remove its partial output, SIGKILL follows
+ * after a grace period.
+ *
+ * Processors are started through render_job.py, which validates the payload against the
+ * processor's schema before anything heavy is imported: an invalid payload is rejected with
+ * RENDER_INVALID_PAYLOAD and the list of errors, without loading the template.
+ *
+ * Jobs are given as [templatePath, encodedPayload, outputPath]. The payload goes to the
+ * processor on its stdin, never on the command line: Linux caps a single argument at 128 KB,
+ * which a catalog of a few hundred products already exceeds.
+ */
+
+const { spawn } = require('child_process');
+const os = require('os');
+const path = require('path');
+const { logger } = require('../utils/secureLogger');
+
+const cpuCount = Math.max(1, os.cpus().length);
+
+const envInt = (name, fallback) => {
+  const value = parseInt(process.env[name], 10);
+  return Number.isFinite(value) && value >= 0 ? value : fallback;
+};
+
+// Interactive jobs are served first when a slot frees up; bulk jobs leave at least one core free
+const DEFAULT_CLASSES = {
+  interactive: {
+    concurrency: envInt('RENDER_INTERACTIVE_CONCURRENCY', Math.max(1, Math.ceil(cpuCount / 2))),
+    maxQueue: envInt('RENDER_INTERACTIVE_MAX_QUEUE', 20),
+    deadlineMs: envInt('RENDER_INTERACTIVE_DEADLINE_MS', 30 * 1000),
+  },
+  bulk: {
+    concurrency: envInt('RENDER_BULK_CONCURRENCY', Math.max(1, cpuCount - 1)),
+    maxQueue: envInt('RENDER_BULK_MAX_QUEUE', 200),
+    deadlineMs: envInt('RENDER_BULK_DEADLINE_MS', 5 * 60 * 1000),
+  },
+};
+
+const PRIORITY_ORDER = ['interactive', 'bulk'];
+
+// Number of recent jobs kept per class for the wait/run time percentiles
+const SAMPLE_SIZE = 500;
+
+// Grace period between SIGTERM and SIGKILL when a running job is stopped
+const KILL_GRACE_MS = 2000;
+
+// Exit code of a processor that stopped on a cancel request or its deadline (render_progress.py)
+const EXIT_CANCELLED = 3;
+
+// File descriptor of the progress channel in the processor
+const PROGRESS_FD = 3;
+
+// Position of the base64 payload in a job's arguments, and what replaces it on the command
+// line: render_job.py then reads the payload from stdin
+const PAYLOAD_ARG_INDEX = 1;
+const STDIN_PAYLOAD = '-';
+
+// Exit code and stderr line of a payload rejected by render_job.py (payload_schema.py)
+const EXIT_INVALID_PAYLOAD = 4;
+const PAYLOAD_INVALID_PREFIX = 'PAYLOAD_INVALID ';
+
+class RenderSchedulerError extends Error {
+  constructor(message, code) {
+    super(message);
+    this.name = 'RenderSchedulerError';
+    this.code = code;
+  }
+}
+
+const percentile = (sortedValues, p) => {
+  if (sortedValues.length === 0) return 0;
+  const index = Math.min(sortedValues.length - 1, Math.ceil((p / 100) * sortedValues.length) - 1);
+  return sortedValues[Math.max(0, index)];
+};
+
+class RenderScheduler {
+  constructor(classes = DEFAULT_CLASSES, { pythonBin = 'python3', servicesDir = __dirname } = {}) {
+    this.pythonBin = pythonBin;
+    this.servicesDir = servicesDir;
+    this.classes = {};
+
+    for (const [name, config] of Object.entries(classes)) {
+      this.classes[name] = {
+        ...config,
+        queue: [],
+        running: 0,
+        active: new Set(),
+        stats: { completed: 0, failed: 0, rejected: 0, timedOut: 0, cancelled: 0, invalid: 0 },
+        waitSamples: [],
+        runSamples: [],
+      };
+    }
+  }
+
+  /**
+   * Queue a processor run and resolve with { stdout, stderr, waitMs, runMs, progress } once it exits with code 0
+   *
+   * `args` are [templatePath, encodedPayload, outputPath]; the payload is piped to the processor.
+   *
+   * `onProgress(event, progress)` receives each progress event of the processor along with the
+   * job's progress so far; aborting `signal` cancels the job, queued or running.
+   */
+  run(script, args, { priority = 'bulk', deadlineMs, label = script, signal, onProgress } = {}) {
+    const klass = this.classes[priority];
+    if (!klass) {
+      return Promise.reject(new RenderSchedulerError(`Unknown render priority: ${priority}`, 'RENDER_BAD_PRIORITY'));
+    }
+    if (signal?.aborted) {
+      return Promise.reject(new RenderSchedulerError(`${label} cancelled before it was queued`, 'RENDER_CANCELLED'));
+    }
+
+    if (klass.queue.length >= klass.maxQueue) {
+      klass.stats.rejected += 1;
+      logger.warn(`Render queue "${priority}" full (${klass.queue.length} waiting), rejecting ${label}`);
+      return Promise.reject(new RenderSchedulerError(
+        `Render queue "${priority}" is overloaded, try again later`,
+        'RENDER_OVERLOADED'
+      ));
+    }
+
+    return new Promise((resolve, reject) => {
+      const job = {
+        script,
+        args,
+        label,
+        priority,
+        enqueuedAt: Date.now(),
+        deadline: Date.now() + (deadlineMs ?? klass.deadlineMs),
+        onProgress,
+        progress: {},
+        resolve,
+        reject,
+      };
+
+      if (signal) {
+        job.abort = () => this._cancel(klass, job);
+        signal.addEventListener('abort', job.abort, { once: true });
+        job.detach = () => signal.removeEventListener('abort', job.abort);
+      }
+
+      // Drop the job if its deadline passes while it is still waiting
+      job.queueTimer = setTimeout(() => {
+        const index = klass.queue.indexOf(job);
+        if (index !== -1) {
+          klass.queue.splice(index, 1);
+          klass.stats.timedOut += 1;
+          if (job.detach) job.detach();
+          reject(new RenderSchedulerError(`${label} expired after waiting in the "${priority}" queue`, 'RENDER_DEADLINE_EXCEEDED'));
+        }
+      }, job.deadline - Date.now());
+
+      klass.queue.push(job);
+      this._dispatch();
+    });
+  }
+
+  _dispatch() {
+    for (const priority of PRIORITY_ORDER) {
+      const klass = this.classes[priority];
+      if (!klass) continue;
+      while (klass.running < klass.concurrency && klass.queue.length > 0) {
+        const job = klass.queue.shift();
+        clearTimeout(job.queueTimer);
+        this._start(klass, job);
+      }
+    }
+  }
+
+  _cancel(klass, job) {
+    const index = klass.queue.indexOf(job);
+    if (index !== -1) {
+      klass.queue.splice(index, 1);
+      clearTimeout(job.queueTimer);
+      klass.stats.cancelled += 1;
+      job.reject(new RenderSchedulerError(`${job.label} cancelled while waiting in the "${job.priority}" queue`, 'RENDER_CANCELLED'));
+    } else if (job.stop) {
+      logger.warn(`Render ${job.label} cancelled, stopping`);
+      job.stop('cancelled');
+    }
+  }
+
+  _progress(job, line) {
+    let event;
+    try {
+      event = JSON.parse(line);
+    } catch (error) {
+      return;
+    }
+    const { progress } = job;
+    if (event.event === 'phase') progress.phase = event.phase;
+    else if (event.event === 'done' || event.event === 'cancelled') progress.phase = event.event;
+    else if (event.event === 'products') progress.products = { written: event.written, total: event.total, sheet: event.sheet };
+    else if (event.event === 'sheets') progress.sheets = { written: event.written, total: event.total };
+    else if (event.event === 'saved') progress.saved = { bytes: event.bytes, total: event.total };
+    progress.elapsedMs = event.elapsed_ms;
+
+    if (job.onProgress) {
+      try {
+        job.onProgress(event, progress);
+      } catch (error) {
+        logger.warn(`Render ${job.label} progress callback failed: ${error.message}`);
+      }
+    }
+  }
+
+  _start(klass, job) {
+    klass.running += 1;
+    klass.active.add(job);
+    const startedAt = Date.now();
+    job.startedAt = startedAt;
+    const waitMs = startedAt - job.enqueuedAt;
+    this._sample(klass.waitSamples, waitMs);
+
+    const args = [...job.args];
+    const payload = args[PAYLOAD_ARG_INDEX];
+    args[PAYLOAD_ARG_INDEX] = STDIN_PAYLOAD;
+
+    // SECURITY: spawn with array arguments, no shell
+    const child = spawn(this.pythonBin, [path.join(this.servicesDir, 'render_job.py'), job.script, ...args], {
+      stdio: ['pipe', 'pipe', 'pipe', 'pipe'],
+      env: { ...process.env, RENDER_PROGRESS_FD: String(PROGRESS_FD), RENDER_DEADLINE_MS: String(job.deadline) },
+      shell: false,
+    });
+    // A processor that exits before reading its payload (killed, failed to start) closes the
+    // pipe: the exit code reports the failure, not EPIPE
+    child.stdin.on('error', (error) => {
+      if (error.code !== 'EPIPE') logger.warn(`Render ${job.label} payload not delivered: ${error.message}`);
+    });
+    child.stdin.end(payload);
+
+    let stdout = '';
+    let stderr = '';
+    let progressBuffer = '';
+    let stopReason = null;
+    let settled = false;
+
+    child.stdout.on('data', (data) => { stdout += data.toString(); });
+    child.stderr.on('data', (data) => { stderr += data.toString(); });
+    child.stdio[PROGRESS_FD].on('data', (data) => {
+      const lines = (progressBuffer + data.toString()).split('\n');
+      progressBuffer = lines.pop();
+      lines.forEach((line) => this._progress(job, line));
+    });
+
+    // SIGTERM lets the processor stop at its next checkpoint and clean up, SIGKILL if it does not
+    job.stop = (reason) => {
+      if (stopReason) return;
+      stopReason = reason;
+      child.kill('SIGTERM');
+      setTimeout(() => child.kill('SIGKILL'), KILL_GRACE_MS).unref();
+    };
+
+    const deadlineTimer = setTimeout(() => {
+      logger.warn(`Render ${job.label} exceeded its deadline, terminating`);
+      job.stop('deadline');
+    }, Math.max(0, job.deadline - startedAt));
+
+    const finish = (error) => {
+      if (settled) return;
+      settled = true;
+      clearTimeout(deadlineTimer);
+      if (job.detach) job.detach();
+      klass.running -= 1;
+      klass.active.delete(job);
+      const runMs = Date.now() - startedAt;
+      this._sample(klass.runSamples, runMs);
+
+      if (error) {
+        const outcome = error.code === 'RENDER_INVALID_PAYLOAD' ? 'invalid' : { deadline: 'timedOut', cancelled: 'cancelled' }[stopReason];
+        klass.stats[outcome || 'failed'] += 1;
+        error.stdout = stdout;
+        error.stderr = stderr;
+        error.progress = job.progress;
+        job.reject(error);
+      } else {
+        klass.stats.completed += 1;
+        job.resolve({ stdout, stderr, waitMs, runMs, progress: job.progress });
+      }
+      this._dispatch();
+    };
+
+    child.on('error', (error) => finish(error));
+    child.on('close', (code, signal) => {
+      // The processor also stops by itself once $RENDER_DEADLINE_MS has passed
+      if (code === EXIT_CANCELLED && !stopReason) stopReason = 'deadline';
+
+      if (stopReason === 'cancelled') {
+        finish(new RenderSchedulerError(`${job.label} cancelled while running`, 'RENDER_CANCELLED'));
+      } else if (stopReason === 'deadline') {
+        finish(new RenderSchedulerError(`${job.label} stopped after exceeding its deadline`, 'RENDER_DEADLINE_EXCEEDED'));
+      } else if (code === EXIT_INVALID_PAYLOAD) {
+        const line = stderr.split('\n').find((entry) => entry.startsWith(PAYLOAD_INVALID_PREFIX));
+        const error = new RenderSchedulerError(`${job.label} rejected: invalid payload`, 'RENDER_INVALID_PAYLOAD');
+        try {
+          error.errors = line ? JSON.parse(line.slice(PAYLOAD_INVALID_PREFIX.length)) : [];
+        } catch (parseError) {
+          error.errors = [];
+        }
+        if (error.errors.length > 0) error.message += `: ${error.errors.slice(0, 5).join('; ')}`;
+        finish(error);
+      } else if (code !== 0) {
+        finish(new Error(`Python process ${job.label} exited with code ${code}${signal ? ` (${signal})` : ''}`));
+      } else {
+        finish(null);
+      }
+    });
+  }
+
+  _sample(samples, value) {
+    samples.push(value);
+    if (samples.length > SAMPLE_SIZE) samples.shift();
+  }
+
+  /**
+   * Queue depth, concurrency and wait/run time percentiles for every priority class
+   */
+  getStats() {
+    const stats = {};
+    for (const [name, klass] of Object.entries(this.classes)) {
+      const waits = [...klass.waitSamples].sort((a, b) => a - b);
+      const runs = [...klass.runSamples].sort((a, b) => a - b);
+      stats[name] = {
+        queued: klass.queue.length,
+        running: klass.running,
+        concurrency: klass.concurrency,
+        maxQueue: klass.maxQueue,
+        ...klass.stats,
+        waitMs: { p50: percentile(waits, 50), p95: percentile(waits, 95), max: waits[waits.length - 1] || 0 },
+        runMs: { p50: percentile(runs, 50), p95: percentile(runs, 95), max: runs[runs.length - 1] || 0 },
+        active: [...klass.active].map((job) => ({
+          label: job.label,
+          runMs: Date.now() - job.startedAt,
+          ...job.progress,
+        })),
+      };
+    }
+    return stats;
+  }
+}
+
+// Shared instance for the whole backend process
+const renderScheduler = new RenderScheduler();
+
+const runPythonProcessor = (script, args, options) => renderScheduler.run(script, args, options);
+const getRenderStats = () => renderScheduler.getStats();
+
+/**
+ * AbortSignal aborted when the client of `res` disconnects before the response is sent,
+ * so the renders started for that request stop instead of running for nobody
+ */
+const abortSignalForRequest = (res) => {
+  const controller = new AbortController();
+  res.on('close', () => {
+    if (!res.writableEnded) controller.abort();
+  });
+  return controller.signal;
+};
+
+module.exports = {
+  RenderScheduler,
+  RenderSchedulerError,
+  renderScheduler,
+  runPythonProcessor,
+  getRenderStats,
+  abortSignalForRequest,
+};
@@ -0,0 +1,120 @@
+import os
+import re
+import zipfile
+
+# Engine selection for the document processors.
+#
+# One product or a 21-cell D2C row and a catalog of thousands of products do not have the
+# same best strategy. Before loading anything, a processor takes a few cheap measurements of
+# the job (product count, sizes of the template parts read from the zip directory, number of
+# placeholders found in the raw parts) and picks one of its engines:
+#   object     the template loaded in openpyxl / python-docx and edited in place
+#   xml_patch  the cell work done on the serialized worksheet parts (see worksheet_workers)
+#   streaming  the product rows written as XML by a process pool (see merch_sheet_shards)
+#
+# The payload option `renderEngine` (or $RENDER_ENGINE) forces an engine, 'auto' (default)
+# lets the processor choose. The chosen engine and the reason are logged with every job.
+# Every engine other than 'object' is checked against it by render_equivalence.
+
+ENGINES = ('object', 'xml_patch', 'streaming')
+
+# Engines each processor implements, the first one is the reference
+PROCESSOR_ENGINES = {
+    'docx': ('object',),
+    'd2c': ('object',),
+    'xlsx': ('object', 'xml_patch'),
+    'merch': ('object', 'xml_patch', 'streaming'),
+}
+
+# From this many products the rows are split over several processes. Real jobs get there:
+# the scheduler pipes the payload to render_job.py on stdin, so its size is not bounded by
+# the 128 KB a single command line argument can carry (about 130 products)
+STREAMING_MIN_PRODUCTS = 1000
+
+# Below this much worksheet XML the parts are patched inline: starting a pool costs more
+PARALLEL_MIN_SHEET_BYTES = 512 * 1024
+
+# Below this much worksheet XML the object model costs about the same as a patch
+SMALL_SHEET_BYTES = 16 * 1024
+
+WORKSHEET_PART = re.compile(r'^xl/worksheets/sheet\d+\.xml$')
+
+
+def measure_template(template_path, placeholders=()):
+    """Cheap measurements of a template: part sizes from the zip directory and, when
+    `placeholders` are given, how many of them appear in the raw worksheet and string parts."""
+    measurements = {'template_bytes': os.path.getsize(template_path)}
+    with zipfile.ZipFile(template_path) as archive:
+        infos = archive.infolist()
+        sheets = [info for info in infos if WORKSHEET_PART.match(info.filename)]
+        measurements['sheet_count'] = len(sheets)
+        measurements['sheet_xml_bytes'] = sum(info.file_size for info in sheets)
+        measurements['document_xml_bytes'] = sum(info.file_size for info in infos if info.filename == 'word/document.xml')
+        if placeholders:
+            # Raw bytes, no parse: a placeholder split by markup is not counted, which only
+            # makes the estimate low
+            parts = sheets + [info for info in infos if info.filename == 'xl/sharedStrings.xml']
+            found = 0
+            for info in parts:
+                data = archive.read(info).decode('utf-8', errors='ignore')
+                found += sum(data.count(placeholder) for placeholder in placeholders)
+            measurements['placeholders_found'] = found
+    return measurements
+
+
+def _auto_xlsx(m):
+    if m.get('placeholders_found') == 0:
+        return 'xml_patch', "no placeholder in the raw template parts: worksheet parts kept as written"
+    if m['sheet_xml_bytes'] < SMALL_SHEET_BYTES:
+        return 'object', f"{m['sheet_xml_bytes'] // 1024} KB of worksheet XML: the object model is as cheap as a patch"
+    return 'xml_patch', (f"{m.get('placeholders_found', '?')} placeholder(s) in {m['sheet_count']} sheet(s), "
+                         f"{m['sheet_xml_bytes'] // 1024} KB of worksheet XML: parts patched directly")
+
+
+def _auto_merch(m):
+    if m.get('append_mode'):
+        return 'object', "append mode edits an existing workbook in place"
+    if m['products'] >= STREAMING_MIN_PRODUCTS:
+        return 'streaming', f"{m['products']} products (>= {STREAMING_MIN_PRODUCTS}): product rows rendered in shards"
+    return 'xml_patch', (f"{m['products']} product(s), {m['sheet_count']} sheet(s), "
+                         f"{m['sheet_xml_bytes'] // 1024} KB of worksheet XML: parts patched directly")
+
+
+AUTO_RULES = {
+    'docx': lambda m: ('object', "python-docx is the only engine for documents"),
+    'd2c': lambda m: ('object', "a single row of mapped cells: object model"),
+    'xlsx': _auto_xlsx,
+    'merch': _auto_merch,
+}
+
+
+def choose_engine(kind, requested, measurements):
+    """Return (engine, reason) for a `kind` processor job.
+
+    `requested` is the payload `renderEngine` option; empty falls back to $RENDER_ENGINE,
+    then to 'auto'.
+    """
+    requested = requested or os.environ.get('RENDER_ENGINE') or 'auto'
+    if requested == 'auto':
+        return AUTO_RULES[kind](measurements)
+    if requested not in ENGINES:
+        raise ValueError(f"Unknown render engine '{requested}', expected 'auto' or one of {ENGINES}")
+    if requested not in PROCESSOR_ENGINES[kind]:
+        engine = PROCESSOR_ENGINES[kind][0]
+        return engine, f"'{requested}' requested but not implemented for {kind}, using '{engine}'"
+    return requested, f"'{requested}' requested"
+
+
+def pool_workers(option, env_name, measurements):
+    """Worker option for a parallel engine: the payload option, else $`env_name`, else one
+    process per core, or a single inline worker when the worksheet XML is too small to be
+    worth a process pool."""
+    option = option if option not in (None, '') else os.environ.get(env_name, '')
+    if option not in (None, ''):
+        return option
+    return 'auto' if measurements['sheet_xml_bytes'] >= PARALLEL_MIN_SHEET_BYTES else 1
+
+
+def format_engine(engine, reason, measurements):
+    shown = ', '.join(f"{key}={value}" for key, value in measurements.items())
+    return f"Render engine: {engine} ({reason}) [{shown}]"
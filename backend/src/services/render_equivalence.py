@@ -0,0 +1,478 @@
+import argparse
+import datetime
+import json
+import os
+import random
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import zipfile
+
+from lxml import etree
+
+from merch_sheet_shards import MIN_SHARD_PRODUCTS
+from render_load_test import SERVICES_DIR, TEMPLATES, make_shop, template_d2c_payload
+
+# Differential equivalence harness for the processor fast paths.
+#
+# A fast path (sharded rows, warm template snapshots, another save profile, later direct XML
+# patching...) only ships once it renders exactly what the reference path renders. Every case
+# of the corpus is rendered through the reference path (fast paths off, template parsed from
+# scratch) and through each fast path that applies to its processor; both outputs are
+# normalized and compared. A fast path that falls back to the reference path (too few products
+# for a shard, no worker...) would trivially match: its run must print the log line proving
+# it was taken, otherwise the result is "fast path not taken", not a pass.
+#
+#   XLSX  sheet list, cell values and data types, cell styles (font, fill, border, alignment,
+#         number format, protection), merged cells, row heights and column widths
+#   DOCX  paragraph text of every story part and run formatting, adjacent runs with the same
+#         properties merged, so a different run split of the same text is not a mismatch
+#
+#   python render_equivalence.py --repeat 3 --large-products 2000
+#
+# The report (JSON + Markdown) lists, per case and fast path, both render times, the speedup
+# and the mismatches. The exit code is 1 as soon as one fast path differs from the reference
+# or was not taken.
+
+PROCESSORS = {
+    'docx_processor.py': ('docx_processor', 'replace_placeholders_and_format'),
+    'xlsx_processor.py': ('xlsx_processor', 'replace_placeholders_in_xlsx'),
+    'merch_xlsx_processor.py': ('merch_xlsx_processor', 'process_merch_xlsx'),
+    'template_processor.py': ('template_processor', 'process_template_xlsx'),
+}
+
+# Runs one processor function in a fresh interpreter, as the render scheduler does, and prints
+# the render time (imports excluded). The payload is read from a file: large catalogs do not
+# fit in one command line argument.
+DRIVER = '''
+import importlib, json, sys, time
+module, function, template, payload_path, output_path = sys.argv[1:6]
+with open(payload_path, encoding='utf-8') as f:
+    payload = json.load(f)
+render = getattr(importlib.import_module(module), function)
+started = time.perf_counter()
+render(template, payload, output_path)
+print(f"EQUIVALENCE_SECONDS {time.perf_counter() - started}")
+'''
+
+# Fast paths under test. `payload` and `env` switch the path on; `warm_cache` renders from a
+# template snapshot primed by a first run instead of parsing the template. `taken` matches the
+# processor log line showing the fast path ran (None: always taken); `min_products` skips the
+# cases it cannot apply to.
+FAST_PATHS = {
+    'merch_sharded_rows': {
+        'description': "product rows rendered as XML by a process pool (the 'streaming' engine)",
+        'scripts': ['merch_xlsx_processor.py'],
+        'payload': {'renderEngine': 'streaming', 'renderShards': 'auto'},
+        'env': {},
+        'taken': re.compile(r'Rendered \d+ product rows in \d+ shard'),
+        'min_products': MIN_SHARD_PRODUCTS,
+    },
+    'sheet_workers': {
+        'description': "each worksheet part rewritten by its own worker (the 'xml_patch' engine)",
+        'scripts': ['xlsx_processor.py', 'merch_xlsx_processor.py'],
+        'payload': {'renderEngine': 'xml_patch', 'sheetWorkers': 'auto'},
+        'env': {},
+        'taken': re.compile(r'Per-sheet processing on \d+ process'),
+    },
+    'auto_engine': {
+        'description': 'engine picked from the template and payload measurements (render_engines)',
+        'scripts': list(PROCESSORS),
+        'payload': {'renderEngine': 'auto'},
+        'env': {},
+        'taken': None,
+    },
+    'template_snapshot': {
+        'description': 'workbook unpickled from a warm template snapshot',
+        'scripts': ['xlsx_processor.py', 'merch_xlsx_processor.py', 'template_processor.py'],
+        'payload': {},
+        'env': {},
+        'warm_cache': True,
+        'taken': re.compile(r'\(from (memory|disk)\)'),
+    },
+    'save_profile_fast': {
+        'description': "archive saved with the 'fast' save profile",
+        'scripts': list(PROCESSORS),
+        'payload': {'saveProfile': 'fast'},
+        'env': {},
+        'taken': re.compile(r"profile 'fast'"),
+    },
+}
+
+# Engine line every processor logs (render_engines.format_engine)
+ENGINE_LINE = re.compile(r'Render engine: (\w+) \((.*?)\) \[')
+
+# The reference path: every fast path switched off
+REFERENCE_ENV = {'RENDER_ENGINE': 'object', 'MERCH_RENDER_SHARDS': '', 'XLSX_SHEET_WORKERS': '',
+                 'DOCUMENT_SAVE_PROFILE': ''}
+
+W_NS = 'http://schemas.openxmlformats.org/wordprocessingml/2006/main'
+DOCX_STORY_PART = re.compile(r'^word/(document|header\d*|footer\d*|footnotes|endnotes)\.xml$')
+
+# Revision ids change with every edit session and say nothing about the rendering
+IGNORED_ATTRIBUTES = re.compile(r'rsid', re.IGNORECASE)
+
+# Mismatches kept per comparison
+MAX_MISMATCHES = 20
+
+
+def build_corpus(rng, small_products, large_products):
+    """Return the list of cases: {'name', 'script', 'template', 'payload'}."""
+    shop = make_shop(rng, 1, small_products)
+    docx_shop = {key: value for key, value in shop.items() if key != 'products'}
+    cases = [
+        {'name': 'web_design', 'script': 'docx_processor.py', 'template': TEMPLATES['web_design'], 'payload': docx_shop},
+        {'name': 'template_d2c', 'script': 'template_processor.py', 'template': TEMPLATES['template_d2c'],
+         'payload': template_d2c_payload(shop)},
+        {'name': 'xlsx_fiches_produits', 'script': 'xlsx_processor.py', 'template': TEMPLATES['fiches_produits'],
+         'payload': docx_shop},
+        {'name': 'web_merch', 'script': 'merch_xlsx_processor.py', 'template': TEMPLATES['web_merch'], 'payload': shop},
+        {'name': 'web_merch_product_sheets_auto', 'script': 'merch_xlsx_processor.py', 'template': TEMPLATES['web_merch'],
+         'payload': dict(shop, productSheets='auto')},
+        {'name': 'fiches_produits_single', 'script': 'merch_xlsx_processor.py', 'template': TEMPLATES['fiches_produits'],
+         'payload': dict(make_shop(rng, 2, 1), appendMode=False)},
+    ]
+    # Contract clauses depend on the subscription and the shipping modules
+    for abonnement in ('mensuel', 'annuel', ''):
+        cases.append({
+            'name': f"fiche_projet_{abonnement or 'sans_abonnement'}",
+            'script': 'docx_processor.py',
+            'template': TEMPLATES['fiche_projet'],
+            'payload': dict(docx_shop, typeAbonnementShopify=abonnement,
+                            moduleMondialRelay=abonnement == 'mensuel', moduleDelivengo=abonnement == 'annuel'),
+        })
+    if large_products:
+        cases.append({'name': f'web_merch_{large_products}', 'script': 'merch_xlsx_processor.py',
+                      'template': TEMPLATES['web_merch'], 'payload': make_shop(rng, 3, large_products)})
+    return cases
+
+
+def run_render(case, payload, output_path, env_overrides, cache_dir):
+    """Render `case` with `payload` in a fresh interpreter; return (render time in seconds, stdout)."""
+    module, function = PROCESSORS[case['script']]
+    payload_path = output_path + '.payload.json'
+    with open(payload_path, 'w', encoding='utf-8') as f:
+        json.dump(payload, f, ensure_ascii=False)
+    env = dict(os.environ, **REFERENCE_ENV, **env_overrides, XLSX_TEMPLATE_CACHE_DIR=cache_dir)
+    try:
+        completed = subprocess.run(
+            [sys.executable, '-c', DRIVER, module, function, case['template'], payload_path, output_path],
+            cwd=SERVICES_DIR, env=env, capture_output=True, text=True,
+        )
+    finally:
+        os.remove(payload_path)
+    if completed.returncode != 0:
+        raise RuntimeError(f"{case['name']}: {case['script']} failed: {completed.stderr.strip()[-2000:]}")
+    for line in reversed(completed.stdout.splitlines()):
+        if line.startswith('EQUIVALENCE_SECONDS '):
+            return float(line.split()[1]), completed.stdout
+    raise RuntimeError(f"{case['name']}: no render time in the processor output")
+
+
+def render_variant(case, work_dir, label, payload_overrides, env_overrides, warm_cache, repeat):
+    """Render `case` `repeat` times; return (path of the first output, median render time,
+    processor output of the first render)."""
+    # A new cache directory per variant: the reference always parses the template, a warm
+    # variant primes the snapshot with one untimed render first
+    cache_dir = tempfile.mkdtemp(prefix=f'{label}-cache-', dir=work_dir)
+    payload = dict(case['payload'], **payload_overrides)
+    if warm_cache:
+        prime_path = os.path.join(work_dir, f"{case['name']}.{label}.prime{os.path.splitext(case['template'])[1]}")
+        run_render(case, payload, prime_path, env_overrides, cache_dir)
+        os.remove(prime_path)
+
+    extension = os.path.splitext(case['template'])[1]
+    first_output = os.path.join(work_dir, f"{case['name']}.{label}{extension}")
+    timings = []
+    first_stdout = ''
+    for attempt in range(repeat):
+        output_path = first_output if attempt == 0 else os.path.join(work_dir, f"{case['name']}.{label}.{attempt}{extension}")
+        if not warm_cache:
+            for name in os.listdir(cache_dir):
+                os.remove(os.path.join(cache_dir, name))
+        seconds, stdout = run_render(case, payload, output_path, env_overrides, cache_dir)
+        timings.append(seconds)
+        if attempt:
+            os.remove(output_path)
+        else:
+            first_stdout = stdout
+    return first_output, statistics.median(timings), first_stdout
+
+
+def fast_path_taken(spec, stdout):
+    """Return (whether the fast path of `spec` ran, the engine line of the render or None)."""
+    engine = ENGINE_LINE.search(stdout)
+    engine_line = f"{engine.group(1)} ({engine.group(2)})" if engine else None
+    return spec['taken'] is None or bool(spec['taken'].search(stdout)), engine_line
+
+
+def applies(spec, case):
+    if case['script'] not in spec['scripts']:
+        return False
+    return len(case['payload'].get('products') or []) >= spec.get('min_products', 0)
+
+
+# --- Normalization -----------------------------------------------------------------------
+
+
+def _style_signature(cell):
+    return repr((cell.font, cell.fill, cell.border, cell.alignment, cell.number_format, cell.protection))
+
+
+def normalize_xlsx(path):
+    """Comparable content of a workbook: {sheet title: {...}} in sheet order."""
+    from openpyxl import load_workbook
+
+    workbook = load_workbook(path)
+    sheets = {}
+    for worksheet in workbook.worksheets:
+        signatures = {}
+        cells = {}
+        for (row, col), cell in sorted(worksheet._cells.items()):
+            key = tuple(cell._style) if cell._style is not None else None
+            if key not in signatures:
+                signatures[key] = _style_signature(cell)
+            # Empty cells without a style of their own are the same as no cell at all
+            if cell.value is None and (key is None or not any(key)):
+                continue
+            cells[cell.coordinate] = (repr(cell.value), cell.data_type, signatures[key])
+        sheets[worksheet.title] = {
+            'cells': cells,
+            'merged': sorted(str(merged) for merged in worksheet.merged_cells.ranges),
+            'row_heights': {row: dim.height for row, dim in worksheet.row_dimensions.items() if dim.height is not None},
+            'column_widths': {col: dim.width for col, dim in worksheet.column_dimensions.items() if dim.customWidth},
+        }
+    workbook.close()
+    return sheets
+
+
+def _canonical(element):
+    """Properties element (w:rPr, w:pPr) as a string, child order and revision ids ignored."""
+    if element is None:
+        return ''
+    children = []
+    for child in element:
+        if not isinstance(child.tag, str):
+            continue
+        attributes = sorted((etree.QName(name).localname, value) for name, value in child.attrib.items()
+                            if not IGNORED_ATTRIBUTES.search(name))
+        nested = _canonical(child) if len(child) else ''
+        children.append(f"{etree.QName(child).localname}{attributes}{nested}")
+    return '{' + ';'.join(sorted(children)) + '}'
+
+
+def _paragraph_segments(p):
+    """(text, formatting) segments of a paragraph, adjacent runs with equal formatting merged."""
+    segments = []
+    for r in p.iter(f'{{{W_NS}}}r'):
+        text = ''.join(
+            node.text or '' if node.tag == f'{{{W_NS}}}t' else '\t' if node.tag == f'{{{W_NS}}}tab' else '\n'
+            for node in r if node.tag in (f'{{{W_NS}}}t', f'{{{W_NS}}}tab', f'{{{W_NS}}}br')
+        )
+        if not text:
+            continue
+        formatting = _canonical(r.find(f'{{{W_NS}}}rPr'))
+        if segments and segments[-1][1] == formatting:
+            segments[-1] = (segments[-1][0] + text, formatting)
+        else:
+            segments.append((text, formatting))
+    return segments
+
+
+def normalize_docx(path):
+    """Comparable content of a document: {story part: [paragraphs]} with text and formatting."""
+    parts = {}
+    with zipfile.ZipFile(path) as archive:
+        for name in sorted(archive.namelist()):
+            if not DOCX_STORY_PART.match(name):
+                continue
+            root = etree.fromstring(archive.read(name))
+            paragraphs = []
+            for p in root.iter(f'{{{W_NS}}}p'):
+                segments = _paragraph_segments(p)
+                paragraphs.append({
+                    'text': ''.join(text for text, _ in segments),
+                    'properties': _canonical(p.find(f'{{{W_NS}}}pPr')),
+                    'segments': segments,
+                })
+            parts[name] = paragraphs
+    return parts
+
+
+def compare_xlsx(reference, candidate):
+    mismatches = []
+    if list(reference) != list(candidate):
+        mismatches.append(f"sheets: {list(reference)} != {list(candidate)}")
+    for title in reference:
+        if title not in candidate:
+            continue
+        ref_sheet, cand_sheet = reference[title], candidate[title]
+        for key in ('merged', 'row_heights', 'column_widths'):
+            if ref_sheet[key] != cand_sheet[key]:
+                mismatches.append(f"{title}: {key} differ")
+        ref_cells, cand_cells = ref_sheet['cells'], cand_sheet['cells']
+        for coordinate in sorted(set(ref_cells) | set(cand_cells)):
+            expected, actual = ref_cells.get(coordinate), cand_cells.get(coordinate)
+            if expected == actual:
+                continue
+            if expected is None or actual is None:
+                mismatches.append(f"{title}!{coordinate}: {'missing' if actual is None else 'extra'} cell")
+            elif expected[:2] != actual[:2]:
+                mismatches.append(f"{title}!{coordinate}: value {expected[0]} ({expected[1]}) != {actual[0]} ({actual[1]})")
+            else:
+                mismatches.append(f"{title}!{coordinate}: style differs")
+    return mismatches
+
+
+def compare_docx(reference, candidate):
+    mismatches = []
+    if list(reference) != list(candidate):
+        mismatches.append(f"parts: {list(reference)} != {list(candidate)}")
+    for name in reference:
+        if name not in candidate:
+            continue
+        ref_paragraphs, cand_paragraphs = reference[name], candidate[name]
+        if len(ref_paragraphs) != len(cand_paragraphs):
+            mismatches.append(f"{name}: {len(ref_paragraphs)} paragraphs != {len(cand_paragraphs)}")
+        for index, (expected, actual) in enumerate(zip(ref_paragraphs, cand_paragraphs)):
+            if expected['text'] != actual['text']:
+                mismatches.append(f"{name} paragraph {index}: text {expected['text'][:60]!r} != {actual['text'][:60]!r}")
+            elif expected['segments'] != actual['segments']:
+                mismatches.append(f"{name} paragraph {index}: run formatting differs in {expected['text'][:60]!r}")
+            elif expected['properties'] != actual['properties']:
+                mismatches.append(f"{name} paragraph {index}: paragraph properties differ")
+    return mismatches
+
+
+def compare_outputs(reference_path, candidate_path):
+    """Return (bytes identical, list of mismatches) between two rendered files."""
+    with open(reference_path, 'rb') as f:
+        reference_bytes = f.read()
+    with open(candidate_path, 'rb') as f:
+        if f.read() == reference_bytes:
+            return True, []
+    if reference_path.endswith('.docx'):
+        return False, compare_docx(normalize_docx(reference_path), normalize_docx(candidate_path))
+    return False, compare_xlsx(normalize_xlsx(reference_path), normalize_xlsx(candidate_path))
+
+
+# --- Report ------------------------------------------------------------------------------
+
+
+def format_markdown(report):
+    lines = [
+        f"# Render equivalence — {report['generated_at']}",
+        '',
+        f"{len(report['cases'])} cases, median of {report['repeat']} render(s) per path, {report['cpu_count']} CPUs.",
+        '',
+        '| Case | Fast path | Reference (s) | Fast path (s) | Speedup | Result |',
+        '|---|---|---|---|---|---|',
+    ]
+    for result in report['results']:
+        if not result['fast_path_taken']:
+            outcome = f"**fast path not taken** (engine: {result['engine'] or 'no engine line'})"
+        elif result['equivalent']:
+            outcome = 'identical bytes' if result['bytes_identical'] else 'equivalent'
+        else:
+            outcome = f"**{len(result['mismatches'])} mismatch(es)**"
+        lines.append(f"| {result['case']} | {result['fast_path']} | {result['reference_seconds']} | "
+                     f"{result['fast_seconds']} | {result['speedup']}x | {outcome} |")
+    failing = [result for result in report['results'] if not result['equivalent']]
+    not_taken = [result for result in report['results'] if not result['fast_path_taken']]
+    lines.append('')
+    if not failing and not not_taken:
+        lines.append('Every fast path renders the same output as the reference path.')
+    for result in not_taken:
+        lines.append(f"- {result['case']} / {result['fast_path']}: fast path not taken, its log line is missing "
+                     f"(engine: {result['engine'] or 'no engine line'})")
+    if not_taken:
+        lines.append('')
+    for result in failing:
+        lines.append(f"## {result['case']} / {result['fast_path']} ({result['speedup']}x)")
+        lines.append('')
+        lines.extend(f"- {mismatch}" for mismatch in result['mismatches'])
+        lines.append('')
+    return '\n'.join(lines) + '\n'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check that every processor fast path renders the same output as the reference path.')
+    parser.add_argument('--fast-paths', default=','.join(FAST_PATHS), help='comma separated fast paths to check')
+    parser.add_argument('--cases', default='', help='comma separated case names (default: the whole corpus)')
+    parser.add_argument('--products', type=int, default=20, help='products of the regular merch cases')
+    parser.add_argument('--large-products', type=int, default=2000, help='products of the large catalog case (0: no large case)')
+    parser.add_argument('--repeat', type=int, default=1, help='renders per path, the median time is reported')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--report', default=None, help='report path (.json, a .md is written next to it)')
+    args = parser.parse_args()
+
+    fast_paths = [name.strip() for name in args.fast_paths.split(',') if name.strip()]
+    unknown = [name for name in fast_paths if name not in FAST_PATHS]
+    if unknown:
+        parser.error(f"unknown fast path(s) {unknown}, expected some of {sorted(FAST_PATHS)}")
+    cases = build_corpus(random.Random(args.seed), args.products, args.large_products)
+    if args.cases:
+        selected = {name.strip() for name in args.cases.split(',')}
+        cases = [case for case in cases if case['name'] in selected]
+
+    results = []
+    with tempfile.TemporaryDirectory(prefix='render-equivalence-') as work_dir:
+        for case in cases:
+            applicable = [name for name in fast_paths if applies(FAST_PATHS[name], case)]
+            if not applicable:
+                continue
+            print(f"{case['name']} ({case['script']})...", flush=True)
+            reference_path, reference_seconds, _ = render_variant(case, work_dir, 'reference', {}, {}, False, args.repeat)
+            for name in applicable:
+                spec = FAST_PATHS[name]
+                fast_path, fast_seconds, fast_stdout = render_variant(case, work_dir, name, spec['payload'], spec['env'],
+                                                                      spec.get('warm_cache', False), args.repeat)
+                taken, engine = fast_path_taken(spec, fast_stdout)
+                bytes_identical, mismatches = compare_outputs(reference_path, fast_path)
+                os.remove(fast_path)
+                results.append({
+                    'case': case['name'],
+                    'script': case['script'],
+                    'fast_path': name,
+                    'reference_seconds': round(reference_seconds, 3),
+                    'fast_seconds': round(fast_seconds, 3),
+                    'speedup': round(reference_seconds / fast_seconds, 2) if fast_seconds else 0.0,
+                    'fast_path_taken': taken,
+                    'engine': engine,
+                    'equivalent': not mismatches,
+                    'bytes_identical': bytes_identical,
+                    'mismatch_count': len(mismatches),
+                    'mismatches': mismatches[:MAX_MISMATCHES],
+                })
+                outcome = 'equivalent' if not mismatches else f'{len(mismatches)} mismatch(es)'
+                if not taken:
+                    outcome = f"fast path not taken (engine: {engine or 'no engine line'}), {outcome}"
+                print(f"  {name}: {results[-1]['speedup']}x, {outcome}", flush=True)
+            os.remove(reference_path)
+
+    report = {
+        'generated_at': datetime.datetime.now().isoformat(timespec='seconds'),
+        'repeat': args.repeat,
+        'cpu_count': os.cpu_count(),
+        'fast_paths': {name: FAST_PATHS[name]['description'] for name in fast_paths},
+        'cases': [case['name'] for case in cases],
+        'results': results,
+    }
+    report_path = args.report or os.path.join(
+        SERVICES_DIR, 'logs', f"render_equivalence_report_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(report_path)), exist_ok=True)
+    with open(report_path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    markdown = format_markdown(report)
+    with open(os.path.splitext(report_path)[0] + '.md', 'w', encoding='utf-8') as f:
+        f.write(markdown)
+
+    print(markdown)
+    print(f"Report written to {report_path}")
+    return 0 if all(result['equivalent'] and result['fast_path_taken'] for result in results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
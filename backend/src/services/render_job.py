@@ -0,0 +1,69 @@
+import base64
+import json
+import os
+import runpy
+import sys
+import time
+
+from payload_schema import SCRIPT_KINDS, PayloadError, validate_payload
+
+# Entry point of every processor run started by the render scheduler (renderScheduler.js):
+#
+#   python render_job.py <processor script> <template path> <base64 payload | -> <output path>
+#
+# With '-' the base64 payload is read from stdin, which is how the scheduler passes it: Linux
+# caps a single command line argument at 128 KB, a few hundred products.
+# The payload is decoded and checked against the processor's schema (see payload_schema)
+# before the processor module is imported, so an invalid job fails in well under a
+# millisecond, without importing openpyxl / python-docx or loading the template. A valid
+# payload is handed over with its coerced values, and the processor runs as its own
+# __main__, exactly as when it is started directly.
+#
+# Exit code EXIT_INVALID_PAYLOAD with one stderr line "PAYLOAD_INVALID <json list of errors>"
+# when the payload is rejected.
+
+EXIT_INVALID_PAYLOAD = 4
+
+# Payload argument meaning "read the payload from stdin"
+STDIN_PAYLOAD = '-'
+
+SERVICES_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def _reject(message, errors):
+    print(message, file=sys.stderr)
+    print(f"PAYLOAD_INVALID {json.dumps(errors, ensure_ascii=False)}", file=sys.stderr)
+    sys.exit(EXIT_INVALID_PAYLOAD)
+
+
+def main():
+    if len(sys.argv) != 5 or sys.argv[1] not in SCRIPT_KINDS:
+        print(f"Usage: python render_job.py <{'|'.join(SCRIPT_KINDS)}> <template_path> <base64_payload|-> <output_path>",
+              file=sys.stderr)
+        sys.exit(1)
+    script, template_path, encoded_payload, output_path = sys.argv[1:]
+    if encoded_payload == STDIN_PAYLOAD:
+        encoded_payload = sys.stdin.read().strip()
+    kind = SCRIPT_KINDS[script]
+
+    started = time.perf_counter()
+    try:
+        payload = json.loads(base64.b64decode(encoded_payload).decode('utf-8'))
+    except ValueError as e:
+        _reject(f"Invalid {kind} payload: not base64-encoded JSON ({e})", [f"payload: {e}"])
+    try:
+        coerced = validate_payload(kind, payload)
+    except PayloadError as e:
+        _reject(str(e), e.errors)
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    coerced_values = coerced != payload
+    if coerced_values:
+        encoded_payload = base64.b64encode(json.dumps(coerced, ensure_ascii=False).encode('utf-8')).decode('ascii')
+    print(f"Payload valid for {script} ({kind}) in {elapsed_ms:.2f} ms{', values coerced' if coerced_values else ''}")
+
+    sys.argv = [script, template_path, encoded_payload, output_path]
+    runpy.run_path(os.path.join(SERVICES_DIR, script), run_name='__main__')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,361 @@
+import argparse
+import base64
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+# Load test for the Python document processors.
+#
+# Replays onboarding bundles (the four documents sharepointService generates for a new shop,
+# one after the other) and single-product appends (customer route, merch workbook only) at
+# rising concurrency levels. Every processor run is a real subprocess, exactly as the render
+# scheduler starts them, and its CPU time and peak RSS are read back with wait4().
+#
+#   python render_load_test.py --levels 1,2,4,8 --scenario mixed
+#
+# The report (JSON + Markdown) shows throughput, latency percentiles, CPU and memory per
+# level and the level where throughput stops scaling.
+
+SERVICES_DIR = os.path.dirname(os.path.abspath(__file__))
+
+TEMPLATES = {
+    'web_design': os.path.join(SERVICES_DIR, 'FileWebDesign', 'Intro - Textes _ CLIENT _ PROJET.docx'),
+    'web_merch': os.path.join(SERVICES_DIR, 'FichesProduitTemplate', 'FICHES.PRODUITS_SHOPIFY_CLIENT_PROJET.xlsx'),
+    'fiche_projet': os.path.join(SERVICES_DIR, 'DocxAModifier', 'FICHE PROJET_ CLIENT _ PROJET _ COMPTENUM _Démarrage Projet.docx'),
+    'template_d2c': os.path.join(SERVICES_DIR, 'TemplateSharePoint', 'Template questionnaire D2C.xlsx'),
+    'fiches_produits': os.path.join(SERVICES_DIR, 'FileWebMerch', 'FICHES.PRODUITS_SHOPIFY_CLIENT_PROJET.xlsx'),
+}
+
+PRODUCT_TYPES = ['Merch', 'POD', 'Vinyle', 'CD', 'Accessoire']
+SIZES = ['XS', 'S', 'M', 'L', 'XL']
+COLORS = ['Noir', 'Blanc', 'Rouge', 'Bleu', 'Vert']
+
+# Throughput gain below which a level is considered saturated
+DEFAULT_SCALING_THRESHOLD = 0.10
+
+
+def make_product(rng, index):
+    tailles = rng.sample(SIZES, rng.randint(0, 5))
+    couleurs = rng.sample(COLORS, rng.randint(0, 3))
+    keys = [f"{s}-{c}" for s in tailles for c in couleurs] or tailles or couleurs or ['default']
+    return {
+        'typeProduit': rng.choice(PRODUCT_TYPES),
+        'titre': f"Produit {index}",
+        'description': 'Description produit ' * rng.randint(1, 20),
+        'eans': {key: str(3000000000000 + index * 100 + i) for i, key in enumerate(keys)},
+        'skus': {key: f"SKU-{index}-{i}" for i, key in enumerate(keys)},
+        'stock': {key: str(rng.randint(0, 50)) for key in keys},
+        'poids': f"{rng.randint(1, 20) / 10}",
+        'prix': str(rng.randint(10, 80)),
+        'occ': rng.random() < 0.3,
+        'couleurs': couleurs,
+        'tailles': tailles,
+        'imageUrls': [],
+    }
+
+
+def make_shop(rng, index, product_count):
+    """Shop payload close to what sharepointService builds for a new shop."""
+    abonnement = rng.choice(['mensuel', 'annuel', ''])
+    return {
+        'nomProjet': f"Projet {index}",
+        'typeProjet': rng.choice(['Merch', 'D2C', 'Evenement']),
+        'commercial': 'Commercial',
+        'nomClient': f"Client {index}",
+        'raisonSociale': f"Client {index} SAS",
+        'compteClientRef': str(100000 + index),
+        'shopifyDomain': f"client-{index}.myshopify.com",
+        'dateMiseEnLigne': '2026/01/10',
+        'dateMiseEnLigneDDMMYYYY': '10/01/2026',
+        'dateCommercialisation': '2026/01/15',
+        'dateSortieOfficielle': '2026/02/01',
+        'precommande': rng.choice(['OUI', 'NON']),
+        'dedicaceEnvisagee': rng.choice(['OUI', 'NON']),
+        'estBoutiqueEnLigne': 'OUI',
+        'chefProjet': 'Chef Projet',
+        'demarrageProjet': '2025/12/01',
+        'contactsClient': 'contact@example.com',
+        'pourcentageSNA': str(rng.randint(5, 25)),
+        'typeAbonnementShopify': abonnement,
+        'moduleMondialRelay': rng.random() < 0.5,
+        'moduleDelivengo': rng.random() < 0.5,
+        'products': [make_product(rng, index * 1000 + i) for i in range(product_count)],
+    }
+
+
+def template_d2c_payload(shop):
+    return {
+        'nomProjet': shop['nomProjet'],
+        'typeProjet': shop['typeProjet'],
+        'commercial': shop['commercial'],
+        'client': shop['raisonSociale'],
+        'numeroCompteClient': shop['compteClientRef'],
+        'dateMiseEnLigne': shop['dateMiseEnLigne'],
+        'dateCommercialisation': shop['dateCommercialisation'],
+        'dateSortieOfficielle': shop['dateSortieOfficielle'],
+        'precommande': shop['precommande'],
+        'dedicace': shop['dedicaceEnvisagee'],
+        'commissionSnagz': f"{shop['pourcentageSNA']}%",
+    }
+
+
+def build_job(scenario, rng, index, work_dir, product_count):
+    """Return (scenario, list of (script, template, payload, output path)) for one job."""
+    if scenario == 'mixed':
+        # Roughly one new shop for every three product additions
+        scenario = 'onboarding' if index % 4 == 0 else 'append'
+
+    if scenario == 'append':
+        shop = make_shop(rng, index, rng.randint(1, 3))
+        shop['appendMode'] = False
+        return scenario, [
+            ('merch_xlsx_processor.py', TEMPLATES['fiches_produits'], shop, os.path.join(work_dir, f'{index}_fiches.xlsx')),
+        ]
+
+    shop = make_shop(rng, index, product_count)
+    docx_shop = {key: value for key, value in shop.items() if key != 'products'}
+    merch_shop = dict(shop, shopifyCsvPath=os.path.join(work_dir, f'{index}_shopify.csv'))
+    return scenario, [
+        ('docx_processor.py', TEMPLATES['web_design'], docx_shop, os.path.join(work_dir, f'{index}_web_design.docx')),
+        ('merch_xlsx_processor.py', TEMPLATES['web_merch'], merch_shop, os.path.join(work_dir, f'{index}_web_merch.xlsx')),
+        ('docx_processor.py', TEMPLATES['fiche_projet'], docx_shop, os.path.join(work_dir, f'{index}_fiche_projet.docx')),
+        ('template_processor.py', TEMPLATES['template_d2c'], template_d2c_payload(shop), os.path.join(work_dir, f'{index}_d2c.xlsx')),
+    ]
+
+
+class RssSampler:
+    """Samples the summed RSS of the running processor processes (Linux /proc only)."""
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.pids = set()
+        self.peak_kb = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self.available = os.path.exists('/proc/self/status')
+
+    def _rss_kb(self, pid):
+        try:
+            with open(f'/proc/{pid}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        return int(line.split()[1])
+        except (OSError, ValueError):
+            pass
+        return 0
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            with self._lock:
+                pids = list(self.pids)
+            self.peak_kb = max(self.peak_kb, sum(self._rss_kb(pid) for pid in pids))
+
+    def add(self, pid):
+        with self._lock:
+            self.pids.add(pid)
+
+    def remove(self, pid):
+        with self._lock:
+            self.pids.discard(pid)
+
+    def __enter__(self):
+        if self.available:
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        if self.available:
+            self._thread.join()
+
+
+def run_processor(script, template, payload, output_path, sampler):
+    """Run one processor to completion; return (ok, seconds, cpu seconds, peak RSS in KB)."""
+    encoded = base64.b64encode(json.dumps(payload).encode('utf-8')).decode('ascii')
+    started = time.perf_counter()
+    # Through render_job.py with the payload on stdin, like the scheduler
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(SERVICES_DIR, 'render_job.py'), script, template, '-', output_path],
+        stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, cwd=SERVICES_DIR,
+    )
+    sampler.add(process.pid)
+    try:
+        process.stdin.write(encoded.encode('ascii'))
+        process.stdin.close()
+    except BrokenPipeError:
+        pass
+    try:
+        # wait4() gives the resource usage of this child only
+        _, status, usage = os.wait4(process.pid, 0)
+    finally:
+        sampler.remove(process.pid)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return process.returncode == 0, time.perf_counter() - started, usage.ru_utime + usage.ru_stime, usage.ru_maxrss
+
+
+def run_job(job, sampler):
+    scenario, steps = job
+    started = time.perf_counter()
+    cpu_seconds, peak_rss_kb, ok = 0.0, 0, True
+    for script, template, payload, output_path in steps:
+        step_ok, _, cpu, rss = run_processor(script, template, payload, output_path, sampler)
+        cpu_seconds += cpu
+        peak_rss_kb = max(peak_rss_kb, rss)
+        for path in (output_path, payload.get('shopifyCsvPath')):
+            if path and os.path.exists(path):
+                os.remove(path)
+        if not step_ok:
+            ok = False
+            break
+    return {'scenario': scenario, 'ok': ok, 'seconds': time.perf_counter() - started,
+            'cpu_seconds': cpu_seconds, 'peak_rss_kb': peak_rss_kb}
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(p / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+def run_level(concurrency, jobs):
+    with RssSampler() as sampler:
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            results = list(pool.map(lambda job: run_job(job, sampler), jobs))
+        wall = time.perf_counter() - started
+
+    latencies = sorted(r['seconds'] for r in results if r['ok'])
+    cpu_seconds = sum(r['cpu_seconds'] for r in results)
+    by_scenario = {}
+    for r in results:
+        by_scenario.setdefault(r['scenario'], []).append(r['seconds'])
+    return {
+        'concurrency': concurrency,
+        'jobs': len(results),
+        'failed': sum(1 for r in results if not r['ok']),
+        'wall_seconds': round(wall, 3),
+        'throughput_per_min': round(len(latencies) / wall * 60, 2) if wall else 0.0,
+        'latency_seconds': {
+            'p50': round(percentile(latencies, 50), 3),
+            'p95': round(percentile(latencies, 95), 3),
+            'p99': round(percentile(latencies, 99), 3),
+        },
+        'latency_p95_by_scenario': {
+            name: round(percentile(sorted(values), 95), 3) for name, values in sorted(by_scenario.items())
+        },
+        'cpu_seconds': round(cpu_seconds, 2),
+        'cpu_utilization': round(cpu_seconds / (wall * (os.cpu_count() or 1)), 3) if wall else 0.0,
+        'peak_process_rss_mb': round(max((r['peak_rss_kb'] for r in results), default=0) / 1024, 1),
+        'peak_total_rss_mb': round(sampler.peak_kb / 1024, 1) if sampler.available else None,
+    }
+
+
+def find_saturation(levels, threshold):
+    """Annotate each level with its scaling and return the first level that no longer scales."""
+    saturated_at = None
+    for previous, level in zip(levels, levels[1:]):
+        base = previous['throughput_per_min']
+        gain = (level['throughput_per_min'] - base) / base if base else 0.0
+        level['throughput_gain'] = round(gain, 3)
+        if saturated_at is None and gain < threshold:
+            saturated_at = level['concurrency']
+    first = levels[0]
+    for level in levels:
+        ideal = first['throughput_per_min'] * level['concurrency'] / first['concurrency']
+        level['scaling_efficiency'] = round(level['throughput_per_min'] / ideal, 3) if ideal else 0.0
+    return saturated_at
+
+
+def format_markdown(report):
+    lines = [
+        f"# Render load test — {report['generated_at']}",
+        '',
+        f"Scenario: `{report['scenario']}`, {report['jobs_per_level']} jobs per level, "
+        f"{report['products_per_shop']} products per onboarding shop, {report['cpu_count']} CPUs.",
+        '',
+        '| Concurrency | Jobs/min | Gain | Efficiency | p50 (s) | p95 (s) | p99 (s) | CPU util. | Peak RSS total (MB) | Peak RSS process (MB) | Failed |',
+        '|---|---|---|---|---|---|---|---|---|---|---|',
+    ]
+    for level in report['levels']:
+        latency = level['latency_seconds']
+        gain = level.get('throughput_gain')
+        lines.append(
+            f"| {level['concurrency']} | {level['throughput_per_min']} | "
+            f"{'' if gain is None else f'{gain:+.0%}'} | {level['scaling_efficiency']:.0%} | "
+            f"{latency['p50']} | {latency['p95']} | {latency['p99']} | {level['cpu_utilization']:.0%} | "
+            f"{level['peak_total_rss_mb'] if level['peak_total_rss_mb'] is not None else 'n/a'} | "
+            f"{level['peak_process_rss_mb']} | {level['failed']} |"
+        )
+    lines.append('')
+    if report['saturated_at'] is None:
+        lines.append(f"Throughput still scales at the highest level tested ({report['levels'][-1]['concurrency']}).")
+    else:
+        best = max(report['levels'], key=lambda level: level['throughput_per_min'])
+        lines.append(
+            f"Throughput stops scaling at concurrency {report['saturated_at']} "
+            f"(gain below {report['scaling_threshold']:.0%}); best throughput "
+            f"{best['throughput_per_min']} jobs/min at concurrency {best['concurrency']}."
+        )
+    return '\n'.join(lines) + '\n'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the Python document processors at rising concurrency.')
+    parser.add_argument('--levels', default='1,2,4,8', help='comma separated concurrency levels')
+    parser.add_argument('--scenario', choices=['onboarding', 'append', 'mixed'], default='mixed')
+    parser.add_argument('--jobs-per-level', type=int, default=0, help='jobs per level (default: 3 x concurrency, at least 6)')
+    parser.add_argument('--products', type=int, default=20, help='products per onboarding shop')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_SCALING_THRESHOLD, help='minimum throughput gain to keep scaling')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--report', default=None, help='report path (.json, a .md is written next to it)')
+    args = parser.parse_args()
+
+    levels = sorted({int(level) for level in args.levels.split(',') if level.strip()})
+    rng = random.Random(args.seed)
+    results = []
+    with tempfile.TemporaryDirectory(prefix='render-load-') as work_dir:
+        for concurrency in levels:
+            count = args.jobs_per_level or max(6, 3 * concurrency)
+            jobs = [build_job(args.scenario, rng, i, work_dir, args.products) for i in range(count)]
+            print(f"Concurrency {concurrency}: {count} jobs...", flush=True)
+            level = run_level(concurrency, jobs)
+            print(f"  {level['throughput_per_min']} jobs/min, p95 {level['latency_seconds']['p95']}s, "
+                  f"CPU {level['cpu_utilization']:.0%}, failed {level['failed']}", flush=True)
+            results.append(level)
+
+    report = {
+        'generated_at': datetime.datetime.now().isoformat(timespec='seconds'),
+        'scenario': args.scenario,
+        'jobs_per_level': args.jobs_per_level or 'auto',
+        'products_per_shop': args.products,
+        'cpu_count': os.cpu_count(),
+        'scaling_threshold': args.threshold,
+        'levels': results,
+    }
+    report['saturated_at'] = find_saturation(results, args.threshold)
+
+    report_path = args.report or os.path.join(
+        SERVICES_DIR, 'logs', f"render_load_report_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(report_path)), exist_ok=True)
+    with open(report_path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    markdown = format_markdown(report)
+    with open(os.path.splitext(report_path)[0] + '.md', 'w', encoding='utf-8') as f:
+        f.write(markdown)
+
+    print(markdown)
+    print(f"Report written to {report_path}")
+    return 0 if all(level['failed'] == 0 for level in results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
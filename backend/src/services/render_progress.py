@@ -0,0 +1,160 @@
+import json
+import os
+import signal
+import time
+from concurrent.futures import FIRST_COMPLETED, wait
+
+# Progress events and cooperative cancellation for the processors.
+#
+# The render scheduler (renderScheduler.js) opens a pipe on file descriptor $RENDER_PROGRESS_FD
+# and passes the job deadline as $RENDER_DEADLINE_MS (epoch milliseconds). A processor writes
+# one JSON object per line on that pipe, stdout stays the human log:
+#   {"event": "phase", "phase": "start" | "load" | "render" | "save", ...}
+#   {"event": "products", "written": 120, "total": 1200, "sheet": "..."}
+#   {"event": "sheets", "written": 2, "total": 4}
+#   {"event": "saved", "bytes": 65536, "total": 281344}
+#   {"event": "done", "bytes": 281344} / {"event": "cancelled", "reason": "..."}
+# Every event carries `elapsed_ms` since the start of the job.
+#
+# SIGTERM (sent by the scheduler when the client is gone or the deadline passes) only records
+# a cancel request; the processor stops at its next checkpoint(), between products, sheets or
+# archive members, stops its process pools, removes the outputs it created and exits with
+# EXIT_CANCELLED. Without the environment variables (CLI, tests) events are dropped and only
+# SIGTERM cancels.
+
+EXIT_CANCELLED = 3
+
+# Minimum time between two 'products' / 'saved' events of the same job
+EVENT_INTERVAL_SECONDS = 0.25
+
+# How often a wait on a process pool looks for a cancel request
+POLL_SECONDS = 0.1
+
+_job = {
+    'channel': None,
+    'started': time.monotonic(),
+    'deadline': None,
+    'cancelled': None,
+    'outputs': [],
+    'last_event': {},
+}
+
+
+class RenderCancelled(Exception):
+    """Raised by checkpoint() once the job is cancelled or past its deadline."""
+
+
+def _request_cancel(signum, frame):
+    _job['cancelled'] = 'cancel signal received'
+
+
+def start_job(processor, output_paths):
+    """Open the progress channel, read the deadline and turn SIGTERM into a cancel request.
+
+    `output_paths` are the files the job writes: those that do not exist yet are removed if
+    the job is cancelled, existing ones (append mode) are only ever replaced atomically.
+    """
+    fd = os.environ.get('RENDER_PROGRESS_FD')
+    if fd:
+        try:
+            _job['channel'] = os.fdopen(int(fd), 'w', buffering=1, encoding='utf-8')
+        except (OSError, ValueError):
+            _job['channel'] = None
+    deadline = os.environ.get('RENDER_DEADLINE_MS')
+    _job['deadline'] = int(deadline) / 1000 if deadline else None
+    _job['started'] = time.monotonic()
+    _job['outputs'] = [path for path in output_paths if path and not os.path.exists(path)]
+    signal.signal(signal.SIGTERM, _request_cancel)
+    emit('phase', phase='start', processor=processor)
+
+
+def emit(event, **fields):
+    channel = _job['channel']
+    if channel is None:
+        return
+    record = {'event': event, 'elapsed_ms': int((time.monotonic() - _job['started']) * 1000), **fields}
+    try:
+        channel.write(json.dumps(record) + '\n')
+    except (OSError, ValueError):
+        # Reader gone: keep rendering, the exit code still tells the outcome
+        _job['channel'] = None
+
+
+def _throttled(event, last, **fields):
+    now = time.monotonic()
+    if not last and now - _job['last_event'].get(event, 0) < EVENT_INTERVAL_SECONDS:
+        return
+    _job['last_event'][event] = now
+    emit(event, **fields)
+
+
+def checkpoint():
+    """Raise RenderCancelled if the job was cancelled or its deadline has passed."""
+    if _job['cancelled'] is None and _job['deadline'] is not None and time.time() >= _job['deadline']:
+        _job['cancelled'] = 'deadline exceeded'
+    if _job['cancelled'] is not None:
+        raise RenderCancelled(_job['cancelled'])
+
+
+def phase(name, **fields):
+    checkpoint()
+    emit('phase', phase=name, **fields)
+
+
+def products_written(written, total, sheet=None):
+    checkpoint()
+    fields = {'sheet': sheet} if sheet is not None else {}
+    _throttled('products', written >= total, written=written, total=total, **fields)
+
+
+def sheets_written(written, total):
+    checkpoint()
+    emit('sheets', written=written, total=total)
+
+
+def bytes_saved(written, total):
+    checkpoint()
+    _throttled('saved', written >= total, bytes=written, total=total)
+
+
+def _stop_pool(pool):
+    pool.shutdown(wait=False, cancel_futures=True)
+    # Running tasks are not interrupted by shutdown(), stop their processes (SIGKILL: the
+    # workers are forked after start_job() and inherit its SIGTERM handler)
+    for process in list((getattr(pool, '_processes', None) or {}).values()):
+        process.kill()
+
+
+def pool_results(pool, futures, on_result=None):
+    """Results of `futures` in submission order, checking for cancellation while they run.
+
+    `on_result(count)` is called each time another future completes. When the job is
+    cancelled, the pending tasks are dropped and the pool's processes stopped.
+    """
+    pending = set(futures)
+    try:
+        while pending:
+            checkpoint()
+            done, pending = wait(pending, timeout=POLL_SECONDS, return_when=FIRST_COMPLETED)
+            if done and on_result:
+                on_result(len(futures) - len(pending))
+    except RenderCancelled:
+        _stop_pool(pool)
+        raise
+    return [future.result() for future in futures]
+
+
+def finish(output_path):
+    size = os.path.getsize(output_path) if os.path.exists(output_path) else None
+    emit('done', output=os.path.abspath(output_path), bytes=size)
+    _job['outputs'] = []
+
+
+def abort(error):
+    """Remove the outputs this job created, report the cancellation and return the exit code."""
+    # Partial archives (.part files) are already removed by archive_writer.write_archive()
+    for path in _job['outputs']:
+        if os.path.exists(path):
+            os.remove(path)
+    emit('cancelled', reason=str(error))
+    return EXIT_CANCELLED
@@ -4,8 +4,10 @@ const { Client } = require("@microsoft/microsoft-graph-client");
 const { Document, Packer, Paragraph, TextRun } = require("docx");
 const ExcelJS = require("exceljs");
 const fs = require('fs');
+const os = require('os');
 const path = require('path');
-const { exec } = require('child_process');
+const crypto = require('crypto');
+const { runPythonProcessor } = require('./renderScheduler');
 const { getCustomersCollection } = require('../config/db');
 require("isomorphic-fetch");
 
@@ -107,8 +109,9 @@ async function uploadFile(driveId, parentId, fileName, content, contentType, ret
   try {
     logger.debug('Uploading file:', fileName);
     const url = `/drives/${driveId}/items/${parentId}:/${fileName}:/content`;
-    await graphClient.api(url).headers({ "Content-Type": contentType }).put(content);
+    const item = await graphClient.api(url).headers({ "Content-Type": contentType }).put(content);
     logger.debug('Successfully uploaded file');
+    return item;
   } catch (error) {
     logger.error('Error uploading file:', error);
     
@@ -123,6 +126,65 @@ async function uploadFile(driveId, parentId, fileName, content, contentType, ret
   }
 }
 
+// Digest of a rendered file, as printed by the Python processors on stdout
+// (RENDER_DIGEST line, see archive_writer.format_render_digest), or computed from the file
+function getRenderDigest(stdout, filePath) {
+  const target = path.resolve(filePath);
+  for (const line of String(stdout || '').split('\n')) {
+    const index = line.indexOf('RENDER_DIGEST ');
+    if (index === -1) continue;
+    try {
+      const rendered = JSON.parse(line.slice(index + 'RENDER_DIGEST '.length));
+      if (path.resolve(rendered.path) === target) {
+        return rendered.sha256;
+      }
+    } catch (error) {
+      // Not a digest line
+    }
+  }
+  return crypto.createHash('sha256').update(fs.readFileSync(filePath)).digest('hex');
+}
+
+async function saveDocumentDigest(customer, shop, digestKey, record) {
+  try {
+    const customersCollection = await getCustomersCollection();
+    const updateQuery = customer._id
+      ? { _id: customer._id, 'shops.shopId': shop.shopId }
+      : { userId: customer.userId, 'shops.shopId': shop.shopId };
+    await customersCollection.updateOne(
+      updateQuery,
+      { $set: { [`shops.$.documentDigests.${digestKey}`]: { ...record, uploadedAt: new Date() } } }
+    );
+    shop.documentDigests = { ...(shop.documentDigests || {}), [digestKey]: record };
+  } catch (error) {
+    // The digest only saves a future upload, never fail the generation for it
+    logger.error('Error saving document digest:', error);
+  }
+}
+
+// Upload a rendered document, unless the same bytes were already uploaded to the same place
+// and the SharePoint copy has not changed since (edited or replaced by hand).
+// The processors write byte-identical files for identical inputs, so a regenerated document
+// that did not change has the same digest. Returns true when the file was uploaded.
+async function uploadRenderedFile(driveId, parentId, fileName, content, contentType, { customer, shop, digestKey, digest }) {
+  const previous = shop.documentDigests && shop.documentDigests[digestKey];
+  if (previous && previous.sha256 === digest && previous.eTag) {
+    try {
+      const existing = await graphClient.api(`/drives/${driveId}/items/${parentId}:/${fileName}`).select('id,eTag').get();
+      if (existing.eTag === previous.eTag) {
+        logger.debug(`${fileName} unchanged (sha256 ${digest.substring(0, 12)}), upload skipped`);
+        return false;
+      }
+    } catch (error) {
+      // Missing or unreadable: upload it again
+    }
+  }
+
+  const item = await uploadFile(driveId, parentId, fileName, content, contentType);
+  await saveDocumentDigest(customer, shop, digestKey, { sha256: digest, eTag: item && item.eTag, fileName });
+  return true;
+}
+
 async function findExistingCustomerFolder(driveId, compteClientNumber) {
   try {
     logger.debug(`Searching for existing customer folder containing: ${compteClientNumber}`);
@@ -213,20 +275,113 @@ async function findExistingShopFolder(driveId, customerFolderId, shopFolderName)
   }
 }
 
-async function createBoxMediaStructure(driveId, parentFolderId, customer, shop) {
+// Date helpers for the document payload
+const formatDateYYYYMMDD = (dateString) => {
+  if (!dateString) return '';
+  const date = new Date(dateString);
+  const day = String(date.getDate()).padStart(2, '0');
+  const month = String(date.getMonth() + 1).padStart(2, '0');
+  const year = date.getFullYear();
+  return `${year}/${month}/${day}`;
+};
+
+const formatDateDDMMYYYY = (dateString) => {
+  if (!dateString) return '';
+  const date = new Date(dateString);
+  const day = String(date.getDate()).padStart(2, '0');
+  const month = String(date.getMonth() + 1).padStart(2, '0');
+  const year = date.getFullYear();
+  return `${day}/${month}/${year}`;
+};
+
+/**
+ * Canonical shop payload for the Python document processors.
+ * Serialized once per bundle: every processor picks the fields it needs through its
+ * mapping file in placeholder_maps/ (field, formatter and fallback chain per placeholder).
+ */
+function buildShopDocumentPayload(customer, shop) {
+  return {
+    nomProjet: shop.nomProjet || '',
+    typeProjet: shop.typeProjet || '',
+    commercial: shop.commercial || '',
+    contactsClient: shop.contactsClient || '',
+    nomClient: customer.raisonSociale || customer.name || '',
+    raisonSociale: customer.raisonSociale || '',
+    compteClientRef: shop.compteClientRef || customer.CompteClientNumber || '',
+    numeroCompteClient: customer.CompteClientNumber || '',
+    shopifyDomain: shop.shopifyDomain || '',
+    dateMiseEnLigne: formatDateYYYYMMDD(shop.dateMiseEnLigne),
+    dateMiseEnLigneDDMMYYYY: formatDateDDMMYYYY(shop.dateMiseEnLigne),
+    dateCommercialisation: formatDateYYYYMMDD(shop.dateCommercialisation),
+    dateSortieOfficielle: formatDateYYYYMMDD(shop.dateSortieOfficielle),
+    demarrageProjet: formatDateYYYYMMDD(shop.demarrageProjet),
+    precommande: !!shop.precommande,
+    dedicaceEnvisagee: !!shop.dedicaceEnvisagee,
+    estBoutiqueEnLigne: !!shop.estBoutiqueEnLigne,
+    chefProjet: `${shop.prenomChefProjet || ''} ${shop.nomChefProjet || ''}`.trim(),
+    pourcentageSNA: shop.pourcentageSNA || '',
+    // Conditional strikethrough in the contract and Shopify plan columns of the D2C template
+    typeAbonnementShopify: shop.typeAbonnementShopify || '',
+    moduleMondialRelay: !!shop.moduleMondialRelay,
+    moduleDelivengo: !!shop.moduleDelivengo,
+    products: shop.products || [],
+    // The merch processor also writes the Shopify import CSV next to the workbook
+    shopifyCsv: true,
+  };
+}
+
+/**
+ * The bundle's shop payload, serialized once per processor family: only the merch workbook
+ * renders the products, the contracts and the D2C template get the payload without them
+ */
+function encodeShopPayloads(customer, shop) {
+  const payload = buildShopDocumentPayload(customer, shop);
+  const encode = (value) => Buffer.from(JSON.stringify(value)).toString('base64');
+  return {
+    merch: encode(payload),
+    documents: encode({ ...payload, products: [] }),
+  };
+}
+
+// DOCX templates account managers can preview before the bundle is pushed (see docx_preview.py)
+const PREVIEW_TEMPLATES = {
+  ficheProjet: path.join(__dirname, 'DocxAModifier', 'FICHE PROJET_ CLIENT _ PROJET _ COMPTENUM _Démarrage Projet.docx'),
+  webDesign: path.join(__dirname, 'FileWebDesign', 'Intro - Textes _ CLIENT _ PROJET.docx'),
+};
+
+/**
+ * HTML (or text) preview of a shop document with the shop's current values, without
+ * rendering the DOCX: placeholders and contract rules applied to a cached parse of the template
+ */
+async function previewShopDocument(customer, shop, documentKey, format = 'html', { signal } = {}) {
+  const templatePath = PREVIEW_TEMPLATES[documentKey];
+  if (!templatePath) {
+    throw new Error(`Unknown preview document: ${documentKey}`);
+  }
+  // The contracts do not use the products: keep the argument small
+  const payload = { ...buildShopDocumentPayload(customer, shop), products: [] };
+  const encodedPayload = Buffer.from(JSON.stringify(payload)).toString('base64');
+  const extension = format === 'text' ? 'txt' : 'html';
+  const outputPath = path.join(os.tmpdir(), `preview_${crypto.randomBytes(8).toString('hex')}.${extension}`);
+
+  try {
+    await runPythonProcessor(
+      'docx_preview.py',
+      [templatePath, encodedPayload, outputPath],
+      { priority: 'interactive', label: `${documentKey} preview`, signal }
+    );
+    return fs.readFileSync(outputPath, 'utf8');
+  } finally {
+    if (fs.existsSync(outputPath)) {
+      fs.unlinkSync(outputPath);
+    }
+  }
+}
+
+async function createBoxMediaStructure(driveId, parentFolderId, customer, shop, shopPayloads, { signal } = {}) {
   try {
     logger.debug('Creating Box Media folder structure...');
     
-    // Helper function to format dates as YYYY/MM/DD 
-    const formatDateYYYYMMDD = (dateString) => {
-      if (!dateString) return '';
-      const date = new Date(dateString);
-      const day = String(date.getDate()).padStart(2, '0');
-      const month = String(date.getMonth() + 1).padStart(2, '0');
-      const year = date.getFullYear();
-      return `${year}/${month}/${day}`;
-    };
-    
     // Create Box Media folder with dynamic naming
     const raisonSocialeForFolder = (customer.raisonSociale || 'CLIENT').toUpperCase().replace(/[^a-zA-Z0-9]/g, '_');
     const nomProjetForFolder = (shop.nomProjet || 'PROJET').toUpperCase().replace(/[^a-zA-Z0-9]/g, '_');
@@ -257,63 +412,37 @@ async function createBoxMediaStructure(driveId, parentFolderId, customer, shop)
     if (fs.existsSync(webDesignTemplatePath)) {
       const webDesignOutputName = `Intro - Textes _ ${raisonSocialeForFolder} _ ${nomProjetForFolder}.docx`;
       const processedWebDesignPath = path.join(webDesignTemplateDir, `PROCESSED_${webDesignOutputName}`);
-      
-      // Prepare shop data for processing (same format as main DOCX)
-      const shopDataForWebDesign = JSON.stringify({
-        nomProjet: shop.nomProjet, // XXX1
-        typeProjet: shop.typeProjet, // XXX2
-        contactsClient: shop.contactsClient, // XXX3
-        nomClient: customer.raisonSociale || customer.name || '', // XXX4
-        compteClientRef: shop.compteClientRef || customer.CompteClientNumber, // XXX5
-        dateMiseEnLigne: formatDateYYYYMMDD(shop.dateMiseEnLigne), // XXX7
-        dateCommercialisation: formatDateYYYYMMDD(shop.dateCommercialisation), // XXX8
-        dateSortieOfficielle: formatDateYYYYMMDD(shop.dateSortieOfficielle), // XXX9
-        precommande: shop.precommande ? 'OUI' : 'NON', // XXX10
-        dedicaceEnvisagee: shop.dedicaceEnvisagee ? 'OUI' : 'NON', // XXX11
-        estBoutiqueEnLigne: shop.estBoutiqueEnLigne ? 'OUI' : 'NON', // XXX12
-        chefProjet: `${shop.prenomChefProjet || ''} ${shop.nomChefProjet || ''}`.trim(), // XXX13
-        demarrageProjet: formatDateYYYYMMDD(shop.demarrageProjet), // XXX14
-        // Additional fields for backwards compatibility
-        commercial: shop.commercial,
-        raisonSociale: customer.raisonSociale,
-        shopifyPlanMonthlySelected: shop.typeAbonnementShopify === 'mensuel',
-        shopifyPlanYearlySelected: shop.typeAbonnementShopify === 'annuel',
-        // Fields for conditional strikethrough
-        typeAbonnementShopify: shop.typeAbonnementShopify || '',
-        moduleMondialRelay: !!shop.moduleMondialRelay,
-        moduleDelivengo: !!shop.moduleDelivengo,
-      });
-
-      const encodedWebDesignData = Buffer.from(shopDataForWebDesign).toString('base64');
 
       // Process the Web-Design DOCX file using Python script
-      await new Promise((resolve, reject) => {
-        const command = `python3 "${path.join(__dirname, 'docx_processor.py')}" "${webDesignTemplatePath}" "${encodedWebDesignData}" "${processedWebDesignPath}"`;
-        logger.debug(`Processing Web-Design DOCX: ${command}`);
-
-        exec(command, (error, stdout, stderr) => {
-          if (error) {
-            logger.error(`Web-Design DOCX processing error: ${error}`);
-            logger.error(`Python stderr: ${stderr}`);
-            return reject(`Failed to process Web-Design DOCX: ${error.message}`);
-          }
-          if (stderr) {
-            logger.warn(`Python stderr: ${stderr}`);
-          }
-          logger.debug(`Python stdout: ${stdout}`);
-          resolve();
-        });
-      });
+      let webDesignStdout;
+      try {
+        logger.debug(`Processing Web-Design DOCX: ${webDesignTemplatePath} -> ${processedWebDesignPath}`);
+        const { stdout, stderr } = await runPythonProcessor(
+          'docx_processor.py',
+          [webDesignTemplatePath, shopPayloads.documents, processedWebDesignPath],
+          { priority: 'bulk', label: 'Web-Design DOCX', signal }
+        );
+        if (stderr) {
+          logger.warn(`Python stderr: ${stderr}`);
+        }
+        logger.debug(`Python stdout: ${stdout}`);
+        webDesignStdout = stdout;
+      } catch (error) {
+        logger.error(`Web-Design DOCX processing error: ${error}`);
+        logger.error(`Python stderr: ${error.stderr}`);
+        throw new Error(`Failed to process Web-Design DOCX: ${error.message}`);
+      }
 
       // Upload the processed Web-Design file
       if (fs.existsSync(processedWebDesignPath)) {
         const processedWebDesignContent = fs.readFileSync(processedWebDesignPath);
-        await uploadFile(
+        await uploadRenderedFile(
           driveId,
           webDesignFolder.id,
           webDesignOutputName,
           processedWebDesignContent,
-          'application/vnd.openxmlformats-officedocument.wordprocessingml.document'
+          'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+          { customer, shop, digestKey: 'webDesignDocx', digest: getRenderDigest(webDesignStdout, processedWebDesignPath) }
         );
         logger.debug('Processed Web-Design template file uploaded successfully');
         // Clean up temporary file
@@ -346,53 +475,46 @@ async function createBoxMediaStructure(driveId, parentFolderId, customer, shop)
     if (fs.existsSync(webMerchTemplatePath)) {
       const webMerchOutputName = `FICHES.PRODUITS_SHOPIFY_${raisonSocialeForFolder}_${nomProjetForFolder}.xlsx`;
       const processedWebMerchPath = path.join(webMerchTemplateDir, `PROCESSED_${webMerchOutputName}`);
+      // Written by the merch processor next to the workbook (shopifyCsv in the payload)
+      const shopifyCsvOutputName = webMerchOutputName.replace(/\.xlsx$/, '.csv');
+      const processedShopifyCsvPath = processedWebMerchPath.replace(/\.xlsx$/, '.csv');
       
-      // Prepare shop data with products for merchandising
-      const shopDataForWebMerch = JSON.stringify({
-        nomProjet: shop.nomProjet,
-        shopifyDomain: shop.shopifyDomain || '',
-        raisonSociale: customer.raisonSociale,
-        dateSortieOfficielle: shop.dateSortieOfficielle,
-        dateCommercialisation: shop.dateCommercialisation,
-        dateMiseEnLigne: shop.dateMiseEnLigne,
-        products: shop.products || []
-      });
-
-      const encodedWebMerchData = Buffer.from(shopDataForWebMerch).toString('base64');
-
       // Process the Web-Merchandising XLSX file using specialized merchandising Python script
-      await new Promise((resolve, reject) => {
-        const command = `python3 "${path.join(__dirname, 'merch_xlsx_processor.py')}" "${webMerchTemplatePath}" "${encodedWebMerchData}" "${processedWebMerchPath}"`;
-        logger.debug(`Processing Web-Merchandising XLSX with products: ${command}`);
-
-        exec(command, (error, stdout, stderr) => {
-          if (error) {
-            logger.error(`Web-Merchandising XLSX processing error: ${error}`);
-            logger.error(`Python stderr: ${stderr}`);
-            return reject(`Failed to process Web-Merchandising XLSX: ${error.message}`);
-          }
-          if (stderr) {
-            logger.warn(`Python stderr: ${stderr}`);
-          }
-          logger.debug(`Python stdout: ${stdout}`);
-          resolve();
-        });
-      });
+      let webMerchStdout;
+      try {
+        logger.debug(`Processing Web-Merchandising XLSX with products: ${webMerchTemplatePath} -> ${processedWebMerchPath}`);
+        const { stdout, stderr } = await runPythonProcessor(
+          'merch_xlsx_processor.py',
+          [webMerchTemplatePath, shopPayloads.merch, processedWebMerchPath],
+          { priority: 'bulk', label: 'Web-Merchandising XLSX', signal }
+        );
+        if (stderr) {
+          logger.warn(`Python stderr: ${stderr}`);
+        }
+        logger.debug(`Python stdout: ${stdout}`);
+        webMerchStdout = stdout;
+      } catch (error) {
+        logger.error(`Web-Merchandising XLSX processing error: ${error}`);
+        logger.error(`Python stderr: ${error.stderr}`);
+        throw new Error(`Failed to process Web-Merchandising XLSX: ${error.message}`);
+      }
 
       // Upload the processed Web-Merchandising file
       if (fs.existsSync(processedWebMerchPath)) {
         const processedWebMerchContent = fs.readFileSync(processedWebMerchPath);
-        await uploadFile(
+        const webMerchUploaded = await uploadRenderedFile(
           driveId,
           webMerchFolder.id,
           webMerchOutputName,
           processedWebMerchContent,
-          'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+          'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+          { customer, shop, digestKey: 'webMerchXlsx', digest: getRenderDigest(webMerchStdout, processedWebMerchPath) }
         );
         logger.debug('Processed Web-Merchandising template file uploaded successfully');
         
         // Mark all products as documented after successful merchandising generation
-        if (shop.products && shop.products.length > 0) {
+        // (an unchanged workbook means they already were)
+        if (webMerchUploaded && shop.products && shop.products.length > 0) {
           try {
             const customersCollection = await getCustomersCollection();
             
@@ -431,6 +553,23 @@ async function createBoxMediaStructure(driveId, parentFolderId, customer, shop)
       } else {
         logger.warn(`Processed Web-Merchandising file not found at ${processedWebMerchPath}`);
       }
+
+      // Upload the Shopify product import CSV next to the workbook
+      if (fs.existsSync(processedShopifyCsvPath)) {
+        const shopifyCsvContent = fs.readFileSync(processedShopifyCsvPath);
+        await uploadRenderedFile(
+          driveId,
+          webMerchFolder.id,
+          shopifyCsvOutputName,
+          shopifyCsvContent,
+          'text/csv',
+          { customer, shop, digestKey: 'shopifyCsv', digest: getRenderDigest(webMerchStdout, processedShopifyCsvPath) }
+        );
+        logger.debug('Shopify product import CSV uploaded successfully');
+        fs.unlinkSync(processedShopifyCsvPath);
+      } else {
+        logger.warn(`Shopify product import CSV not found at ${processedShopifyCsvPath}`);
+      }
     }
     
     // Copy PDFs from BoxMediaPDFS directory to the root of Box Media folder
@@ -688,7 +827,8 @@ async function checkDocumentationExists(customer, shop) {
   }
 }
 
-async function generateDocumentation(customer, shop, forceOverwrite = false) {
+// `signal` (AbortSignal) cancels the renders of the bundle still queued or running, see renderScheduler
+async function generateDocumentation(customer, shop, forceOverwrite = false, { signal } = {}) {
   try {
     logger.debug('Starting documentation generation...');
     
@@ -728,8 +868,11 @@ async function generateDocumentation(customer, shop, forceOverwrite = false) {
     
     const shopFolder = await getOrCreateFolder(drive.id, clientFolder.id, shopFolderName);
 
+    // One canonical payload for every document of the bundle, serialized once per processor family
+    const shopPayloads = encodeShopPayloads(customer, shop);
+
     // Create Box Media structure with new folders
-    await createBoxMediaStructure(drive.id, shopFolder.id, customer, shop);
+    await createBoxMediaStructure(drive.id, shopFolder.id, customer, shop, shopPayloads, { signal });
 
     // Create CONTRAT folder (renamed from CONTRAT SIGNÉ) with grey color
     await createContratFolder(drive.id, shopFolder.id);
@@ -747,87 +890,36 @@ async function generateDocumentation(customer, shop, forceOverwrite = false) {
     const outputFilename = `FICHE PROJET_ ${raisonSocialeForFilename} _ ${nomProjetForFilename} _ ${compteNumForFilename} _Démarrage Projet.docx`;
     const processedDocxPath = path.join(__dirname, 'DocxAModifier', `PROCESSED_${outputFilename}`);
 
-    // Helper function to format dates as YYYY/MM/DD for Fiche Projet
-    const formatDateYYYYMMDD = (dateString) => {
-      if (!dateString) return '';
-      const date = new Date(dateString);
-      const day = String(date.getDate()).padStart(2, '0');
-      const month = String(date.getMonth() + 1).padStart(2, '0');
-      const year = date.getFullYear();
-      return `${year}/${month}/${day}`;
-    };
-
-    // Helper function to format dates as DD/MM/YYYY for date de mise en ligne
-    const formatDateDDMMYYYY = (dateString) => {
-      if (!dateString) return '';
-      const date = new Date(dateString);
-      const day = String(date.getDate()).padStart(2, '0');
-      const month = String(date.getMonth() + 1).padStart(2, '0');
-      const year = date.getFullYear();
-      return `${day}/${month}/${year}`;
-    };
-
-    // Prepare shop data as a JSON string for the Python script
-    const shopDataJson = JSON.stringify({
-      nomProjet: shop.nomProjet, // XXX1
-      typeProjet: shop.typeProjet, // XXX2
-      contactsClient: shop.contactsClient, // XXX3
-      nomClient: customer.raisonSociale || customer.name || '', // XXX4 - Client name
-      compteClientRef: shop.compteClientRef || customer.CompteClientNumber, // XXX5 - Prefer shop reference
-      dateMiseEnLigne: formatDateYYYYMMDD(shop.dateMiseEnLigne), // XXX7 - YYYY/MM/DD format
-      dateCommercialisation: formatDateYYYYMMDD(shop.dateCommercialisation), // XXX8 - YYYY/MM/DD format
-      dateSortieOfficielle: formatDateYYYYMMDD(shop.dateSortieOfficielle), // XXX9 - YYYY/MM/DD format
-      precommande: shop.precommande ? 'OUI' : 'NON', // XXX10
-      dedicaceEnvisagee: shop.dedicaceEnvisagee ? 'OUI' : 'NON', // XXX11
-      estBoutiqueEnLigne: shop.estBoutiqueEnLigne ? 'OUI' : 'NON', // XXX12
-      chefProjet: `${shop.prenomChefProjet || ''} ${shop.nomChefProjet || ''}`.trim(), // XXX13
-      demarrageProjet: formatDateYYYYMMDD(shop.demarrageProjet), // XXX14 - YYYY/MM/DD format
-      pourcentageSNA: shop.pourcentageSNA || '', // XXX69 - NEW: pourcentageSNA value
-      dateMiseEnLigneDDMMYYYY: formatDateDDMMYYYY(shop.dateMiseEnLigne), // For specific box in fiche produit
-      // Fields for conditional strikethrough
-      typeAbonnementShopify: shop.typeAbonnementShopify || '',
-      moduleMondialRelay: !!shop.moduleMondialRelay,
-      moduleDelivengo: !!shop.moduleDelivengo,
-      // Additional fields for backwards compatibility and other processing
-      commercial: shop.commercial,
-      clientName: clientFolderName,
-      raisonSociale: customer.raisonSociale,
-      // legacy flags kept for backward compatibility
-      shopifyPlanMonthlySelected: shop.typeAbonnementShopify === 'mensuel',
-      shopifyPlanYearlySelected: shop.typeAbonnementShopify === 'annuel',
-    });
-
-    // Base64 encode the JSON string to avoid shell escaping issues
-    const encodedShopData = Buffer.from(shopDataJson).toString('base64');
-
     // Execute the Python script to process the DOCX
-    await new Promise((resolve, reject) => {
-      const command = `python3 "${path.join(__dirname, 'docx_processor.py')}" "${docxTemplatePath}" "${encodedShopData}" "${processedDocxPath}"`;
-      logger.debug(`Executing Python command: ${command}`);
-
-      exec(command, (error, stdout, stderr) => {
-        if (error) {
-          logger.error(`exec error: ${error}`);
-          logger.error(`Python stderr: ${stderr}`);
-          return reject(`Failed to process DOCX: ${error.message}`);
-        }
-        if (stderr) {
-          logger.warn(`Python stderr: ${stderr}`);
-        }
-        logger.debug(`Python stdout: ${stdout}`);
-        resolve();
-      });
-    });
+    let ficheProjetStdout;
+    try {
+      logger.debug(`Processing Fiche projet DOCX: ${docxTemplatePath} -> ${processedDocxPath}`);
+      const { stdout, stderr } = await runPythonProcessor(
+        'docx_processor.py',
+        [docxTemplatePath, shopPayloads.documents, processedDocxPath],
+        { priority: 'bulk', label: 'Fiche projet DOCX', signal }
+      );
+      if (stderr) {
+        logger.warn(`Python stderr: ${stderr}`);
+      }
+      logger.debug(`Python stdout: ${stdout}`);
+      ficheProjetStdout = stdout;
+    } catch (error) {
+      logger.error(`DOCX processing error: ${error}`);
+      logger.error(`Python stderr: ${error.stderr}`);
+      throw new Error(`Failed to process DOCX: ${error.message}`);
+    }
 
     // Upload the processed DOCX file to the shop folder
     if (fs.existsSync(processedDocxPath)) {
       const processedDocxContent = fs.readFileSync(processedDocxPath);
-      await uploadFile(
+      await uploadRenderedFile(
         drive.id,
         shopFolder.id,
         outputFilename,
         processedDocxContent,
-        'application/vnd.openxmlformats-officedocument.wordprocessingml.document'
+        'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+        { customer, shop, digestKey: 'ficheProjetDocx', digest: getRenderDigest(ficheProjetStdout, processedDocxPath) }
       );
       logger.debug(`Processed DOCX '${outputFilename}' uploaded successfully.`);
       // Clean up the temporary processed DOCX file
@@ -841,62 +933,35 @@ async function generateDocumentation(customer, shop, forceOverwrite = false) {
     const xlsxOutputPath = path.join(__dirname, 'generated_docs', `Template_Questionaire_D2C_${customer.CompteClientNumber}_${Date.now()}.xlsx`);
     const xlsxOutputBasename = `Template_Questionaire_D2C.xlsx`;
     
-    // Prepare shop data for template filling
-    const templateData = {
-      nomProjet: shop.nomProjet || '',
-      typeProjet: shop.typeProjet || '',
-      commercial: shop.commercial || '',
-      boutiqueEnLigne: shop.estBoutiqueEnLigne === true ? 'OUI' : 'NON',
-      client: customer.raisonSociale || '',
-      contactsClient: shop.contactsClient || '',
-      numeroCompteClient: customer.CompteClientNumber || '',
-      dateMiseEnLigne: shop.dateMiseEnLigne || '',
-      dateCommercialisation: shop.dateCommercialisation || '',
-      dateSortieOfficielle: shop.dateSortieOfficielle || '',
-      precommande: shop.precommande === 'OUI' ? 'OUI' : 'NON',
-      dedicace: shop.dedicaceEnvisagee === 'OUI' ? 'OUI' : 'NON',
-      facturation: 'vendeur', // Default to vendeur
-      abonnementMensuelShopify: shop.shopifyPlanMonthlySelected === true ? 'OUI' : 'NON',
-      abonnementAnnuelShopify: shop.shopifyPlanYearlySelected === true ? 'OUI' : 'NON',
-      coutsMondialRelay: shop.moduleMondialRelay === true ? 'OUI' : 'NON',
-      coutsDelivengo: shop.moduleDelivengo === true ? 'OUI' : 'NON',
-      fraisMensuelMaintenance: '50€',
-      fraisOuvertureBoutique: '500€',
-      fraisOuvertureSansHabillage: '', // Leave empty as requested
-      commissionSnagz: `${shop.pourcentageSNA || 0}%`
-    };
-    
-    const encodedTemplateData = Buffer.from(JSON.stringify(templateData)).toString('base64');
-    
-    const templateCommand = `python3 "${path.join(__dirname, 'template_processor.py')}" "${xlsxTemplatePath}" "${encodedTemplateData}" "${xlsxOutputPath}"`;
-    
     try {
-      logger.debug('Executing Template D2C generation command:', templateCommand);
-      const templateResult = await new Promise((resolve, reject) => {
-        exec(templateCommand, (error, stdout, stderr) => {
-          if (error) {
-            logger.error('Template D2C generation error:', error);
-            logger.error('Template stdout:', stdout);
-            logger.error('Template stderr:', stderr);
-            reject(error);
-          } else {
-            logger.debug('Template D2C generation completed successfully');
-            resolve(stdout);
-          }
-        });
-      });
+      logger.debug('Executing Template D2C generation:', xlsxTemplatePath);
+      let templateResult;
+      try {
+        ({ stdout: templateResult } = await runPythonProcessor(
+          'template_processor.py',
+          [xlsxTemplatePath, shopPayloads.documents, xlsxOutputPath],
+          { priority: 'bulk', label: 'Template D2C', signal }
+        ));
+        logger.debug('Template D2C generation completed successfully');
+      } catch (error) {
+        logger.error('Template D2C generation error:', error);
+        logger.error('Template stdout:', error.stdout);
+        logger.error('Template stderr:', error.stderr);
+        throw error;
+      }
       
       logger.debug('Template D2C processing result:', templateResult);
       
       // Upload the generated XLSX to SharePoint
       if (fs.existsSync(xlsxOutputPath)) {
         const xlsxContent = fs.readFileSync(xlsxOutputPath);
-        await uploadFile(
+        await uploadRenderedFile(
           drive.id,
           shopFolder.id,
           xlsxOutputBasename,
           xlsxContent,
-          'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+          'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+          { customer, shop, digestKey: 'templateD2C', digest: getRenderDigest(templateResult, xlsxOutputPath) }
         );
         logger.debug('Template_Questionaire_D2C.xlsx uploaded successfully');
         
@@ -1363,23 +1428,22 @@ async function createNewFichesProduitsFile(driveId, webMerchFolderId, customer,
   const encodedWebMerchData = Buffer.from(shopDataForWebMerch).toString('base64');
 
   // Process the template with new products
-  await new Promise((resolve, reject) => {
-    const command = `python3 "${path.join(__dirname, 'merch_xlsx_processor.py')}" "${webMerchTemplatePath}" "${encodedWebMerchData}" "${processedWebMerchPath}"`;
-    logger.debug(`Creating new Fiches Produits: ${command}`);
-
-    exec(command, (error, stdout, stderr) => {
-      if (error) {
-        logger.error(`New Fiches Produits creation error: ${error}`);
-        logger.error(`Python stderr: ${stderr}`);
-        return reject(`Failed to create new Fiches Produits: ${error.message}`);
-      }
-      if (stderr) {
-        logger.warn(`Python stderr: ${stderr}`);
-      }
-      logger.debug(`Python stdout: ${stdout}`);
-      resolve();
-    });
-  });
+  try {
+    logger.debug(`Creating new Fiches Produits: ${webMerchTemplatePath} -> ${processedWebMerchPath}`);
+    const { stdout, stderr } = await runPythonProcessor(
+      'merch_xlsx_processor.py',
+      [webMerchTemplatePath, encodedWebMerchData, processedWebMerchPath],
+      { priority: 'bulk', label: 'Fiches Produits' }
+    );
+    if (stderr) {
+      logger.warn(`Python stderr: ${stderr}`);
+    }
+    logger.debug(`Python stdout: ${stdout}`);
+  } catch (error) {
+    logger.error(`New Fiches Produits creation error: ${error}`);
+    logger.error(`Python stderr: ${error.stderr}`);
+    throw new Error(`Failed to create new Fiches Produits: ${error.message}`);
+  }
 
   // Upload the new file
   if (fs.existsSync(processedWebMerchPath)) {
@@ -1415,5 +1479,6 @@ async function findFolderByName(driveId, parentFolderId, folderName) {
 module.exports = { 
   generateDocumentation, 
   checkDocumentationExists, 
-  appendToFichesProduitsOrCreate 
+  appendToFichesProduitsOrCreate,
+  previewShopDocument
 };
@@ -0,0 +1,156 @@
+import csv
+import json
+import sys
+import os
+import re
+import base64
+import datetime
+import unicodedata
+
+from archive_writer import file_digest, format_render_digest
+from product_fields import extract_product_fields, iter_variants, parse_price, parse_weight_grams
+
+# Set up logging to a file
+def setup_logging():
+    log_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'logs')
+    os.makedirs(log_dir, exist_ok=True)
+    log_file = os.path.join(log_dir, f'shopify_csv_export_{datetime.datetime.now().strftime("%Y%m%d_%H%M%S")}.log')
+
+    def log_message(message):
+        with open(log_file, 'a', encoding='utf-8') as f:
+            timestamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            f.write(f'[{timestamp}] {message}\n')
+            print(f'[{timestamp}] {message}')
+
+    return log_message
+
+log = setup_logging()
+
+# Shopify product import CSV, one row per variant, written as the products are read.
+# Nothing here imports openpyxl: memory stays flat whatever the size of the catalog.
+
+SHOPIFY_COLUMNS = [
+    'Handle', 'Title', 'Body (HTML)', 'Vendor', 'Type', 'Tags', 'Published',
+    'Option1 Name', 'Option1 Value', 'Option2 Name', 'Option2 Value',
+    'Variant SKU', 'Variant Grams', 'Variant Inventory Tracker', 'Variant Inventory Qty',
+    'Variant Inventory Policy', 'Variant Fulfillment Service', 'Variant Price',
+    'Variant Requires Shipping', 'Variant Taxable', 'Variant Barcode', 'Variant Weight Unit',
+    'Status',
+]
+
+# Columns Shopify only reads on the first row of a product
+PRODUCT_COLUMNS = ('Title', 'Body (HTML)', 'Vendor', 'Type', 'Tags', 'Published', 'Option1 Name', 'Option2 Name', 'Status')
+
+SIZE_OPTION_NAME = 'Taille'
+COLOR_OPTION_NAME = 'Couleur'
+
+
+def make_handle(title, seen_handles):
+    """URL handle from the product title, made unique within the export."""
+    ascii_title = unicodedata.normalize('NFKD', title or '').encode('ascii', 'ignore').decode('ascii')
+    base = re.sub(r'[^a-z0-9]+', '-', ascii_title.lower()).strip('-') or 'produit'
+    handle, suffix = base, 2
+    while handle in seen_handles:
+        handle, suffix = f"{base}-{suffix}", suffix + 1
+    seen_handles.add(handle)
+    return handle
+
+
+def iter_variant_rows(product, vendor, seen_handles):
+    """Yield the CSV rows (dicts keyed by SHOPIFY_COLUMNS) of one product."""
+    fields = extract_product_fields(product)
+    handle = make_handle(fields['titre'], seen_handles)
+    grams = parse_weight_grams(fields['poids'])
+    price = parse_price(fields['prix'])
+
+    variants = list(iter_variants(fields))
+    # The product-level EAN only identifies a product with a single variant: on several
+    # variants it would give them all the same barcode
+    product_ean = ''
+    if len(variants) == 1:
+        product_ean = product.get('codeEAN', '') or product.get('ean', '') or product.get('codeBarres', '')
+
+    for index, (key, size, color) in enumerate(variants):
+        options = [(SIZE_OPTION_NAME, size), (COLOR_OPTION_NAME, color)]
+        options = [(name, value) for name, value in options if value]
+        if not options:
+            # Shopify's own convention for products without options
+            options = [('Title', 'Default Title')]
+
+        stock = str(fields['stock'].get(key, '') or '')
+        row = {
+            'Handle': handle,
+            'Title': fields['titre'],
+            'Body (HTML)': fields['description'],
+            'Vendor': vendor,
+            'Type': fields['type_produit'],
+            'Tags': 'OCC' if fields['occ'] else '',
+            'Published': 'FALSE',
+            'Option1 Name': options[0][0],
+            'Option1 Value': options[0][1],
+            'Option2 Name': options[1][0] if len(options) > 1 else '',
+            'Option2 Value': options[1][1] if len(options) > 1 else '',
+            'Variant SKU': fields['skus'].get(key, '') or '',
+            'Variant Grams': grams if grams is not None else '',
+            'Variant Inventory Tracker': 'shopify',
+            'Variant Inventory Qty': int(stock) if stock.isdigit() else 0,
+            'Variant Inventory Policy': 'deny',
+            'Variant Fulfillment Service': 'manual',
+            'Variant Price': price,
+            'Variant Requires Shipping': 'TRUE',
+            'Variant Taxable': 'TRUE',
+            'Variant Barcode': fields['eans'].get(key) or fields['eans'].get('default') or product_ean or '',
+            'Variant Weight Unit': 'g',
+            'Status': 'draft',
+        }
+        if index > 0:
+            for column in PRODUCT_COLUMNS:
+                row[column] = ''
+        yield row
+
+
+def export_shopify_csv(shop_data, csv_path):
+    """Stream the products of `shop_data` to a Shopify import CSV at `csv_path`; return counters."""
+    vendor = shop_data.get('raisonSociale', '') or shop_data.get('customerName', '') or shop_data.get('nomProjet', '')
+    seen_handles = set()
+    products = variants = 0
+
+    temp_path = f"{csv_path}.{os.getpid()}.part"
+    try:
+        # utf-8-sig so Excel opens accents correctly, Shopify ignores the BOM
+        with open(temp_path, 'w', encoding='utf-8-sig', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=SHOPIFY_COLUMNS)
+            writer.writeheader()
+            # The same products as the workbook process_merch_xlsx() writes
+            for product in shop_data.get('products') or []:
+                products += 1
+                for row in iter_variant_rows(product, vendor, seen_handles):
+                    writer.writerow(row)
+                    variants += 1
+        os.replace(temp_path, csv_path)
+    except Exception:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+    sha256 = file_digest(csv_path)
+    log(f"Shopify CSV saved to {csv_path}: {products} product(s), {variants} variant row(s)")
+    log(format_render_digest(csv_path, sha256))
+    return {'products': products, 'variants': variants, 'sha256': sha256}
+
+
+if __name__ == "__main__":
+    try:
+        if len(sys.argv) != 3:
+            error_msg = "Usage: python shopify_csv_export.py <shop_data_json_string> <output_csv_path>"
+            log(error_msg)
+            print(error_msg, file=sys.stderr)
+            sys.exit(1)
+
+        shop_data = json.loads(base64.b64decode(sys.argv[1]).decode('utf-8'))
+        export_shopify_csv(shop_data, sys.argv[2])
+    except Exception as e:
+        error_msg = f"Fatal error: {str(e)}"
+        log(error_msg)
+        print(error_msg, file=sys.stderr)
+        sys.exit(1)
@@ -0,0 +1,281 @@
+from lxml import etree
+import copy
+import json
+import sys
+import os
+import re
+import datetime
+import shutil
+import tempfile
+import zipfile
+
+from archive_writer import rewrite_archive, format_save_stats
+from placeholder_registry import mapping_for
+
+# Set up logging to a file
+def setup_logging():
+    log_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'logs')
+    os.makedirs(log_dir, exist_ok=True)
+    log_file = os.path.join(log_dir, f'template_normalizer_{datetime.datetime.now().strftime("%Y%m%d_%H%M%S")}.log')
+
+    def log_message(message):
+        with open(log_file, 'a', encoding='utf-8') as f:
+            timestamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            f.write(f'[{timestamp}] {message}\n')
+            print(f'[{timestamp}] {message}')
+
+    return log_message
+
+log = setup_logging()
+
+# Offline tool: rewrite a Word template so every XXXn / COMPTENUM placeholder sits alone in a
+# single clean run. docx_processor then replaces it on its exact-run pass and never needs the
+# paragraph rebuild or the XML-level regex fallback.
+
+W_NS = 'http://schemas.openxmlformats.org/wordprocessingml/2006/main'
+W = f'{{{W_NS}}}'
+XML_SPACE = '{http://www.w3.org/XML/1998/namespace}space'
+
+PLACEHOLDER_PATTERN = re.compile(r'XXX\d+|COMPTENUM')
+# Invisible characters only: no-break and narrow spaces (\u00a0, \u202f, \u2009) are French
+# typography and stay in the template
+ZERO_WIDTH_CHARS = set('\u200b\u200c\u200d\u2060\ufeff')
+
+# Parts that can hold template text
+STORY_PART_PATTERN = re.compile(r'^word/(document|header\d*|footer\d*|footnotes|endnotes)\.xml$')
+
+
+def is_text_run(run):
+    """True for runs that only carry formatting and text, the only ones safe to merge."""
+    return all(child.tag in (W + 'rPr', W + 't') for child in run)
+
+
+def run_text(run):
+    return ''.join(t.text or '' for t in run.iter(W + 't'))
+
+
+def make_run(source_run, text):
+    """Copy `source_run` (formatting included) with `text` as its only content."""
+    new_run = copy.deepcopy(source_run)
+    for t in new_run.findall(W + 't'):
+        new_run.remove(t)
+    t = etree.SubElement(new_run, W + 't')
+    t.text = text
+    if text != text.strip():
+        t.set(XML_SPACE, 'preserve')
+    return new_run
+
+
+def iter_run_sequences(container):
+    """Yield lists of consecutive mergeable runs among the children of `container`.
+
+    Any other child (tab, break, field, bookmark, content control...) ends the current
+    sequence, except spell-check markers which carry no content.
+    """
+    sequence = []
+    for child in container:
+        if child.tag == W + 'r' and is_text_run(child):
+            sequence.append(child)
+        elif child.tag == W + 'proofErr':
+            continue
+        else:
+            if sequence:
+                yield sequence
+            sequence = []
+    if sequence:
+        yield sequence
+
+
+def normalize_sequence(runs, part_name):
+    """Rewrite `runs` so each placeholder gets its own run; return one report entry per placeholder."""
+    # Flatten the text, remembering which run each character comes from
+    chars = []
+    for run_index, run in enumerate(runs):
+        chars.extend((ch, run_index) for ch in run_text(run))
+
+    # Search on the text without zero-width characters, mapped back to raw positions
+    clean_positions = [i for i, (ch, _) in enumerate(chars) if ch not in ZERO_WIDTH_CHARS]
+    clean_text = ''.join(chars[i][0] for i in clean_positions)
+
+    spans = []
+    for match in PLACEHOLDER_PATTERN.finditer(clean_text):
+        start = clean_positions[match.start()]
+        end = clean_positions[match.end() - 1] + 1
+        # Swallow invisible characters glued to the placeholder, within its own runs: the
+        # neighbouring runs are left as they are
+        while start > 0 and chars[start - 1][0] in ZERO_WIDTH_CHARS and chars[start - 1][1] == chars[start][1]:
+            start -= 1
+        while end < len(chars) and chars[end][0] in ZERO_WIDTH_CHARS and chars[end][1] == chars[end - 1][1]:
+            end += 1
+        spans.append((start, end, match.group()))
+
+    changes = []
+    for start, end, placeholder in spans:
+        first_run, last_run = chars[start][1], chars[end - 1][1]
+        if first_run == last_run and run_text(runs[first_run]) == placeholder:
+            continue  # Already alone in a clean run
+        changes.append({
+            'part': part_name,
+            'placeholder': placeholder,
+            'runs_merged': last_run - first_run + 1,
+            'zero_width_removed': sum(1 for ch, _ in chars[start:end] if ch in ZERO_WIDTH_CHARS),
+            'split_from_text': run_text(runs[first_run]) != ''.join(ch for ch, _ in chars[start:end]),
+        })
+    if not changes:
+        return []
+
+    # Rebuild the sequence: text keeps the formatting of its own run, each placeholder
+    # takes the formatting of the run holding its first character
+    new_runs = []
+    pending_text, pending_run = '', None
+
+    def flush():
+        if pending_text:
+            new_runs.append(make_run(runs[pending_run], pending_text))
+
+    position = 0
+    for start, end, placeholder in spans + [(len(chars), len(chars), None)]:
+        for ch, run_index in chars[position:start]:
+            if run_index != pending_run:
+                flush()
+                pending_text, pending_run = '', run_index
+            pending_text += ch
+        flush()
+        pending_text, pending_run = '', None
+        if placeholder is not None:
+            new_runs.append(make_run(runs[chars[start][1]], placeholder))
+        position = end
+
+    parent = runs[0].getparent()
+    first, last = parent.index(runs[0]), parent.index(runs[-1])
+    # Spell-check markers inside the rebuilt span no longer point anywhere meaningful
+    markers = [child for child in parent[first:last + 1] if child.tag == W + 'proofErr']
+    for offset, new_run in enumerate(new_runs):
+        parent.insert(first + offset, new_run)
+    for element in runs + markers:
+        parent.remove(element)
+    return changes
+
+
+def normalize_part(xml_bytes, part_name):
+    """Return (new XML bytes or None when unchanged, report entries) for one story part."""
+    root = etree.fromstring(xml_bytes)
+    changes = []
+    containers = list(dict.fromkeys(run.getparent() for run in root.iter(W + 'r')))
+    for container in containers:
+        for sequence in list(iter_run_sequences(container)):
+            changes.extend(normalize_sequence(sequence, part_name))
+    if not changes:
+        return None, []
+    return etree.tostring(root, xml_declaration=True, encoding='UTF-8', standalone=True), changes
+
+
+def find_unresolved_placeholders(docx_path):
+    """Placeholders still not alone in a clean run, e.g. split across a field or a content control."""
+    unresolved = []
+    with zipfile.ZipFile(docx_path, 'r') as zin:
+        for name in zin.namelist():
+            if not STORY_PART_PATTERN.match(name):
+                continue
+            root = etree.fromstring(zin.read(name))
+            for paragraph in root.iter(W + 'p'):
+                text = ''.join(ch for ch in ''.join(t.text or '' for t in paragraph.iter(W + 't'))
+                               if ch not in ZERO_WIDTH_CHARS)
+                clean_runs = {run_text(run) for run in paragraph.iter(W + 'r')}
+                for placeholder in PLACEHOLDER_PATTERN.findall(text):
+                    if placeholder not in clean_runs:
+                        unresolved.append({'part': name, 'placeholder': placeholder, 'paragraph': text})
+    return unresolved
+
+
+def verify_payload(mapping):
+    """Payload giving every placeholder of `mapping` a visible value, through the first field
+    of its fallback chain (the value names the field: a placeholder name would be matched again)."""
+    payload = {}
+    for fields in mapping['placeholder_fields'].values():
+        if fields:
+            payload.setdefault(fields[0], f'<<{fields[0]}>>')
+    return payload
+
+
+def verify_normalized_template(docx_path):
+    """Round-trip render the normalized template and check every placeholder is replaced on
+    the exact-run pass: no placeholder left outside a clean run, no paragraph rebuilt (which
+    loses the run formatting), no XML fallback.
+
+    `docx_path` must keep the template's file name: it selects the placeholder map the render
+    uses, and the verification payload is built from that map.
+    """
+    from docx_processor import replace_placeholders_and_format
+
+    mapping = mapping_for(docx_path, 'docx')
+    with tempfile.TemporaryDirectory() as temp_dir:
+        output_path = os.path.join(temp_dir, 'verify.docx')
+        result = replace_placeholders_and_format(docx_path, verify_payload(mapping), output_path)
+    unresolved = find_unresolved_placeholders(docx_path)
+    rebuilt = result['rebuilt_paragraphs']
+    return {'mapping': mapping['name'], 'unresolved': unresolved, 'rebuilt_paragraphs': rebuilt,
+            'xml_fallback_parts': result['xml_fallback_parts'],
+            'ok': not result['xml_fallback_parts'] and not rebuilt and not unresolved}
+
+
+def normalize_template(template_path, output_path=None):
+    """Normalize `template_path` into `output_path` (in place by default) and return a report."""
+    output_path = output_path or template_path
+    log(f"Normalizing template: {template_path}")
+
+    replacements = {}
+    merged = []
+    with zipfile.ZipFile(template_path, 'r') as zin:
+        for name in zin.namelist():
+            if not STORY_PART_PATTERN.match(name):
+                continue
+            new_xml, changes = normalize_part(zin.read(name), name)
+            for change in changes:
+                log(f"Merged {change['placeholder']} in {name}: {change['runs_merged']} run(s), "
+                    f"{change['zero_width_removed']} invisible char(s) removed")
+            if new_xml is not None:
+                replacements[name] = new_xml
+                merged.extend(changes)
+
+    # Work on a temporary copy so the template is only replaced once verification passed. The
+    # copy keeps the template's file name, which selects its placeholder map
+    temp_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(output_path)))
+    temp_path = os.path.join(temp_dir, os.path.basename(template_path))
+    try:
+        save_stats = rewrite_archive(template_path, temp_path, replacements)
+        log(f"Normalized copy written: {format_save_stats(save_stats)}")
+        verification = verify_normalized_template(temp_path)
+        report = {
+            'template': template_path,
+            'output': output_path,
+            'merged': merged,
+            'unresolved': verification['unresolved'],
+            'verification': verification,
+        }
+        if not verification['ok']:
+            log(f"Verification failed, template left untouched: {verification}")
+        elif not replacements and os.path.abspath(output_path) == os.path.abspath(template_path):
+            log("Template already normalized, nothing to write")
+        else:
+            os.replace(temp_path, output_path)
+            log(f"Normalized template saved to {output_path}")
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+    return report
+
+
+if __name__ == "__main__":
+    if len(sys.argv) not in (2, 3):
+        print("Usage: python template_normalizer.py <docx_template_path> [<output_docx_path>]", file=sys.stderr)
+        sys.exit(1)
+
+    try:
+        report = normalize_template(sys.argv[1], sys.argv[2] if len(sys.argv) == 3 else None)
+    except Exception as e:
+        log(f"Fatal error: {str(e)}")
+        print(f"Fatal error: {str(e)}", file=sys.stderr)
+        sys.exit(1)
+
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    sys.exit(0 if report['verification']['ok'] else 2)
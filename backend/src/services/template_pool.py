@@ -0,0 +1,173 @@
+import copyreg
+import hashlib
+import os
+import pickle
+import threading
+
+import openpyxl
+from openpyxl import load_workbook
+from openpyxl.worksheet.table import TableList
+
+from cache_dirs import CACHE_ROOT, private_cache_dir
+
+# Parsed XLSX templates shared by the processors.
+#
+# Every render used to call load_workbook() on the same few templates. Here each template is
+# parsed once, kept as a pickled snapshot keyed by the SHA-256 of its content (so identical
+# copies stored in several folders share one entry) and every render gets its own workbook
+# unpickled from that snapshot, which is several times cheaper than parsing the XML again.
+#
+# The processors run as one process per render, so snapshots are also kept on disk and
+# reused by the next processes. A template edited on disk has a new hash and is parsed again.
+# Unpickling runs code, so the disk tier is only used from a directory private to the
+# service's user (see cache_dirs), never from a shared location such as /tmp.
+
+SERVICES_DIR = os.path.dirname(os.path.abspath(__file__))
+
+CACHE_DIR = os.environ.get('XLSX_TEMPLATE_CACHE_DIR') or os.path.join(CACHE_ROOT, 'xlsx-templates')
+
+# Only the templates bundled with the service are pooled. A generated workbook passed as the
+# template (the customer routes append to the shop's last workbook) has a new hash after every
+# write and would push the real templates out of the cache: it is parsed directly
+TEMPLATE_DIRS = [os.path.join(SERVICES_DIR, name) for name in ('FichesProduitTemplate', 'FileWebMerch', 'TemplateSharePoint')]
+
+# Snapshots kept on disk, oldest ones are removed first
+MAX_DISK_ENTRIES = 32
+
+# TableList.items() returns (name, ref) pairs instead of the tables, which breaks the default
+# pickling of dict subclasses: pickle the real items instead. If another openpyxl build stops
+# pickling anyway, the workbook is used unpooled (see _Unpicklable)
+copyreg.pickle(TableList, lambda tables: (TableList, (), None, None, iter(dict.items(tables))))
+
+
+class _Unpicklable(Exception):
+    """The parsed workbook cannot be snapshotted; `workbook` is used as is."""
+
+    def __init__(self, workbook):
+        super().__init__('workbook cannot be pickled')
+        self.workbook = workbook
+
+
+def is_bundled_template(path):
+    """True when `path` is a template shipped with the service (see TEMPLATE_DIRS)."""
+    real_path = os.path.realpath(path)
+    name = os.path.basename(real_path)
+    # Bundle outputs are written next to the templates with this prefix (sharepointService)
+    if name.startswith('PROCESSED_'):
+        return False
+    return any(os.path.dirname(real_path) == os.path.realpath(directory) for directory in TEMPLATE_DIRS)
+
+
+class TemplatePool:
+    def __init__(self, cache_dir=CACHE_DIR, max_disk_entries=MAX_DISK_ENTRIES):
+        self.cache_dir = cache_dir
+        self.max_disk_entries = max_disk_entries
+        self._snapshots = {}  # content hash -> pickled workbook
+        self._digests = {}    # real path -> (mtime_ns, size, content hash)
+        self._lock = threading.Lock()
+        self._disk_usable = None  # checked on first use, see cache_dirs.private_cache_dir()
+        self.stats = {'memory_hits': 0, 'disk_hits': 0, 'parsed': 0}
+
+    def _digest(self, path):
+        """Content hash of `path`, recomputed only when its size or mtime changed."""
+        real_path = os.path.realpath(path)
+        stat = os.stat(real_path)
+        known = self._digests.get(real_path)
+        if known and known[:2] == (stat.st_mtime_ns, stat.st_size):
+            return known[2]
+        sha = hashlib.sha256()
+        with open(real_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                sha.update(chunk)
+        digest = sha.hexdigest()
+        self._digests[real_path] = (stat.st_mtime_ns, stat.st_size, digest)
+        return digest
+
+    def _disk_path(self, digest):
+        # The openpyxl version is part of the key: snapshots are pickled openpyxl objects
+        return os.path.join(self.cache_dir, f'{digest}.openpyxl-{openpyxl.__version__}.pickle')
+
+    def _disk_cache_usable(self):
+        if self._disk_usable is None:
+            self._disk_usable = private_cache_dir(self.cache_dir)
+        return self._disk_usable
+
+    def _load_from_disk(self, digest):
+        if not self._disk_cache_usable():
+            return None
+        try:
+            with open(self._disk_path(digest), 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def _store_on_disk(self, digest, snapshot):
+        if not self._disk_cache_usable():
+            return
+        try:
+            final_path = self._disk_path(digest)
+            temp_path = f'{final_path}.{os.getpid()}.part'
+            with open(temp_path, 'wb') as f:
+                f.write(snapshot)
+            os.replace(temp_path, final_path)
+
+            entries = [os.path.join(self.cache_dir, name) for name in os.listdir(self.cache_dir)
+                       if name.endswith('.pickle')]
+            entries.sort(key=os.path.getmtime)
+            for stale in entries[:-self.max_disk_entries]:
+                os.remove(stale)
+        except OSError:
+            # The disk cache is an optimization only
+            pass
+
+    def _snapshot(self, path):
+        digest = self._digest(path)
+        snapshot = self._snapshots.get(digest)
+        if snapshot is not None:
+            self.stats['memory_hits'] += 1
+            return snapshot, 'memory'
+
+        snapshot = self._load_from_disk(digest)
+        source = 'disk'
+        if snapshot is None:
+            workbook = load_workbook(path)
+            try:
+                snapshot = pickle.dumps(workbook, protocol=pickle.HIGHEST_PROTOCOL)
+            except Exception as error:
+                self.stats['parsed'] += 1
+                raise _Unpicklable(workbook) from error
+            self._store_on_disk(digest, snapshot)
+            source = 'parsed'
+        self._snapshots[digest] = snapshot
+        self.stats['disk_hits' if source == 'disk' else 'parsed'] += 1
+        return snapshot, source
+
+    def checkout(self, path):
+        """Return (independent Workbook for `path`, 'memory' | 'disk' | 'parsed').
+
+        Files outside the bundled template directories are parsed without being pooled.
+        """
+        if not is_bundled_template(path):
+            self.stats['parsed'] += 1
+            return load_workbook(path), 'parsed'
+        try:
+            with self._lock:
+                snapshot, source = self._snapshot(path)
+        except _Unpicklable as unpicklable:
+            return unpicklable.workbook, 'parsed'
+        try:
+            return pickle.loads(snapshot), source
+        except Exception:
+            # Unreadable snapshot (e.g. written by another openpyxl build): parse the template again
+            with self._lock:
+                self._snapshots.pop(self._digest(path), None)
+            return load_workbook(path), 'parsed'
+
+
+# Shared pool for the whole process
+template_pool = TemplatePool()
+
+
+def checkout_workbook(path):
+    """Independent copy of the parsed template at `path`, see TemplatePool.checkout()."""
+    return template_pool.checkout(path)
@@ -1,10 +1,15 @@
-from openpyxl import load_workbook
 import json
 import sys
 import os
 import base64
 import datetime
 
+from archive_writer import save_xlsx, format_save_stats, format_render_digest
+from template_pool import checkout_workbook
+from placeholder_registry import mapping_for, resolve_cells
+from render_engines import choose_engine, format_engine, measure_template
+from render_progress import RenderCancelled, abort, finish, phase, start_job
+
 # Set up logging to a file
 def setup_logging():
     log_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'logs')
@@ -24,74 +29,40 @@ log = setup_logging()
 def process_template_xlsx(template_path, template_data, output_path):
     log(f"Starting Template D2C processing for: {template_path}")
     log(f"Output will be saved to: {output_path}")
+
+    # A single row of cells: the object engine, logged like the other processors (see render_engines)
+    measurements = measure_template(template_path)
+    engine, reason = choose_engine('d2c', template_data.get('renderEngine'), measurements)
+    log(format_engine(engine, reason, measurements))
     
     try:
         # Load the template workbook
-        workbook = load_workbook(template_path)
-        log(f"Successfully loaded template: {template_path}")
+        phase('load')
+        workbook, source = checkout_workbook(template_path)
+        log(f"Successfully loaded template: {template_path} (from {source})")
         
         # Get the first worksheet
         worksheet = workbook.active
         log(f"Processing worksheet: {worksheet.title}")
         
-        # Fill row 2 with template data according to column structure:
-        # Col 1: nom de projet
-        # Col 2: type de projet  
-        # Col 3: commercial
-        # Col 4: boutique en ligne
-        # Col 5: client
-        # Col 6: contacts client
-        # Col 7: numero compte client
-        # Col 8: date de mise en ligne
-        # Col 9: date de commercialisation
-        # Col 10: date de sortie officielle
-        # Col 11: precommande (OUI/NON)
-        # Col 12: dedicace (OUI/NON)
-        # Col 13: facturation (mandataire/vendeur)
-        # Col 14: abonnement mensuel shopify (OUI/NON)
-        # Col 15: abonnement annuel shopify (OUI/NON)
-        # Col 16: couts mondial relay (OUI/NON)
-        # Col 17: couts delivengo (OUI/NON)
-        # Col 18: frais mensuel maintenance (50€)
-        # Col 19: frais ouverture boutique (500€)
-        # Col 20: frais ouverture sans habillage (empty)
-        # Col 21: commission snagz (pourcentageSNA%)
-        
-        row_data = [
-            template_data.get('nomProjet', ''),                # Col 1
-            template_data.get('typeProjet', ''),               # Col 2  
-            template_data.get('commercial', ''),               # Col 3
-            template_data.get('boutiqueEnLigne', ''),          # Col 4
-            template_data.get('client', ''),                   # Col 5
-            template_data.get('contactsClient', ''),           # Col 6
-            template_data.get('numeroCompteClient', ''),       # Col 7
-            template_data.get('dateMiseEnLigne', ''),          # Col 8
-            template_data.get('dateCommercialisation', ''),    # Col 9
-            template_data.get('dateSortieOfficielle', ''),     # Col 10
-            template_data.get('precommande', ''),              # Col 11
-            template_data.get('dedicace', ''),                 # Col 12
-            template_data.get('facturation', ''),              # Col 13
-            template_data.get('abonnementMensuelShopify', ''), # Col 14
-            template_data.get('abonnementAnnuelShopify', ''),  # Col 15
-            template_data.get('coutsMondialRelay', ''),        # Col 16
-            template_data.get('coutsDelivengo', ''),           # Col 17
-            template_data.get('fraisMensuelMaintenance', ''),  # Col 18
-            template_data.get('fraisOuvertureBoutique', ''),   # Col 19
-            template_data.get('fraisOuvertureSansHabillage', ''), # Col 20
-            template_data.get('commissionSnagz', '')           # Col 21
-        ]
-        
-        log(f"Filling row 2 with {len(row_data)} columns of data")
-        
-        # Fill row 2 (index 2) with the data
-        for col_idx, value in enumerate(row_data, 1):
-            cell = worksheet.cell(row=2, column=col_idx)
-            cell.value = value
-            log(f"Set column {col_idx} to: '{value}'")
+        # Fill row 2 with template data, one column per field (see placeholder_maps/template_d2c.json):
+        # nom de projet, type de projet, commercial, boutique en ligne, client, contacts client,
+        # numero compte client, dates (mise en ligne, commercialisation, sortie officielle),
+        # precommande, dedicace, facturation, abonnements Shopify, couts Mondial Relay/Delivengo,
+        # frais (maintenance, ouverture, ouverture sans habillage), commission snagz
+        cell_values = resolve_cells(mapping_for(template_path, 'd2c'), template_data)
+
+        log(f"Filling row 2 with {len(cell_values)} columns of data")
+
+        for coordinate, value in cell_values.items():
+            worksheet[coordinate].value = value
+            log(f"Set {coordinate} to: '{value}'")
         
         # Save the workbook
-        workbook.save(output_path)
-        log(f"Template D2C file saved to {output_path}")
+        phase('save')
+        save_stats = save_xlsx(workbook, output_path, template_data.get('saveProfile'), source_path=template_path)
+        log(f"Template D2C file saved to {output_path}: {format_save_stats(save_stats)}")
+        log(format_render_digest(output_path, save_stats['sha256']))
         log("Template D2C processing completed successfully")
         
     except Exception as e:
@@ -126,8 +97,14 @@ def main():
         
         # Process the template
         log("Starting template processing...")
+        start_job('template_processor', [output_path])
         process_template_xlsx(template_path, template_data, output_path)
+        finish(output_path)
         
+    except RenderCancelled as e:
+        # Cancel request or deadline: outputs removed, see render_progress
+        log(f"Processing cancelled: {str(e)}")
+        sys.exit(abort(e))
     except Exception as e:
         log(f"Fatal error: {str(e)}")
         print(f"Fatal error: {str(e)}")
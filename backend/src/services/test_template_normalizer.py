@@ -0,0 +1,38 @@
+import unittest
+
+from lxml import etree
+
+from template_normalizer import W, W_NS, normalize_part, run_text
+
+# python -m unittest test_template_normalizer (from backend/src/services)
+
+
+def document(*runs):
+    """word/document.xml with one paragraph made of `runs` (one text per run)."""
+    body = ''.join(f'<w:r><w:t xml:space="preserve">{text}</w:t></w:r>' for text in runs)
+    return f'<w:document xmlns:w="{W_NS}"><w:body><w:p>{body}</w:p></w:body></w:document>'.encode('utf-8')
+
+
+def paragraph_runs(xml_bytes):
+    return [run_text(run) for run in etree.fromstring(xml_bytes).iter(W + 'r')]
+
+
+class NormalizePartTest(unittest.TestCase):
+    def test_placeholder_alone_between_french_spaces_is_left_untouched(self):
+        new_xml, changes = normalize_part(document('Commission :\xa0', 'XXX1', '\u202f% HT'), 'word/document.xml')
+        self.assertIsNone(new_xml)
+        self.assertEqual(changes, [])
+
+    def test_split_placeholder_keeps_the_spacing_of_its_neighbours(self):
+        new_xml, changes = normalize_part(document('Commission :\xa0', 'XX', 'X1', '\u2009% HT'), 'word/document.xml')
+        self.assertEqual(paragraph_runs(new_xml), ['Commission :\xa0', 'XXX1', '\u2009% HT'])
+        self.assertEqual(changes[0]['runs_merged'], 2)
+
+    def test_zero_width_characters_are_only_taken_from_the_placeholder_runs(self):
+        new_xml, changes = normalize_part(document('Nom :\u200b', '\u200bXXX2\u200b', '\u200b fin'), 'word/document.xml')
+        self.assertEqual(paragraph_runs(new_xml), ['Nom :\u200b', 'XXX2', '\u200b fin'])
+        self.assertEqual(changes[0]['zero_width_removed'], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
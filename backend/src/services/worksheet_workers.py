@@ -0,0 +1,168 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from xml.sax.saxutils import escape
+
+from lxml import etree
+from openpyxl.cell.cell import ERROR_CODES, ILLEGAL_CHARACTERS_RE
+from openpyxl.compat import safe_string
+
+from render_progress import checkpoint, pool_results, sheets_written
+
+# Per-worksheet processing of XLSX workbooks, at the sheet XML level.
+#
+# The processors used to walk `workbook.worksheets` one after the other through openpyxl,
+# cell by cell, on one core. The workbook is still loaded (template pool) and serialized by
+# openpyxl, but the cell work now happens on the serialized worksheet parts: openpyxl writes
+# every string inline (no shared string table), so each xl/worksheets/sheetN.xml holds all
+# the text of its sheet and can be parsed and rewritten on its own. The save patch hands each
+# part to its own worker of a process pool; the parts are independent, so the sheets scale
+# with the cores instead of with their number.
+
+SHEET_NS = 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'
+
+CELL_TAG = f'{{{SHEET_NS}}}c'
+FORMULA_TAG = f'{{{SHEET_NS}}}f'
+INLINE_STRING_TAG = f'{{{SHEET_NS}}}is'
+TEXT_TAG = f'{{{SHEET_NS}}}t'
+
+
+def resolve_sheet_workers(option, sheet_count):
+    """Number of sheet workers for `option` (payload `sheetWorkers` or $XLSX_SHEET_WORKERS):
+    a number, 'auto' (one per core) or empty (per-sheet processing off). 0 when it does not apply."""
+    option = option if option not in (None, '') else os.environ.get('XLSX_SHEET_WORKERS', '')
+    if option in ('', False, 0, '0'):
+        return 0
+    if option in ('auto', True):
+        workers = os.cpu_count() or 1
+    else:
+        workers = int(option)
+    # Never more workers than sheets
+    return max(0, min(workers, sheet_count))
+
+
+def cell_xml(coordinate, style_id, value):
+    """<c> element for `value`, with the same data types openpyxl infers on assignment."""
+    style = f' s="{style_id}"' if style_id is not None else ''
+    if value is None:
+        return f'<c r="{coordinate}"{style}/>'
+    if value == '':
+        return f'<c r="{coordinate}"{style} t="inlineStr"/>'
+    if isinstance(value, bool):
+        return f'<c r="{coordinate}"{style} t="b"><v>{int(value)}</v></c>'
+    if isinstance(value, (int, float)):
+        return f'<c r="{coordinate}"{style} t="n"><v>{safe_string(value)}</v></c>'
+    value = str(value)
+    if ILLEGAL_CHARACTERS_RE.search(value):
+        # openpyxl refuses these values, the serial writer leaves the cell empty
+        return f'<c r="{coordinate}"{style}/>'
+    if value.startswith('=') and len(value) > 1:
+        return f'<c r="{coordinate}"{style}><f>{escape(value[1:])}</f><v></v></c>'
+    if value in ERROR_CODES:
+        return f'<c r="{coordinate}"{style} t="e"><v>{escape(value)}</v></c>'
+    space = ' xml:space="preserve"' if value != value.strip() else ''
+    return f'<c r="{coordinate}"{style} t="inlineStr"><is><t{space}>{escape(value)}</t></is></c>'
+
+
+def _cell_text(c):
+    """The value openpyxl gives a string or formula cell (formulas with their '='), else None."""
+    if c.get('t') == 'inlineStr':
+        inline = c.find(INLINE_STRING_TAG)
+        return ''.join(t.text or '' for t in inline.iter(TEXT_TAG)) if inline is not None else None
+    formula = c.find(FORMULA_TAG)
+    if formula is not None and formula.get('t') not in ('array', 'dataTable'):
+        return f"={formula.text or ''}"
+    return None
+
+
+def _new_value(coordinate, value, rewrite, notes):
+    """New text of one cell, same order of precedence as the serial processors."""
+    cells = rewrite.get('cells', {})
+    conditional = rewrite.get('conditional_cells', {})
+    if coordinate in cells:
+        notes.append(f"Cell {coordinate} set to '{cells[coordinate]}' (was: '{value}')")
+        return cells[coordinate]
+    if coordinate in conditional:
+        markers, replacement = conditional[coordinate]
+        if any(marker in value for marker in markers):
+            notes.append(f"Cell {coordinate} set to '{replacement}' (was: '{value}')")
+            return replacement
+        return value
+    for placeholder, replacement in rewrite.get('placeholders', {}).items():
+        if placeholder in value:
+            value = value.replace(placeholder, str(replacement))
+            notes.append(f"Replaced {placeholder} with {replacement} in cell {coordinate}")
+    return value
+
+
+def rewrite_cells(sheet_xml, rewrite):
+    """Apply `rewrite` to the string and formula cells of one worksheet part.
+
+    `rewrite` holds 'placeholders' ({placeholder: text}, replaced inside the cell text),
+    'cells' ({coordinate: text}, the whole text of a non-empty cell) and 'conditional_cells'
+    ({coordinate: (markers, text)}, the whole text when it contains one of the markers).
+    Returns (worksheet XML, notes for the log).
+    """
+    notes = []
+    placeholders = rewrite.get('placeholders', {})
+    if (not rewrite.get('cells') and not rewrite.get('conditional_cells')
+            and not any(escape(placeholder) in sheet_xml for placeholder in placeholders)):
+        return sheet_xml, notes
+
+    root = etree.fromstring(sheet_xml.encode('utf-8'))
+    changed = False
+    for c in root.iter(CELL_TAG):
+        value = _cell_text(c)
+        if not value:
+            continue
+        new_value = _new_value(c.get('r'), value, rewrite, notes)
+        if new_value == value:
+            continue
+        replacement = etree.fromstring(f'<x xmlns="{SHEET_NS}">{cell_xml(c.get("r"), c.get("s"), new_value)}</x>')[0]
+        c.getparent().replace(c, replacement)
+        changed = True
+
+    if not changed:
+        return sheet_xml, notes
+    declaration = sheet_xml.lstrip().startswith('<?xml')
+    return etree.tostring(root, xml_declaration=declaration, encoding='UTF-8').decode('utf-8'), notes
+
+
+def _run_task(data, task):
+    function, args = task
+    return function(data.decode('utf-8'), *args)
+
+
+def sheet_patch(workbook, task_for_sheet, workers, notes):
+    """save_xlsx() patch running one task per worksheet part, in `workers` processes.
+
+    `task_for_sheet(worksheet)` returns (function, args) or None to keep the part as written;
+    function(sheet_xml, *args) -> (sheet_xml, notes) must be a module-level function so the
+    workers can import it. The notes of each sheet are appended to `notes` as (title, notes).
+    """
+    def patch(members):
+        # Worksheet paths are only known once openpyxl has written the workbook
+        tasks = {}
+        for worksheet in workbook.worksheets:
+            task = task_for_sheet(worksheet)
+            if task is not None:
+                tasks[worksheet.path.lstrip('/')] = (worksheet.title, task)
+
+        jobs = [(index, name, data) for index, (name, data) in enumerate(members) if name in tasks]
+        if workers > 1 and len(jobs) > 1:
+            with ProcessPoolExecutor(max_workers=min(workers, len(jobs))) as pool:
+                futures = [pool.submit(_run_task, data, tasks[name][1]) for _, name, data in jobs]
+                results = pool_results(pool, futures, lambda done: sheets_written(done, len(jobs)))
+        else:
+            results = []
+            for _, name, data in jobs:
+                checkpoint()
+                results.append(_run_task(data, tasks[name][1]))
+                sheets_written(len(results), len(jobs))
+
+        patched = list(members)
+        for (index, name, _), (sheet_xml, sheet_notes) in zip(jobs, results):
+            patched[index] = (name, sheet_xml.encode('utf-8'))
+            notes.append((tasks[name][0], sheet_notes))
+        return patched
+
+    return patch
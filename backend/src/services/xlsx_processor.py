@@ -1,10 +1,16 @@
-from openpyxl import load_workbook
 import json
 import sys
 import os
 import base64
 import datetime
 
+from archive_writer import save_xlsx, format_save_stats, format_render_digest
+from template_pool import checkout_workbook
+from worksheet_workers import resolve_sheet_workers, rewrite_cells, sheet_patch
+from placeholder_registry import mapping_for, resolve_placeholders
+from render_engines import choose_engine, format_engine, measure_template, pool_workers
+from render_progress import RenderCancelled, abort, finish, phase, sheets_written, start_job
+
 # Set up logging to a file
 def setup_logging():
     log_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'logs')
@@ -27,51 +33,50 @@ def replace_placeholders_in_xlsx(xlsx_path, shop_data, output_path):
     log(f"Output will be saved to: {output_path}")
     
     try:
-        workbook = load_workbook(xlsx_path)
-        log(f"Successfully loaded workbook: {xlsx_path}")
+        phase('load')
+        workbook, source = checkout_workbook(xlsx_path)
+        log(f"Successfully loaded workbook: {xlsx_path} (from {source})")
     except Exception as e:
         log(f"Failed to load workbook: {str(e)}")
         raise
 
     log(f"[DEBUG - Inside replace_placeholders_in_xlsx] Type of shop_data: {type(shop_data)}")
-    log(f"[DEBUG - Inside replace_placeholders_in_xlsx] Content of shop_data: {shop_data}")
     
     # Ensure shop_data is a dictionary
     if not isinstance(shop_data, dict):
-        error_msg = f"[ERROR] shop_data is not a dictionary. Type: {type(shop_data)}, Value: {shop_data}"
+        error_msg = f"[ERROR] shop_data is not a dictionary. Type: {type(shop_data)}"
         log(error_msg)
         raise ValueError(error_msg)
 
-    # Get the raisonSociale from the customer data (passed in shop_data)
-    raison_sociale = shop_data.get("raisonSociale", "") or shop_data.get("clientName", "").split('_')[0]
-    
-    # Get boolean values from shop_data and convert to OUI/NON
-    precommande_value = "OUI" if shop_data.get("precommande", False) else "NON"
-    dedicace_value = "OUI" if shop_data.get("dedicaceEnvisagee", False) else "NON"
-    
-    placeholder_mapping = {
-        "XXX1": shop_data.get("nomProjet", ""),  # Project name
-        "XXX2": shop_data.get("typeProjet", ""),  # Project type
-        "XXX3": shop_data.get("commercial", ""),  # XXX3 commercial
-        "XXX4": raison_sociale,  # Client's raison sociale
-        "XXX5": shop_data.get("compteClientRef", ""),  # Client reference
-        "XXX6": shop_data.get("contactsClient", ""),  # Client contact email
-        "XXX7": shop_data.get("dateMiseEnLigne", ""),  # Go-live date
-        "XXX8": shop_data.get("dateCommercialisation", ""),  # Commercialization date
-        "XXX9": shop_data.get("dateSortieOfficielle", ""),  # Official release date
-        "XXX10": precommande_value,  # Pre-order (OUI/NON)
-        "XXX11": dedicace_value,  # Dedication planned (OUI/NON)
-        "XXX12": shop_data.get("boutiqueEnLigne", ""),  # Boutique en ligne (OUI/NON)
-        "XXX13": shop_data.get("chefProjet", ""),  # Chef de projet (prenom + nom)
-        "XXX14": shop_data.get("demarrageProjet", ""),
-        "XXX15": shop_data.get("contactsClient", ""),
-        "COMPTENUM": shop_data.get("compteClientRef", ""),  # Client reference number
-    }
+    # Placeholder values come from the template's mapping file (placeholder_maps/)
+    xlsx_mapping = mapping_for(xlsx_path, 'xlsx')
+    placeholder_mapping = resolve_placeholders(xlsx_mapping, shop_data)
+
+    # Engine for this job, from the template shape (see render_engines)
+    measurements = measure_template(xlsx_path, [key for key, _ in xlsx_mapping['placeholders']])
+    engine, reason = choose_engine('xlsx', shop_data.get('renderEngine'), measurements)
+    log(format_engine(engine, reason, measurements))
 
     log(f"Processing {len(workbook.worksheets)} worksheets...")
 
-    # Process all worksheets
-    for worksheet in workbook.worksheets:
+    # Multi-sheet workbooks: each worksheet part rewritten by its own worker (see worksheet_workers)
+    save_patch = None
+    sheet_notes = []
+    sheet_workers = 0
+    if engine == 'xml_patch':
+        sheet_workers = resolve_sheet_workers(
+            pool_workers(shop_data.get('sheetWorkers'), 'XLSX_SHEET_WORKERS', measurements), len(workbook.worksheets))
+        if not sheet_workers:
+            log("Per-sheet processing not used, no sheet worker: object engine")
+    if sheet_workers:
+        log(f"Per-sheet processing on {sheet_workers} process(es)")
+        rewrite = {'placeholders': placeholder_mapping}
+        save_patch = sheet_patch(workbook, lambda worksheet: (rewrite_cells, (rewrite,)), sheet_workers, sheet_notes)
+
+    # Process all worksheets (the sheet workers do it when saving in per-sheet mode)
+    worksheets = [] if save_patch else workbook.worksheets
+    phase('render', engine=engine)
+    for index, worksheet in enumerate(worksheets, 1):
         log(f"Processing worksheet: {worksheet.title}")
         
         # Iterate through all cells in the worksheet
@@ -90,10 +95,17 @@ def replace_placeholders_in_xlsx(xlsx_path, shop_data, output_path):
                     # Update the cell if any replacements were made
                     if new_value != original_value:
                         cell.value = new_value
+        sheets_written(index, len(worksheets))
 
     # Save the processed workbook
-    workbook.save(output_path)
-    log(f"XLSX file saved to {output_path}")
+    phase('save')
+    save_stats = save_xlsx(workbook, output_path, shop_data.get('saveProfile'), patch=save_patch, source_path=xlsx_path)
+    for title, notes in sheet_notes:
+        log(f"Processed worksheet: {title}")
+        for note in notes:
+            log(note)
+    log(f"XLSX file saved to {output_path}: {format_save_stats(save_stats)}")
+    log(format_render_digest(output_path, save_stats['sha256']))
 
 if __name__ == "__main__":
     try:
@@ -120,7 +132,6 @@ if __name__ == "__main__":
             log("Successfully decoded base64 data")
             
             log(f"[DEBUG] Type of shop_data_string after decode: {type(shop_data_string)}")
-            log(f"[DEBUG] First 100 chars of shop_data_string: {shop_data_string[:100]}...")
 
             # Parse the JSON string
             log("Parsing JSON data...")
@@ -132,9 +143,15 @@ if __name__ == "__main__":
 
             # Process the XLSX file
             log("Starting XLSX processing...")
+            start_job('xlsx_processor', [output_path])
             replace_placeholders_in_xlsx(template_path, shop_data, output_path)
             log("XLSX processing completed successfully")
+            finish(output_path)
             
+        except RenderCancelled as e:
+            # Cancel request or deadline: outputs removed, see render_progress
+            log(f"Processing cancelled: {str(e)}")
+            sys.exit(abort(e))
         except Exception as e:
             error_msg = f"Error processing XLSX: {str(e)}"
             log(error_msg)